@@ -1,3 +1,5 @@
 from bquery.ctable import ctable
 from bquery.carray import carray
+from bquery.cache import chunk_cache, filter_cache
+from bquery.engine import QueryEngine
 from toplevel import open
\ No newline at end of file
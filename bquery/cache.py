@@ -0,0 +1,210 @@
+from collections import OrderedDict
+import functools
+import os
+import threading
+
+from bcolz import carray_ext
+
+
+def _nbytes(value):
+    return value.nbytes
+
+
+class LRUCache(object):
+    """
+    A thread-safe LRU cache of numpy arrays, bounded by the total number of
+    bytes of the cached arrays
+
+    sizeof is used to count the bytes of an array, so compressed arrays
+    can be counted by their compressed size.
+    The hits, misses and evictions are counted, see stats()
+    """
+
+    def __init__(self, max_bytes, sizeof=_nbytes):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached array for key (or None) and mark it as most
+        recently used
+
+        :param key:
+        :return:
+        """
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Cache an array under key, evicting the least recently used arrays
+        until the cache fits in max_bytes again
+
+        :param key:
+        :param value:
+        :return:
+        """
+        if self.sizeof(value) > self.max_bytes:
+            return
+
+        with self._lock:
+            old_value = self._items.pop(key, None)
+            if old_value is not None:
+                self.nbytes -= self.sizeof(old_value)
+            self._items[key] = value
+            self.nbytes += self.sizeof(value)
+            self._evict()
+
+    def invalidate(self, prefix):
+        """
+        Remove all arrays whose key starts with prefix
+
+        :param prefix: a tuple with the first elements of the keys
+        :return:
+        """
+        with self._lock:
+            for key in list(self._items):
+                if key[:len(prefix)] == prefix:
+                    self.nbytes -= self.sizeof(self._items.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'items': len(self._items),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            _, value = self._items.popitem(last=False)
+            self.nbytes -= self.sizeof(value)
+            self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+def _cbytes(value):
+    return value.cbytes
+
+
+def file_stamp(path):
+    """
+    Return the inode, size and modification time of a file, or None when
+    it does not exist
+
+    :param path:
+    :return:
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime
+
+
+_state = threading.local()
+
+
+class stamp_scope(object):
+    """
+    A context (of a query) in which every on-disk carray is stamped once,
+    see carray_stamp; scopes can be nested, the outermost one counts
+
+    The carrays are taken to be unchanged within the scope, so a query that
+    reads the chunks of a carray pays two stat calls for all of them.
+    """
+
+    def __enter__(self):
+        self.outer = getattr(_state, 'stamps', None) is not None
+        if not self.outer:
+            _state.stamps = {}
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.outer:
+            _state.stamps = None
+
+
+def stamped(method):
+    """
+    Run a (query) method in a stamp_scope
+
+    :param method:
+    :return:
+    """
+    @functools.wraps(method)
+    def stamped_method(*args, **kwargs):
+        with stamp_scope():
+            return method(*args, **kwargs)
+    return stamped_method
+
+
+def carray_stamp(ca):
+    """
+    Return the write stamp of an on-disk carray: the inode, size and
+    modification time of its sizes file and of its leftover chunk file,
+    which bcolz rewrites with every flush (also by another process), so
+    writes to the carray are seen with their flush, like other handles see
+    them
+
+    :param ca:
+    :return:
+    """
+    rootdir = os.path.normpath(ca.rootdir)
+    stamps = getattr(_state, 'stamps', None)
+    if stamps is not None and rootdir in stamps:
+        return stamps[rootdir]
+
+    leftover_nr = len(ca) // ca.chunklen
+    stamp = (
+        file_stamp(os.path.join(rootdir, carray_ext.META_DIR,
+                                 carray_ext.SIZES_FILE)),
+        file_stamp(os.path.join(rootdir, carray_ext.DATA_DIR, '__%d%s' % (
+            leftover_nr, carray_ext.EXTENSION))))
+    if stamps is not None:
+        stamps[rootdir] = stamp
+    return stamp
+
+
+# process-wide cache of decompressed chunks of on-disk carrays, keyed by
+# (ctable rootdir, column, chunk number, write stamp of the carray)
+chunk_cache = LRUCache(max_bytes=256 * 2 ** 20)
+
+# process-wide cache of where_terms selections as compressed boolean
+# carrays, keyed by (ctable rootdir, normalised term, row ranges, version
+# stamp of the term columns)
+filter_cache = LRUCache(max_bytes=64 * 2 ** 20, sizeof=_cbytes)
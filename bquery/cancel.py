@@ -0,0 +1,65 @@
+import threading
+import time
+
+
+class QueryCancelled(Exception):
+    """
+    Raised at a chunk boundary of a query that was cancelled
+    """
+    pass
+
+
+class QueryTimeout(QueryCancelled):
+    """
+    Raised at a chunk boundary of a query that ran past its deadline
+    """
+    pass
+
+
+class CancelToken(object):
+    """
+    The cancellation state of a query, with an optional timeout in seconds
+
+    The kernels call check_cancelled() between chunks, which checks the
+    token of the running thread (see set_token), so a query stops at the
+    next chunk boundary once it is cancelled or past its deadline.
+    """
+
+    def __init__(self, timeout=None):
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        if self.cancelled:
+            raise QueryCancelled('The query was cancelled')
+        if self.deadline is not None and time.time() > self.deadline:
+            raise QueryTimeout('The query ran past its timeout')
+
+
+_state = threading.local()
+
+
+def set_token(token):
+    """
+    Set the cancellation token of the queries run by the current thread
+    (None to run them without one)
+
+    :param token:
+    :return:
+    """
+    _state.token = token
+
+
+def check_cancelled():
+    """
+    Raise QueryCancelled when the query of the current thread is cancelled
+    or past its deadline
+
+    :return: :raise QueryCancelled:
+    """
+    token = getattr(_state, 'token', None)
+    if token is not None:
+        token.check()
@@ -0,0 +1,140 @@
+import timeit
+
+import bcolz
+import numpy as np
+
+# the candidates tried by choose_cparams: the codecs (as far as blosc
+# supports them), both shuffle settings and chunk sizes in bytes, all at
+# the default compression level
+AUTO_CNAMES = ('blosclz', 'lz4', 'lz4hc', 'snappy', 'zlib')
+AUTO_CHUNK_BYTES = (2 ** 14, 2 ** 16, 2 ** 18)
+AUTO_CLEVEL = 5
+# the bytes of every column that are sampled
+AUTO_SAMPLE_BYTES = 2 ** 20
+# the read rate at which compressed bytes are weighed against decompression
+# time (see choose_cparams)
+AUTO_READ_BANDWIDTH = 500 * 2 ** 20
+# candidates within this fraction of the lowest cost count as equally fast,
+# between them the smallest compressed size wins (see choose_cparams)
+AUTO_COST_TOLERANCE = 0.25
+
+
+def to_cparams(cparams):
+    """
+    Return the bcolz.cparams for a compression setting: None (the bcolz
+    defaults), a bcolz.cparams or a dict of its arguments, like
+    {'cname': 'lz4', 'clevel': 5, 'shuffle': True}
+
+    :param cparams:
+    :return: :raise ValueError:
+    """
+    if cparams is None:
+        return bcolz.cparams()
+    elif isinstance(cparams, bcolz.cparams):
+        return cparams
+    elif isinstance(cparams, dict):
+        return bcolz.cparams(**cparams)
+    raise ValueError("cparams should be None, 'auto', a bcolz.cparams or a "
+                     "dict, not " + repr(cparams))
+
+
+def cparams_meta(cparams, chunklen, auto=False):
+    """
+    Return the compression settings of a carray as a dict that can be
+    stored in its attrs
+
+    :param cparams: a bcolz.cparams
+    :param chunklen:
+    :param auto: whether the settings were picked by choose_cparams
+    :return:
+    """
+    return {
+        'cname': cparams.cname,
+        'clevel': cparams.clevel,
+        'shuffle': bool(cparams.shuffle),
+        'chunklen': chunklen,
+        'auto': auto
+    }
+
+
+def sample_rows(columns, sample_bytes=AUTO_SAMPLE_BYTES):
+    """
+    Return the number of leading rows of the columns to sample, so that
+    every column is sampled with at most sample_bytes
+
+    :param columns: a list of arrays (or carrays)
+    :param sample_bytes:
+    :return:
+    """
+    itemsize = max([column.dtype.itemsize for column in columns])
+    return min(len(columns[0]), max(1, sample_bytes // itemsize))
+
+
+def _decompress_seconds(ca, repeats):
+    seconds = []
+    for _ in range(repeats):
+        start = timeit.default_timer()
+        ca[:]
+        seconds.append(timeit.default_timer() - start)
+    return min(seconds)
+
+
+def choose_cparams(samples, chunklen=None,
+                   read_bandwidth=AUTO_READ_BANDWIDTH, repeats=3):
+    """
+    Pick the codec, shuffle and chunklen for carrays with the given sample
+    data (e.g. their first chunks): the one with the lowest cost, i.e. the
+    time to decompress the samples plus the time to read their compressed
+    bytes at read_bandwidth, so small and fast to decompress both count
+
+    Samples shorter than the smallest candidate chunk are stored in a
+    single chunk, as is usual for small aggregation results.
+
+    The decompression is timed, so the choice can differ between runs and
+    machines. To keep it as stable as possible, the candidates within
+    AUTO_COST_TOLERANCE of the lowest cost are treated as equal, and the
+    one with the smallest compressed size (which does not depend on
+    timing) is picked from them, the first candidate on equal size.
+
+    :param samples: a list of arrays, one per carray (e.g. the columns of
+     a ctable, which share the compression settings and chunklen)
+    :param chunklen: a fixed chunklen (e.g. to stay chunk-aligned with
+     another carray), or None to pick one
+    :param read_bandwidth: in bytes per second
+    :param repeats: the decompression is timed as the fastest of repeats
+    :return: cparams, chunklen
+    """
+    nr_rows = len(samples[0])
+    if nr_rows == 0:
+        return to_cparams(None), chunklen
+
+    if chunklen is not None:
+        chunklens = [chunklen]
+    else:
+        itemsize = max([sample.dtype.itemsize for sample in samples])
+        chunklens = [chunk_bytes // itemsize
+                     for chunk_bytes in AUTO_CHUNK_BYTES
+                     if chunk_bytes // itemsize <= nr_rows] or [nr_rows]
+
+    available = bcolz.blosc_compressor_list()
+    candidates = []
+    for cname in [cname for cname in AUTO_CNAMES if cname in available]:
+        for shuffle in (True, False):
+            cparams = bcolz.cparams(clevel=AUTO_CLEVEL, shuffle=shuffle,
+                                    cname=cname)
+            for candidate_chunklen in chunklens:
+                cost, cbytes = 0.0, 0
+                for sample in samples:
+                    ca = bcolz.carray(sample, cparams=cparams,
+                                      chunklen=candidate_chunklen)
+                    cost += _decompress_seconds(ca, repeats) + \
+                        ca.cbytes / float(read_bandwidth)
+                    cbytes += ca.cbytes
+                candidates.append((cost, cbytes, cparams, candidate_chunklen))
+
+    max_cost = min([cost for cost, _, _, _ in candidates]) * \
+        (1 + AUTO_COST_TOLERANCE)
+    _, _, cparams, chunklen = min(
+        [candidate for candidate in candidates if candidate[0] <= max_cost],
+        key=lambda candidate: candidate[1])
+    return cparams, chunklen
@@ -1,15 +1,269 @@
 # internal imports
 import ctable_ext
+from bquery.cache import carray_stamp, chunk_cache, filter_cache, stamped
+from bquery.cancel import check_cancelled
+from bquery.compression import choose_cparams, cparams_meta, sample_rows, \
+    to_cparams
 
 # external imports
 import numpy as np
 import bcolz
 from collections import namedtuple
 import os
+import shutil
+import hashlib
+import json
+import re
+import ast
+from bcolz.ctable import ROOTDIRS, cols as bcolz_cols
+
+
+def key_bin(values, edges):
+    """
+    Return the index of the bin that each value falls in (see np.digitize)
+    """
+    return np.digitize(values, edges)
+
+
+def key_trunc(values, unit):
+    """
+    Truncate epoch seconds to the start of their day ('D'), month ('M')
+    or year ('Y'), as epoch seconds
+    """
+    return values.astype('datetime64[s]').astype('datetime64[%s]' % unit) \
+        .astype('datetime64[s]').astype('int64')
+
+
+# the aggregation operations that take quantiles (see groupby)
+quantile_ops = ('median', 'quantile', 'percentile', 'approx_median',
+                'approx_quantile', 'approx_percentile')
+
+# the functions that can be used in groupby key expressions, next to the
+# python operators
+key_functions = {
+    'bin': key_bin,
+    'floor': np.floor,
+    'ceil': np.ceil,
+    'trunc_day': lambda values: key_trunc(values, 'D'),
+    'trunc_month': lambda values: key_trunc(values, 'M'),
+    'trunc_year': lambda values: key_trunc(values, 'Y')
+}
+
+# the syntax of groupby key expressions: literals, columns, arithmetic,
+# comparisons and calls of key_functions (see ctable.compile_key_expression);
+# no powers, as a literal like 10 ** 10 ** 10 would not finish evaluating
+key_expression_nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare,
+                        ast.Call, ast.Name, ast.Load, ast.Num, ast.Str,
+                        ast.List, ast.Tuple, ast.Add, ast.Sub, ast.Mult,
+                        ast.Div, ast.FloorDiv, ast.Mod, ast.BitAnd,
+                        ast.BitOr, ast.BitXor, ast.LShift, ast.RShift,
+                        ast.unaryop, ast.cmpop)
+
+# the dense result of ctable.pivot, with the labels of both axes
+pivot_result = namedtuple('pivot_result', ['values', 'row_values',
+                                           'col_values'])
+
+
+def append_labels(values, rows):
+    """
+    Return the labels of rows in a factorization with the unique values
+    values, and the values of the rows that are not in values yet, which
+    get the next labels in order
+
+    :param values: the unique values of the factorization
+    :param rows:
+    :return: labels, new_values
+    """
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    known = dict(zip(values.tolist(), xrange(len(values))))
+
+    unique_labels = np.empty(len(unique_rows), dtype='int64')
+    new_values = []
+    for i, value in enumerate(unique_rows.tolist()):
+        label = known.get(value)
+        if label is None:
+            label = len(values) + len(new_values)
+            new_values.append(value)
+        unique_labels[i] = label
+
+    return unique_labels[inverse], np.array(new_values, dtype=values.dtype)
+
+
+def key_globals():
+    # the globals of key expressions: the key functions and no builtins
+    key_globals = dict(key_functions)
+    key_globals['__builtins__'] = {}
+    return key_globals
+
+
+class ctable_rows(object):
+    """
+    The rows of a ctable in a list of (start, stop) ranges (see
+    ctable.row_ranges), which the aggregation kernels read like a ctable:
+    its columns are ctable_ext.row_view objects, so only the chunks that
+    overlap the ranges are decompressed
+    """
+
+    def __init__(self, ct, ranges):
+        self.ct = ct
+        self.ranges = ranges
+        self.names = ct.names
+
+    def __getitem__(self, name):
+        return ctable_ext.row_view(self.ct[name], self.ranges)
+
+    def __len__(self):
+        return sum(stop - start for start, stop in self.ranges)
+
+    def measure_cols(self, input_col):
+        return self.ct.measure_cols(input_col)
+
+    def measure_dtype(self, input_col):
+        return self.ct.measure_dtype(input_col)
+
+
+class lazy_cols(bcolz_cols):
+    """
+    The columns accessor of a ctable that opens the carrays of an on-disk
+    ctable on first access, instead of all of them when the ctable is
+    opened
+
+    The dtypes of the columns are also stored next to the names in the
+    rootdirs file, so that the dtype of the ctable is known without opening
+    any column (for ctables written by bcolz itself they are read from the
+    storage metadata of the column).
+    """
+
+    def __init__(self, rootdir, mode):
+        super(lazy_cols, self).__init__(rootdir, mode)
+        self._dtypes = {}
+
+    def read_meta_and_open(self):
+        rootsfile = os.path.join(self.rootdir, ROOTDIRS)
+        with open(rootsfile, 'rb') as rfile:
+            data = json.loads(rfile.read().decode('ascii'))
+        self.names = [str(name) for name in data['names']]
+        for name, col_dtype in data.get('dtypes', {}).items():
+            self._dtypes[str(name)] = np.dtype(str(col_dtype))
+
+    def update_meta(self):
+        if not self.rootdir:
+            return
+        data = {
+            'names': self.names,
+            'dtypes': dict((name, self.dtype(name).str)
+                           for name in self.names)
+        }
+        rootsfile = os.path.join(self.rootdir, ROOTDIRS)
+        with open(rootsfile, 'wb') as rfile:
+            rfile.write(json.dumps(data).encode('ascii'))
+            rfile.write(b"\n")
+
+    def dtype(self, name):
+        """
+        Return the dtype of a column, without opening it
+
+        :param name:
+        :return:
+        """
+        if name in self._cols:
+            return self._cols[name].dtype
+        if name not in self._dtypes:
+            storage_file = os.path.join(self.rootdir, name, 'meta', 'storage')
+            with open(storage_file, 'rb') as sfile:
+                storage = json.loads(sfile.read().decode('ascii'))
+            self._dtypes[name] = np.dtype(str(storage['dtype']))
+        return self._dtypes[name]
+
+    def __getitem__(self, name):
+        if name not in self._cols:
+            if not self.rootdir or name not in self.names:
+                raise KeyError(name)
+            self._cols[name] = bcolz.carray(
+                rootdir=os.path.join(self.rootdir, name), mode=self.mode)
+        return self._cols[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def opened(self):
+        """
+        Return the columns that have been opened (or added) so far
+
+        :return:
+        """
+        return [self._cols[name] for name in self.names if name in self._cols]
+
+    def pop(self, name):
+        col = self[name]
+        self.names.remove(name)
+        del self._cols[name]
+        self.update_meta()
+        return col
+
+    def __str__(self):
+        return "".join("%s : %s" % (name, str(self[name]))
+                       for name in self.names)
+
+    def __repr__(self):
+        return "".join("%s : %s\n" % (name, repr(self[name]))
+                       for name in self.names)
 
 
 class ctable(bcolz.ctable):
-    def cache_factor(self, col_list, refresh=False):
+    # exact quantiles order the measure values of all groups; above this
+    # many bytes they are spilled to a memory mapped temporary file
+    quantile_spill_bytes = 256 * 2 ** 20
+
+    def __init__(self, *args, **kwargs):
+        super(ctable, self).__init__(*args, **kwargs)
+
+        # the chunks of a table that was (re)written at this rootdir
+        if self.mode == 'w':
+            self.invalidate_caches()
+
+        # dimension attributes that can be used as groupby columns,
+        # see add_lookup
+        self.lookups = {}
+
+    @property
+    def cols(self):
+        "The ctable columns accessor, which opens columns lazily."
+        return self._lazy_cols
+
+    @cols.setter
+    def cols(self, value):
+        # bcolz.ctable sets up its own accessor, it is replaced before any
+        # column is read or added
+        if not isinstance(value, lazy_cols):
+            value = lazy_cols(value.rootdir, value.mode)
+        self._lazy_cols = value
+
+    @property
+    def dtype(self):
+        "The data type of this object (numpy dtype)."
+        return np.dtype([(name, self.cols.dtype(name)) for name in self.names])
+
+    def flush(self):
+        # a flush changes the stamp of the columns (see column_stamp), the
+        # rollups that were current are stamped again
+        current = []
+        if self.rootdir and self.mode != 'r':
+            current = [rollup_name
+                       for rollup_name, rollup in self.rollups().items()
+                       if self.rollup_current(rollup)]
+
+        # columns that were never opened have nothing to flush
+        for col in self.cols.opened():
+            col.flush()
+
+        for rollup_name in current:
+            rollup = self.rollups()[rollup_name]
+            self.save_rollup_meta(rollup_name, rollup, rollup['nr_rows'])
+
+    @stamped
+    def cache_factor(self, col_list, refresh=False, storage='compressed',
+                     cparams=None):
         """
         Existing todos here are: these should be hidden helper carrays
         As in: not normal columns that you would normally see as a user
@@ -21,6 +275,18 @@ class ctable(bcolz.ctable):
 
         :param col_list:
         :param refresh:
+        :param storage: 'compressed' (default) to store the factor and
+         values as compressed carrays, or 'mmap' to store them as flat .npy
+         files that groupby memory maps, so the labels are read through the
+         OS page cache without decompressing them; either one storage for
+         all columns or a {col: storage} dict
+        :param cparams: the compression of compressed caches: None (the
+         bcolz defaults), a bcolz.cparams or a dict of its arguments, or
+         'auto' to pick the codec and shuffle (and the chunklen of the
+         values) from the first chunks, see bquery.compression. The
+         settings are recorded in attrs['cparams'] of the .factor carray.
+         As 'auto' times the decompression of the candidates, the choice
+         can differ between runs and machines
         :return:
         """
 
@@ -30,28 +296,624 @@ class ctable(bcolz.ctable):
 
         for col in col_list:
 
-            col_rootdir = self[col].rootdir
+            col_storage = storage.get(col, 'compressed') \
+                if isinstance(storage, dict) else storage
+            if col_storage not in ('compressed', 'mmap'):
+                raise ValueError("storage should be 'compressed' or 'mmap', "
+                                 "not " + repr(col_storage))
+
+            if col in self.names:
+                col_rootdir = self[col].rootdir
+            else:
+                # a groupby key expression (see groupby), which is
+                # remembered so append can extend its cache
+                col_rootdir = self.key_rootdir(col)
+                key_caches = self.attrs.getall().get('key_caches', {})
+                if key_caches.get(os.path.basename(col_rootdir)) != col:
+                    key_caches[os.path.basename(col_rootdir)] = col
+                    self.attrs['key_caches'] = key_caches
             col_factor_rootdir = col_rootdir + '.factor'
             col_values_rootdir = col_rootdir + '.values'
 
-            # create cache if needed
-            if refresh or not os.path.exists(col_factor_rootdir):
+            # create cache if needed (or when it has another storage)
+            if col_storage == 'mmap':
+                cached = os.path.exists(col_factor_rootdir + '.npy')
+            else:
+                cached = os.path.exists(col_factor_rootdir)
+            if refresh or not cached:
+                # drop decompressed chunks of a previous cache
+                for rootdir in (col_factor_rootdir, col_values_rootdir):
+                    chunk_cache.invalidate(
+                        os.path.split(os.path.normpath(rootdir)))
+
+                # factorize in memory first, the labels are stored in the
+                # narrowest dtype that fits the number of unique values
+                # and chunk-aligned with the column
+                if col in self.names:
+                    labels, values = ctable_ext.factorize(self[col])
+                else:
+                    labels, values = self.factorize_key_expression(col)
+                values = np.array(values.values(),
+                                  dtype=self.groupby_col_dtype(col))
+
+                if col_storage == 'mmap':
+                    self.save_factor_mmap(col_rootdir, labels, values)
+                    continue
+
+                for path in (col_factor_rootdir, col_values_rootdir):
+                    if os.path.exists(path + '.npy'):
+                        os.remove(path + '.npy')
+                factor_cparams, values_cparams, values_chunklen = \
+                    self.factor_cparams(labels, values, cparams)
                 carray_factor = \
-                    bcolz.carray([], dtype='int64', expectedlen=self.size,
-                                   rootdir=col_factor_rootdir, mode='w')
-                _, values = \
-                    ctable_ext.factorize(self[col], labels=carray_factor)
+                    ctable_ext.narrow_labels(labels, len(values),
+                                             chunklen=labels.chunklen,
+                                             cparams=factor_cparams,
+                                             rootdir=col_factor_rootdir,
+                                             mode='w')
                 carray_factor.flush()
+                carray_factor.attrs['cparams'] = cparams_meta(
+                    factor_cparams, labels.chunklen, auto=cparams == 'auto')
                 carray_values = \
-                    bcolz.carray(values.values(), dtype=self[col].dtype,
+                    bcolz.carray(values, cparams=values_cparams,
+                                 chunklen=values_chunklen,
                                  rootdir=col_values_rootdir, mode='w')
                 carray_values.flush()
 
-    def groupby(self, groupby_cols, agg_list, bool_arr=None, rootdir=None):
+    def factor_cparams(self, labels, values, cparams):
+        """
+        Return the compression settings of a compressed factor cache (see
+        cache_factor): the factor and values cparams and the chunklen of
+        the values. With 'auto' they are picked from the first chunks; the
+        factor keeps the chunklen of the labels, so it stays chunk-aligned
+        with the column.
+
+        :param labels: the int64 labels carray
+        :param values: the unique values
+        :param cparams: None, a bcolz.cparams, a dict or 'auto'
+        :return: factor_cparams, values_cparams, values_chunklen
+        """
+        if cparams != 'auto':
+            cparams = to_cparams(cparams)
+            return cparams, cparams, None
+
+        nr_rows = min(len(labels),
+                      max(sample_rows([labels]), labels.chunklen))
+        sample = ctable_ext.read_rows(labels, 0, nr_rows).astype(
+            ctable_ext.label_dtype(len(values)))
+        factor_cparams, _ = choose_cparams([sample],
+                                           chunklen=labels.chunklen)
+        values_cparams, values_chunklen = choose_cparams(
+            [values[:sample_rows([values])]])
+
+        return factor_cparams, values_cparams, values_chunklen
+
+    def save_factor_mmap(self, col_rootdir, labels, values):
+        """
+        Store a factorization as flat <col_rootdir>.factor.npy and
+        .values.npy files (see cache_factor), replacing a compressed cache
+
+        The labels are written chunk by chunk into a temporary file that is
+        renamed over the old one, so running queries keep their mapping.
+
+        :param col_rootdir:
+        :param labels: the int64 labels carray
+        :param values: the unique values
+        :return:
+        """
+        col_factor_path = col_rootdir + '.factor.npy'
+        col_values_path = col_rootdir + '.values.npy'
+
+        factor_dtype = ctable_ext.label_dtype(len(values))
+        tmp_path = col_factor_path + '.tmp'
+        factor = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                           dtype=factor_dtype,
+                                           shape=(len(labels),))
+        for start in xrange(0, len(labels), labels.chunklen):
+            stop = min(start + labels.chunklen, len(labels))
+            factor[start:stop] = ctable_ext.read_rows(labels, start, stop)
+        factor.flush()
+        del factor
+        os.rename(tmp_path, col_factor_path)
+
+        np.save(col_values_path + '.tmp.npy', values)
+        os.rename(col_values_path + '.tmp.npy', col_values_path)
+
+        for rootdir in (col_rootdir + '.factor', col_rootdir + '.values'):
+            if os.path.exists(rootdir):
+                shutil.rmtree(rootdir)
+
+    def invalidate_caches(self):
+        """
+        Drop the cached chunks and where_terms selections of this ctable
+        (see bquery.cache), in memory and on disk, after it was written
+
+        The cache keys carry the write stamp of the columns (see
+        carray_stamp), which only changes when they are flushed, so the
+        writes through this ctable are not seen from the caches even
+        before they are flushed.
+
+        :return:
+        """
+        if self.rootdir:
+            rootdir = os.path.normpath(self.rootdir)
+            chunk_cache.invalidate((rootdir,))
+            filter_cache.invalidate((rootdir,))
+            if os.path.exists(rootdir + '.filters'):
+                shutil.rmtree(rootdir + '.filters')
+
+    def __setitem__(self, key, value):
+        super(ctable, self).__setitem__(key, value)
+        self.invalidate_caches()
+        self.outdate_rollups()
+
+    def resize(self, nitems):
+        super(ctable, self).resize(nitems)
+        self.invalidate_caches()
+        self.refresh_factor_caches()
+
+    def trim(self, nitems):
+        super(ctable, self).trim(nitems)
+        self.invalidate_caches()
+        self.refresh_factor_caches()
+
+    def factor_caches(self):
+        """
+        Return the factor caches of this ctable (see cache_factor) as a list
+        of (column or key expression, cache rootdir, storage)
+
+        :return:
+        """
+        if not self.rootdir:
+            return []
+
+        caches = [(col, self[col].rootdir) for col in self.names]
+        key_caches = self.attrs.getall().get('key_caches', {})
+        caches += [(expression, os.path.join(self.rootdir, name))
+                   for name, expression in sorted(key_caches.items())]
+
+        factor_caches = []
+        for col, col_rootdir in caches:
+            if os.path.exists(col_rootdir + '.factor.npy'):
+                factor_caches.append((col, col_rootdir, 'mmap'))
+            elif os.path.exists(col_rootdir + '.factor'):
+                factor_caches.append((col, col_rootdir, 'compressed'))
+
+        return factor_caches
+
+    def refresh_factor_cache(self, col, col_rootdir, storage):
+        """
+        Factorize a cached column (or key expression) again, keeping the
+        storage and compression settings of its cache
+
+        :param col:
+        :param col_rootdir: the cache rootdir (see factor_caches)
+        :param storage: the storage of the cache (see factor_caches)
+        :return:
+        """
+        cparams = None
+        if storage == 'compressed':
+            factor = bcolz.carray(rootdir=col_rootdir + '.factor', mode='r')
+            meta = factor.attrs.getall().get('cparams')
+            if meta is not None:
+                cparams = dict((name, meta[name]) for name in
+                               ('cname', 'clevel', 'shuffle'))
+            del factor
+        self.cache_factor([col], refresh=True, storage=storage,
+                          cparams=cparams)
+
+    def refresh_factor_caches(self):
+        """
+        Factorize all cached columns again (see cache_factor), after a
+        resize or trim changed the length of the ctable
+
+        :return:
+        """
+        for col, col_rootdir, storage in self.factor_caches():
+            self.refresh_factor_cache(col, col_rootdir, storage)
+
+    def extend_factor_caches(self, old_len):
+        """
+        Extend the factor caches (see cache_factor) with the rows that were
+        appended after old_len: the new rows are labelled with the cached
+        values (and new values get the next labels), so the cached rows
+        are not factorized again. A cache is rebuilt when its labels no
+        longer fit their dtype, or when it did not hold the old_len rows
+        before the append (it was already out of date, e.g. after rows were
+        appended through another handle).
+
+        :param old_len:
+        :return:
+        """
+        for col, col_rootdir, storage in self.factor_caches():
+            col_factor_rootdir = col_rootdir + '.factor'
+            col_values_rootdir = col_rootdir + '.values'
+
+            if storage == 'mmap':
+                factor = np.load(col_factor_rootdir + '.npy', mmap_mode='r')
+                values = np.load(col_values_rootdir + '.npy')
+            else:
+                factor = bcolz.carray(rootdir=col_factor_rootdir, mode='a')
+                values = bcolz.carray(rootdir=col_values_rootdir, mode='a')
+
+            if len(factor) != old_len:
+                del factor, values
+                self.refresh_factor_cache(col, col_rootdir, storage)
+                continue
+
+            if col in self.names:
+                rows = self[col][old_len:]
+            else:
+                rows = np.concatenate(
+                    list(self.key_expression_blocks(
+                        col, ranges=[(old_len, self.len)])))
+
+            labels, new_values = append_labels(values[:], rows)
+            nr_values = len(values) + len(new_values)
+            if ctable_ext.label_dtype(nr_values) != factor.dtype:
+                del factor, values
+                self.refresh_factor_cache(col, col_rootdir, storage)
+                continue
+
+            if storage == 'mmap':
+                del factor
+                self.append_factor_mmap(col_rootdir, labels,
+                                        np.concatenate([values, new_values]))
+            else:
+                factor.append(labels.astype(factor.dtype))
+                factor.flush()
+                values.append(new_values)
+                values.flush()
+
+    def append_factor_mmap(self, col_rootdir, labels, values):
+        """
+        Append labels to a memory mapped factor cache (see
+        save_factor_mmap) and replace its values
+
+        The factor is copied into a temporary file that is renamed over
+        the old one, so running queries keep their mapping.
+
+        :param col_rootdir:
+        :param labels: the labels of the appended rows
+        :param values: all unique values
+        :return:
+        """
+        col_factor_path = col_rootdir + '.factor.npy'
+        col_values_path = col_rootdir + '.values.npy'
+
+        old_factor = np.load(col_factor_path, mmap_mode='r')
+        old_len = len(old_factor)
+        tmp_path = col_factor_path + '.tmp'
+        factor = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                           dtype=old_factor.dtype,
+                                           shape=(old_len + len(labels),))
+        block_len = 2 ** 20
+        for start in xrange(0, old_len, block_len):
+            stop = min(start + block_len, old_len)
+            factor[start:stop] = old_factor[start:stop]
+        factor[old_len:] = labels
+        factor.flush()
+        del factor, old_factor
+        os.rename(tmp_path, col_factor_path)
+
+        np.save(col_values_path + '.tmp.npy', values)
+        os.rename(col_values_path + '.tmp.npy', col_values_path)
+
+    def append(self, cols):
+        """
+        Append cols to the ctable (see bcolz.ctable.append)
+
+        The factor caches (see cache_factor) are extended with the new
+        rows, and any rollups defined on the ctable are updated with the
+        aggregated new rows, without recomputing them from the full table.
+        Rollups that were already out of date (see find_rollup) are
+        created again from the full table instead.
+
+        :param cols:
+        :return:
+        """
+        old_len = self.len
+        # whether every rollup is current, before the append changes the
+        # stamp of its columns
+        current = dict((rollup_name, self.rollup_current(rollup))
+                       for rollup_name, rollup in self.rollups().items())
+        super(ctable, self).append(cols)
+        self.invalidate_caches()
+
+        if self.len > old_len:
+            self.extend_factor_caches(old_len)
+            for rollup_name, rollup in self.rollups().items():
+                if current[rollup_name]:
+                    self.update_rollup(rollup_name, old_len)
+                else:
+                    self.create_rollup(
+                        str(rollup_name),
+                        [str(col) for col in rollup['groupby_cols']],
+                        [[str(x) for x in measure]
+                         for measure in rollup['measures']])
+
+    # rollup functions
+    def rollups(self):
+        """
+        Return the rollup definitions of this ctable as a dict:
+        {rollup_name: {'groupby_cols': [...], 'measures': [[out, in, op]],
+                       'nr_rows': ..., 'source_len': ...,
+                       'source_stamp': ...}}
+
+        :return:
+        """
+        return self.attrs.getall().get('rollups', {})
+
+    def rollup_rootdir(self, rollup_name):
+        return os.path.normpath(self.rootdir) + '.rollup.' + rollup_name
+
+    def create_rollup(self, rollup_name, groupby_cols, agg_list):
+        """
+        Create a persisted rollup (pre-aggregated groupby) next to the
+        ctable rootdir
+
+        Later groupby calls whose groupby_cols and measures are covered by
+        the rollup are answered from the rollup instead of the base table,
+        and rows appended to the ctable are merged into the rollup. The
+        rollup records the length and version stamp (see column_stamp) of
+        the columns it aggregates; after any other write to them (through
+        the ctable, or to a column carray once it is flushed) it is no
+        longer used, until it is created again (by create_rollup or the
+        next append).
+
+        :param rollup_name: the name of the rollup
+        :param groupby_cols: the columns to groupby over (see groupby)
+        :param agg_list: the aggregation operations (see groupby), only
+         sum and sum_na can be rolled up
+        :return: the rollup ctable
+        """
+
+        if not self.rootdir:
+            raise TypeError('Only out-of-core ctables can have '
+                            'rollups at the moment')
+
+        measures = [list(agg) for agg in self.parse_agg_list(agg_list)]
+        if any(isinstance(agg_op, tuple) for _, _, agg_op in measures):
+            raise NotImplementedError('Quantiles cannot be rolled up')
+        # lookups are not stored with the ctable, so appends could not
+        # update the rollup
+        if any(col in self.lookups for col in groupby_cols):
+            raise NotImplementedError('Lookup columns cannot be rolled up')
+
+        ct_rollup = self.groupby(
+            groupby_cols, measures,
+            rootdir=self.new_rollup_rootdir(rollup_name), use_rollups=False)
+        ct_rollup.flush()
+        ct_rollup = self.replace_rollup(rollup_name)
+
+        self.save_rollup_meta(rollup_name, {
+            'groupby_cols': list(groupby_cols),
+            'measures': measures
+        }, len(ct_rollup))
+
+        return ct_rollup
+
+    def rollup_input_cols(self, rollup):
+        """
+        Return the columns that a rollup aggregates (see create_rollup)
+
+        :param rollup: a rollup definition (see rollups)
+        :return:
+        """
+        input_cols = []
+        for col in list(rollup['groupby_cols']) + \
+                [measure[1] for measure in rollup['measures']]:
+            for input_col in self.measure_cols(str(col)):
+                if input_col not in input_cols:
+                    input_cols.append(input_col)
+        return input_cols
+
+    def rollup_current(self, rollup):
+        """
+        Return whether a rollup was aggregated from the current version of
+        its columns (see save_rollup_meta)
+
+        :param rollup: a rollup definition (see rollups)
+        :return:
+        """
+        return rollup.get('source_len') == self.len and \
+            rollup.get('source_stamp') == \
+            self.column_stamp(self.rollup_input_cols(rollup))
+
+    def new_rollup_rootdir(self, rollup_name):
+        """
+        Return an empty temporary rootdir to write a new version of a rollup
+        to, which replace_rollup renames into place
+
+        :param rollup_name:
+        :return:
+        """
+        rollup_rootdir = self.rollup_rootdir(rollup_name)
+        for rootdir in (rollup_rootdir + '.tmp', rollup_rootdir + '.old'):
+            if os.path.exists(rootdir):
+                shutil.rmtree(rootdir)
+        return rollup_rootdir + '.tmp'
+
+    def replace_rollup(self, rollup_name):
+        """
+        Rename the rollup written to new_rollup_rootdir into place
+
+        The new version is only renamed into place once it is complete, so
+        a failure leaves the old rollup (which is then out of date, see
+        find_rollup) as it was.
+
+        :param rollup_name:
+        :return: the rollup ctable
+        """
+        rollup_rootdir = self.rollup_rootdir(rollup_name)
+        if os.path.exists(rollup_rootdir):
+            os.rename(rollup_rootdir, rollup_rootdir + '.old')
+        os.rename(rollup_rootdir + '.tmp', rollup_rootdir)
+        if os.path.exists(rollup_rootdir + '.old'):
+            shutil.rmtree(rollup_rootdir + '.old')
+        chunk_cache.invalidate((rollup_rootdir,))
+
+        return ctable(rootdir=rollup_rootdir, mode='r')
+
+    def save_rollup_meta(self, rollup_name, rollup, nr_rows):
+        """
+        Store a rollup definition with the length of the rollup and the
+        length and version stamp of the columns it was aggregated from
+
+        :param rollup_name:
+        :param rollup: the groupby_cols and measures of the rollup
+        :param nr_rows: the number of rows of the rollup
+        :return:
+        """
+        rollup = dict(rollup)
+        rollup['nr_rows'] = nr_rows
+        rollup['source_len'] = self.len
+        rollup['source_stamp'] = \
+            self.column_stamp(self.rollup_input_cols(rollup))
+
+        rollups = self.rollups()
+        rollups[rollup_name] = rollup
+        self.attrs['rollups'] = rollups
+
+    def outdate_rollups(self):
+        """
+        Mark the rollups as out of date (see find_rollup), after a write to
+        the rows of the ctable that may change their totals
+
+        :return:
+        """
+        rollups = self.rollups()
+        if rollups:
+            for rollup in rollups.values():
+                rollup['source_stamp'] = None
+            self.attrs['rollups'] = rollups
+
+    def drop_rollup(self, rollup_name):
+        rollups = self.rollups()
+        del rollups[rollup_name]
+        self.attrs['rollups'] = rollups
+
+        shutil.rmtree(self.rollup_rootdir(rollup_name))
+        chunk_cache.invalidate((self.rollup_rootdir(rollup_name),))
+
+    def update_rollup(self, rollup_name, start):
+        """
+        Merge the rows from start onwards into the rollup
+
+        :param rollup_name:
+        :param start: the first row that is not yet part of the rollup
+        :return:
+        """
+        rollup = self.rollups()[rollup_name]
+        groupby_cols = [str(col) for col in rollup['groupby_cols']]
+        measures = [[str(x) for x in measure]
+                    for measure in rollup['measures']]
+
+        # aggregate the new rows only
+        input_cols = self.rollup_input_cols(rollup)
+        ct_new = ctable([self.cols[col][start:] for col in input_cols],
+                        names=input_cols)
+        ct_delta = ct_new.groupby(groupby_cols, measures)
+
+        # merge the new aggregates into the rollup, in which key
+        # expressions are stored under their output name
+        rollup_rootdir = self.rollup_rootdir(rollup_name)
+        ct_rollup = ctable(rootdir=rollup_rootdir, mode='r')
+        ct_merge = ctable(np.concatenate([ct_rollup[:], ct_delta[:]]))
+
+        # the merged rollup is written next to the old one and renamed into
+        # place (see replace_rollup)
+        ct_rollup = ct_merge.groupby(
+            [self.key_name(col) for col in groupby_cols],
+            [[measure[0], measure[0], 'sum'] for measure in measures],
+            rootdir=self.new_rollup_rootdir(rollup_name))
+        ct_rollup.flush()
+        ct_rollup = self.replace_rollup(rollup_name)
+
+        self.save_rollup_meta(rollup_name, rollup, len(ct_rollup))
+
+    def find_rollup(self, groupby_cols, agg_list):
+        """
+        Return the name of the smallest rollup that covers the groupby
+        columns and measures, or None when there is no such rollup; rollups
+        of an older version of the ctable (see create_rollup) are skipped
+
+        :param groupby_cols:
+        :param agg_list:
+        :return:
+        """
+        if not self.rootdir:
+            return None
+
+        found_name = None
+        found_len = None
+
+        for rollup_name, rollup in self.rollups().items():
+            if not set(groupby_cols) <= set(rollup['groupby_cols']):
+                continue
+
+            rollup_measures = \
+                set((measure[1], measure[2]) for measure in rollup['measures'])
+            if any((input_col, agg_op) not in rollup_measures
+                   for _, input_col, agg_op in self.parse_agg_list(agg_list)):
+                continue
+
+            if found_name is not None and rollup['nr_rows'] >= found_len:
+                continue
+            if not self.rollup_current(rollup):
+                continue
+
+            found_name = str(rollup_name)
+            found_len = rollup['nr_rows']
+
+        return found_name
+
+    def groupby_rollup(self, rollup_name, groupby_cols, agg_list,
+                       rootdir=None, output='ctable', cparams=None):
+        """
+        Answer a groupby from a rollup that covers it (see find_rollup)
+
+        :param rollup_name:
+        :param groupby_cols:
+        :param agg_list:
+        :param rootdir: the aggregation ctable rootdir
+        :param output: the kind of result (see groupby)
+        :param cparams: the compression of a ctable result (see groupby)
+        :return:
+        """
+        rollup_cols = {}
+        for output_col, input_col, agg_op in \
+                self.rollups()[rollup_name]['measures']:
+            rollup_cols[(input_col, agg_op)] = str(output_col)
+
+        # the rollup holds partial sums, so the measures sum up again
+        rollup_agg_list = \
+            [[output_col, rollup_cols[(input_col, agg_op)], 'sum']
+             for output_col, input_col, agg_op
+             in self.parse_agg_list(agg_list)]
+
+        ct_rollup = ctable(rootdir=self.rollup_rootdir(rollup_name), mode='r')
+
+        # key expressions are stored under their output name in the rollup
+        return ct_rollup.groupby([self.key_name(col) for col in groupby_cols],
+                                 rollup_agg_list, rootdir=rootdir,
+                                 output=output, cparams=cparams)
+
+    @stamped
+    def groupby(self, groupby_cols, agg_list, bool_arr=None, rootdir=None,
+                use_rollups=True, output='ctable', start=None, stop=None,
+                ranges=None, cparams=None, bool_arr_rows='all'):
         """
         Aggregate the ctable
 
-        groupby_cols: a list of columns to groupby over
+        groupby_cols: a list of columns to groupby over, which can also be
+         lookup columns (see add_lookup) or key expressions over columns,
+         like 'bin(price, [0, 10, 100])', 'floor(ts / 86400)',
+         'trunc_month(ts)' or 'id % 64' (see key_functions). Key
+         expressions are evaluated and factorized chunk by chunk and can
+         be cached with cache_factor like columns. Their output column
+         is named by key_name, i.e. 'trunc_month(ts)' becomes
+         'trunc_month_ts'.
         agg_list: the aggregation operations, which can be:
          - a straight forward sum of a list columns with a
            similarly named output: ['m1', 'm2', ...]
@@ -59,43 +921,651 @@ class ctable(bcolz.ctable):
            [['mnew1', 'm1'], ['mnew2', 'm2], ...]
          - a list that includes the type of aggregation for each column, i.e.
            [['mnew1', 'm1', 'sum'], ['mnew2', 'm1, 'avg'], ...]
+         - the input can also be a numexpr expression over columns, i.e.
+           [['margin', 'revenue - cost', 'sum'], ...], which is evaluated
+           chunk by chunk during the aggregation
 
         Currently supported aggregation operations are:
         - sum
         - sum_na (that checks for nan values and excludes them)
+        - median, quantile and percentile, i.e.
+          [['p95', 'latency', 'quantile', 0.95],
+           ['p99', 'latency', 'percentile', 99]]; exact quantiles order the
+          values per group with a counting sort over the factor (spilling
+          to disk above quantile_spill_bytes)
+        - approx_median, approx_quantile and approx_percentile, which use
+          a mergeable sketch with a 1% relative error (see
+          bquery.sketch.QuantileSketch)
         - To be added: mean, mean_na (and perhaps standard deviation etc)
 
         boolarr: to be added (filtering the groupby factorization input)
         rootdir: the aggregation ctable rootdir
+        use_rollups: answer the groupby from a covering rollup (see
+         create_rollup) when one exists
+        output: 'ctable' (default) for a compressed bcolz ctable, or
+         'numpy' / 'pandas' to get the aggregated buffers directly as a
+         structured array or DataFrame, without compressing them
+        start, stop: only aggregate the rows start:stop
+        ranges: only aggregate the rows in a list of (start, stop) ranges
+         (see row_ranges). Only the chunks that overlap the rows are read,
+         and cached factors (see cache_factor) are sliced to the rows
+        cparams: the compression of a ctable output: None (the bcolz
+         defaults), a bcolz.cparams or a dict of its arguments, or 'auto'
+         to pick the codec, shuffle and chunklen from the aggregated
+         columns (see bquery.compression), which are then recorded in
+         attrs['cparams']. As the decompression of the candidates is
+         timed, the choice can differ between runs and machines
+        bool_arr_rows: the rows bool_arr has a value for: 'all' (default)
+         for all rows of the ctable, or 'ranges' for only the aggregated
+         rows of start/stop or ranges (e.g. a where_terms with the same
+         ranges)
 
         """
 
         if not agg_list:
             raise AttributeError('One or more aggregation operations '
                                  'need to be defined')
+        self.check_output(output, rootdir)
+        self.check_output_names(groupby_cols, agg_list)
 
-        factor_list, values_list = self.factorize_groupby_cols(groupby_cols)
+        ranges = self.row_ranges(start, stop, ranges)
+        if ranges is None:
+            ct_input = self
+        else:
+            ct_input = ctable_rows(self, ranges)
+
+        bool_arr = self.range_bool_arr(bool_arr, bool_arr_rows, ranges)
+
+        # answer from a covering rollup if one is available
+        if use_rollups and bool_arr is None and ranges is None:
+            rollup_name = self.find_rollup(groupby_cols, agg_list)
+            if rollup_name is not None:
+                return self.groupby_rollup(rollup_name, groupby_cols,
+                                           agg_list, rootdir=rootdir,
+                                           output=output, cparams=cparams)
+
+        factor_list, values_list = \
+            self.factorize_groupby_cols(groupby_cols, ranges=ranges)
 
         factor_carray, nr_groups, skip_key = \
             self.make_group_index(factor_list, values_list, groupby_cols,
-                                  len(self), bool_arr)
+                                  len(ct_input), bool_arr)
 
         ct_agg, dtype_list, agg_ops = \
-            self.create_agg_ctable(groupby_cols, agg_list, nr_groups, rootdir)
+            self.create_agg_ctable(groupby_cols, agg_list, nr_groups, rootdir,
+                                   output=output, cparams=cparams)
 
         # perform aggregation
-        ctable_ext.aggregate_groups_by_iter_2(self, ct_agg, nr_groups, skip_key,
-                                              factor_carray, groupby_cols,
-                                              agg_ops, dtype_list)
+        groupby_values = [(col_factor_carray, col_values_carray[:])
+                          for col_factor_carray, col_values_carray
+                          in zip(factor_list, values_list)]
+        total = ctable_ext.aggregate_groups_by_iter_2(
+            ct_input, ct_agg, nr_groups, skip_key, factor_carray, groupby_values,
+            agg_ops, dtype_list, self.quantile_spill_bytes)
+
+        return self.agg_output(ct_agg, dtype_list, total, output,
+                               rootdir=rootdir, cparams=cparams)
+
+    @stamped
+    def groupby_many(self, specs):
+        """
+        Perform several groupby operations over one shared scan of the
+        ctable; the measure columns are decompressed once for all of them
+
+        Every spec is a (groupby_cols, agg_list) pair or a dict with the
+        keyword arguments of groupby (groupby_cols, agg_list, bool_arr,
+        rootdir, use_rollups, output, cparams, start, stop, ranges,
+        bool_arr_rows).
+        Groupby columns that occur in several specs are factorized once.
+        Specs with a row selection (start, stop or ranges) are not part of
+        the shared scan; they are aggregated with groupby.
+
+        :param specs: a list of groupby specifications
+        :return: a list with the result of every spec (see groupby)
+        """
+        spec_keys = ('groupby_cols', 'agg_list', 'bool_arr', 'rootdir',
+                     'use_rollups', 'output', 'cparams', 'start', 'stop',
+                     'ranges', 'bool_arr_rows')
+        for spec in specs:
+            if not isinstance(spec, dict) and len(spec) != 2:
+                raise ValueError('A groupby spec should be a (groupby_cols, '
+                                 'agg_list) pair or a dict, not ' +
+                                 repr(spec))
+        specs = [dict(spec) if isinstance(spec, dict)
+                 else dict(zip(['groupby_cols', 'agg_list'], spec))
+                 for spec in specs]
+
+        results = [None] * len(specs)
+        scan_specs = []
+        for i, spec in enumerate(specs):
+            unknown_keys = set(spec) - set(spec_keys)
+            if unknown_keys:
+                raise ValueError('Unknown groupby spec keys: ' +
+                                 ', '.join(sorted(unknown_keys)))
+            if not spec['agg_list']:
+                raise AttributeError('One or more aggregation operations '
+                                     'need to be defined')
+            if any(spec.get(key) is not None
+                   for key in ('start', 'stop', 'ranges')):
+                results[i] = self.groupby(**spec)
+                continue
+            spec['bool_arr'] = self.range_bool_arr(
+                spec.get('bool_arr'), spec.get('bool_arr_rows', 'all'), None)
+            spec.setdefault('rootdir', None)
+            spec.setdefault('output', 'ctable')
+            spec.setdefault('cparams', None)
+            self.check_output(spec['output'], spec['rootdir'])
+            self.check_output_names(spec['groupby_cols'], spec['agg_list'])
+            # specs covered by a rollup are answered from the rollup
+            rollup_name = None
+            if spec.get('use_rollups', True) and spec['bool_arr'] is None:
+                rollup_name = \
+                    self.find_rollup(spec['groupby_cols'], spec['agg_list'])
+            if rollup_name is not None:
+                results[i] = self.groupby_rollup(
+                    rollup_name, spec['groupby_cols'], spec['agg_list'],
+                    rootdir=spec['rootdir'], output=spec['output'],
+                    cparams=spec['cparams'])
+            else:
+                scan_specs.append(i)
+
+        if not scan_specs:
+            return results
+
+        # factorize every groupby column once
+        groupby_cols = []
+        for i in scan_specs:
+            for col in specs[i]['groupby_cols']:
+                if col not in groupby_cols:
+                    groupby_cols.append(col)
+        factors = dict(zip(groupby_cols,
+                           zip(*self.factorize_groupby_cols(groupby_cols))))
+
+        queries = []
+        for i in scan_specs:
+            spec = specs[i]
+            factor_list = [factors[col][0] for col in spec['groupby_cols']]
+            values_list = [factors[col][1] for col in spec['groupby_cols']]
+
+            factor_carray, nr_groups, skip_key = \
+                self.make_group_index(factor_list, values_list,
+                                      spec['groupby_cols'], len(self),
+                                      spec['bool_arr'])
+
+            ct_agg, dtype_list, agg_ops = \
+                self.create_agg_ctable(spec['groupby_cols'], spec['agg_list'],
+                                       nr_groups, spec['rootdir'],
+                                       output=spec['output'],
+                                       cparams=spec['cparams'])
+            results[i] = (ct_agg, dtype_list)
+
+            groupby_values = [(col_factor_carray, col_values_carray[:])
+                              for col_factor_carray, col_values_carray
+                              in zip(factor_list, values_list)]
+            queries.append((ct_agg, nr_groups, skip_key, factor_carray,
+                            groupby_values, agg_ops))
+
+        totals = ctable_ext.aggregate_groups_many(self, queries,
+                                                  self.quantile_spill_bytes)
+
+        for i, total in zip(scan_specs, totals):
+            ct_agg, dtype_list = results[i]
+            results[i] = \
+                self.agg_output(ct_agg, dtype_list, total, specs[i]['output'],
+                                rootdir=specs[i]['rootdir'],
+                                cparams=specs[i]['cparams'])
+
+        return results
+
+    @stamped
+    def transform(self, groupby_cols, agg_list, bool_arr=None, rootdir=None):
+        """
+        Broadcast group aggregates back to the rows: return a ctable as long
+        as this ctable, with for every row the aggregates of its group
+
+        The groups are aggregated as in groupby, after which the output is
+        written chunk by chunk by gathering the aggregates through the
+        factor carray of the rows, so the memory use stays at the number
+        of groups plus one chunk.
+
+        :param groupby_cols: the columns to groupby over (see groupby)
+        :param agg_list: the aggregation operations (see groupby); every
+         output column of the agg_list becomes a column of the result
+        :param bool_arr: a boolean array (see where_terms) of the rows that
+         are aggregated; the other rows get 0 (or nan for float columns)
+        :param rootdir: the rootdir of the result ctable
+        :return: a ctable with the aggregates per row
+        """
+        if not agg_list:
+            raise AttributeError('One or more aggregation operations '
+                                 'need to be defined')
+
+        factor_list, values_list = self.factorize_groupby_cols(groupby_cols)
+
+        factor_carray, nr_groups, skip_key = \
+            self.make_group_index(factor_list, values_list, groupby_cols,
+                                  len(self), bool_arr)
+
+        _, dtype_list, agg_ops = \
+            self.create_agg_ctable(groupby_cols, agg_list, nr_groups, None,
+                                   output='numpy')
+
+        # aggregate all groups, including the group of the skipped rows
+        total = ctable_ext.aggregate_groups_by_iter_2(
+            self, None, nr_groups, nr_groups, factor_carray, [],
+            agg_ops, dtype_list, self.quantile_spill_bytes)
+        agg_dtype_list = dtype_list[len(groupby_cols):]
+        for (_, col_dtype), values in zip(agg_dtype_list, total):
+            if skip_key < nr_groups:
+                values[skip_key] = np.nan if col_dtype.kind == 'f' else 0
+
+        ct_transform = bcolz.ctable(
+            np.zeros(0, agg_dtype_list),
+            expectedlen=len(self),
+            rootdir=rootdir)
+
+        # gather the aggregates of the rows chunk by chunk
+        block_len = ctable_ext.source_chunklen(factor_carray)
+        for start in xrange(0, len(self), block_len):
+            check_cancelled()
+            stop = min(start + block_len, len(self))
+            factor_rows = ctable_ext.read_rows(factor_carray, start, stop)
+            ct_transform.append([values[factor_rows] for values in total])
+
+        return ct_transform
+
+    @stamped
+    def pivot(self, row_col, col_col, measure, op='sum', bool_arr=None,
+              output='numpy', rootdir=None):
+        """
+        Aggregate a measure into a dense cross table of the values of
+        row_col by the values of col_col, in one chunked pass
+
+        Both columns are factorized as groupby columns (using their factor
+        caches if any), and every row is summed straight into its cell of
+        a dense array; the rows and columns are sorted by value.
+
+        :param row_col: the column (or key expression) of the rows
+        :param col_col: the column (or key expression) of the columns
+        :param measure: the column or expression to aggregate
+        :param op: 'sum' or 'sum_na' (which skips nan values)
+        :param bool_arr: a boolean array of the rows to aggregate
+        :param output: 'numpy' for a pivot_result of the 2-D array with
+         the row and column values, or 'ctable' for a wide ctable with
+         the row values and a column per value of col_col, named
+         <col_col>_<value> (see key_name); values that give the same name,
+         like -1 and 1, get their position as an extra suffix
+        :param rootdir: the rootdir of the ctable output
+        :return:
+        """
+        if op not in ('sum', 'sum_na'):
+            raise NotImplementedError(
+                'Unknown Aggregation Type: ' + unicode(op))
+        if output not in ('numpy', 'ctable'):
+            raise ValueError("output should be 'numpy' or 'ctable', not " +
+                             repr(output))
+
+        factor_list, values_list = \
+            self.factorize_groupby_cols([row_col, col_col])
+        row_values = values_list[0][:]
+        col_values = values_list[1][:]
+
+        values = ctable_ext.pivot_values(
+            self, measure, factor_list[0], factor_list[1],
+            len(row_values), len(col_values), bool_arr,
+            skip_nan=(op == 'sum_na'))
+
+        row_order = np.argsort(row_values, kind='mergesort')
+        col_order = np.argsort(col_values, kind='mergesort')
+        result = pivot_result(values[row_order][:, col_order],
+                              row_values[row_order], col_values[col_order])
+
+        if output == 'numpy':
+            return result
+
+        names = [self.key_name(row_col)]
+        for i, value in enumerate(result.col_values):
+            name = self.key_name('%s_%s' % (self.key_name(col_col), value))
+            while name in names:
+                name = '%s_%d' % (name, i)
+            names.append(name)
+        return bcolz.ctable([result.row_values] + list(result.values.T),
+                            names=names, rootdir=rootdir)
+
+
+    # lookup (dimension join) functions
+    def add_lookup(self, key_col, dim_ct, dim_key_col, attr_cols,
+                   missing=None):
+        """
+        Make attributes of a dimension ctable available as groupby columns
+
+        The rows of this (fact) ctable are joined to the dimension on
+        key_col == dim_key_col when the attributes are factorized, without
+        materialising a joined ctable. Keys without a dimension row form a
+        group of their own, with the missing value as attribute.
+
+        Lookups only exist on this ctable object, they are not stored with
+        the ctable (and cannot be used in rollups).
+
+        :param key_col: the key column in this ctable
+        :param dim_ct: the dimension ctable
+        :param dim_key_col: the key column in the dimension ctable
+        :param attr_cols: the dimension columns to make available
+        :param missing: the attribute value of keys without a dimension
+         row; by default the default value of the attribute dtype (0 or
+         ''), which should then not be a value of the attribute. An
+         explicit missing value that is an attribute value joins its group.
+        :return:
+        """
+        for col in attr_cols:
+            if col in self.names:
+                raise ValueError(
+                    'Lookup column ' + col + ' already is a column')
+            self.lookups[col] = (key_col, dim_ct, dim_key_col, missing)
+
+    def factorize_lookup(self, col, ranges=None):
+        """
+        Return the factor and values carrays of a lookup column (see
+        add_lookup), for the rows in ranges (see row_ranges) when given
+
+        The distinct keys of the fact key column are matched with a khash
+        table on the dimension keys. When the key column is factorized with
+        cache_factor only its .values carray (so O(distinct keys)) is
+        matched, after which the cached labels are mapped to the attribute
+        labels chunk by chunk.
+
+        :param col:
+        :return:
+        """
+        key_col, dim_ct, dim_key_col, missing_value = self.lookups[col]
+        dim_keys = dim_ct[dim_key_col]
+        dim_len = len(dim_keys)
+
+        factor_list, values_list = \
+            self.factorize_groupby_cols([key_col], ranges=ranges)
+        key_factor = factor_list[0]
+        key_values = values_list[0][:]
+
+        # factorize the dimension keys together with the distinct fact keys
+        # so both sides get their labels from the same khash table
+        key_dtype = np.promote_types(dim_keys.dtype, key_values.dtype)
+        ca_keys = bcolz.carray([], dtype=key_dtype,
+                               expectedlen=dim_len + len(key_values))
+        for start in xrange(0, dim_len, dim_keys.chunklen):
+            check_cancelled()
+            stop = min(start + dim_keys.chunklen, dim_len)
+            ca_keys.append(ctable_ext.read_rows(dim_keys, start, stop))
+        ca_keys.append(key_values.astype(key_dtype))
+        labels, reverse = ctable_ext.factorize(ca_keys)
+        labels = labels[:]
+
+        # the (first) dimension row of every key label
+        label_dim_rows = np.empty(len(reverse), dtype='int64')
+        label_dim_rows.fill(-1)
+        if dim_len > 0:
+            label_dim_rows[labels[dim_len - 1::-1]] = \
+                np.arange(dim_len - 1, -1, -1)
+        key_dim_rows = label_dim_rows[labels[dim_len:]]
+
+        # map the fact key labels to attribute labels
+        attr_factor, attr_reverse = ctable_ext.factorize(dim_ct[col])
+        attr_values = [attr_reverse[i] for i in xrange(len(attr_reverse))]
+        key_attr_labels = attr_factor[:][key_dim_rows]
+        missing = key_dim_rows < 0
+        if missing.any():
+            attr_dtype = dim_ct[col].dtype
+            if missing_value is None:
+                value = np.zeros(1, dtype=attr_dtype)[0]
+                if value in attr_values:
+                    raise ValueError(
+                        'Keys without a dimension row would get the value ' +
+                        repr(value) + ' of lookup column ' + col + ', which '
+                        'is an attribute value too; pass a missing value '
+                        'to add_lookup')
+            else:
+                value = np.array([missing_value], dtype=attr_dtype)[0]
+            if value in attr_values:
+                key_attr_labels[missing] = attr_values.index(value)
+            else:
+                key_attr_labels[missing] = len(attr_values)
+                attr_values.append(value)
+
+        col_values_carray = bcolz.carray(attr_values, dtype=dim_ct[col].dtype)
+        block_len = ctable_ext.source_chunklen(key_factor)
+        nr_rows = len(key_factor)
+        col_factor_carray = bcolz.carray(
+            [], dtype=ctable_ext.label_dtype(len(attr_values)),
+            expectedlen=nr_rows, chunklen=block_len)
+        for start in xrange(0, nr_rows, block_len):
+            check_cancelled()
+            stop = min(start + block_len, nr_rows)
+            col_factor_carray.append(key_attr_labels[
+                ctable_ext.read_rows(key_factor, start, stop)])
+
+        return col_factor_carray, col_values_carray
+
+    # groupby key expression functions
+    def key_name(self, col):
+        """
+        Return the output column name of a groupby column; key expressions
+        are named after their identifiers, e.g. 'f0 % 3' becomes 'f0_3'; a
+        groupby whose output names clash is refused (see check_output_names)
 
-        return ct_agg
+        :param col:
+        :return:
+        """
+        if re.match(r'^[A-Za-z_]\w*$', col):
+            return col
+        return re.sub(r'\W+', '_', col).strip('_')
+
+    def key_rootdir(self, expression):
+        """
+        Return the rootdir (without .factor/.values) under which the
+        factorization of a groupby key expression is cached
+
+        :param expression:
+        :return:
+        """
+        digest = hashlib.md5(expression).hexdigest()[:8]
+        return os.path.join(self.rootdir,
+                            '__key_' + self.key_name(expression) + '_' +
+                            digest)
+
+    def key_expression_blocks(self, expression, ranges=None):
+        """
+        Generate the values of a groupby key expression block by block,
+        each block being evaluated on the decompressed chunks of the
+        columns it uses
+
+        :param expression:
+        :param ranges: only the rows in these ranges (see row_ranges)
+        :return:
+        """
+        key_dtype = self.groupby_col_dtype(expression)
+        key_cols = self.measure_cols(expression)
+        code = self.compile_key_expression(expression)
+        ct_input = self if ranges is None else ctable_rows(self, ranges)
+        block_len = min([ct_input[col].chunklen for col in key_cols])
+        nr_rows = len(ct_input)
+
+        for start in xrange(0, nr_rows, block_len):
+            check_cancelled()
+            stop = min(start + block_len, nr_rows)
+            local_dict = {}
+            for col in key_cols:
+                local_dict[col] = \
+                    ctable_ext.read_rows(ct_input[col], start, stop)
+            block = eval(code, key_globals(), local_dict)
+            yield np.ascontiguousarray(block, dtype=key_dtype)
+
+    def factorize_key_expression(self, expression, ranges=None):
+        """
+        Factorize a groupby key expression on the fly (see groupby)
+
+        :param expression:
+        :param ranges: only the rows in these ranges (see row_ranges)
+        :return: labels, reverse (as ctable_ext.factorize)
+        """
+        block_len = min([self[col].chunklen
+                         for col in self.measure_cols(expression)])
+        nr_rows = len(self) if ranges is None \
+            else len(ctable_rows(self, ranges))
+        labels = bcolz.carray([], dtype='int64', expectedlen=nr_rows,
+                              chunklen=block_len)
+
+        return ctable_ext.factorize_blocks(
+            self.key_expression_blocks(expression, ranges=ranges),
+            self.groupby_col_dtype(expression), labels)
+
+    def compile_key_expression(self, expression):
+        """
+        Compile a groupby key expression, which may only use literals,
+        columns, arithmetic, comparisons and calls of key_functions; it is
+        evaluated without builtins, so it cannot run arbitrary code
+
+        :param expression:
+        :return: the code object :raise ValueError:
+        """
+        try:
+            tree = ast.parse(expression, mode='eval')
+        except SyntaxError:
+            raise ValueError('Invalid groupby key expression: ' + expression)
+
+        for node in ast.walk(tree):
+            if not isinstance(node, key_expression_nodes):
+                raise ValueError('Unsupported syntax in groupby key '
+                                 'expression: ' + expression)
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or \
+                        node.func.id not in key_functions or \
+                        node.keywords or node.starargs or node.kwargs:
+                    raise ValueError('Only the key functions ' +
+                                     ', '.join(sorted(key_functions)) +
+                                     ' can be called in a groupby key '
+                                     'expression: ' + expression)
+            elif isinstance(node, ast.Name) and \
+                    node.id not in self.names and \
+                    node.id not in key_functions and \
+                    node.id not in ('True', 'False'):
+                raise ValueError('Unknown name ' + node.id + ' in groupby '
+                                 'key expression: ' + expression)
+
+        return compile(tree, '<key expression>', 'eval')
+
+    def groupby_col_dtype(self, col):
+        """
+        Return the dtype of a groupby column, lookup column (see add_lookup)
+        or groupby key expression
 
+        :param col:
+        :return:
+        """
+        if col in self.names:
+            return self[col].dtype
+        elif col in self.lookups:
+            _, dim_ct, _, _ = self.lookups[col]
+            return dim_ct[col].dtype
+
+        # evaluate the key expression on one row
+        local_dict = {}
+        for measure_col in self.measure_cols(col):
+            local_dict[measure_col] = np.ones(1, dtype=self[measure_col].dtype)
+        key_dtype = np.asarray(eval(self.compile_key_expression(col),
+                                    key_globals(), local_dict)).dtype
+
+        # the factorization supports int32, int64, float64 and strings
+        if key_dtype.kind in 'biu' and key_dtype != np.int32:
+            key_dtype = np.dtype('int64')
+        elif key_dtype.kind == 'f':
+            key_dtype = np.dtype('float64')
+
+        return key_dtype
 
     # groupby helper functions
-    def factorize_groupby_cols(self, groupby_cols):
+    def row_ranges(self, start=None, stop=None, ranges=None):
+        """
+        Normalise the row selection of a groupby or where_terms: either
+        start:stop or a list of (start, stop) ranges, which are read in the
+        given order. Negative and out of bound rows are handled like
+        slices; empty ranges are dropped.
+
+        :param start:
+        :param stop:
+        :param ranges: a list of (start, stop) tuples
+        :return: a list of (start, stop) tuples, or None for all rows
+        """
+        if ranges is None:
+            if start is None and stop is None:
+                return None
+            ranges = [(start, stop)]
+        elif start is not None or stop is not None:
+            raise ValueError('Use either start/stop or ranges')
+
+        row_ranges = []
+        for range_start, range_stop in ranges:
+            range_start, range_stop, _ = \
+                slice(range_start, range_stop).indices(len(self))
+            if range_stop > range_start:
+                row_ranges.append((range_start, range_stop))
+
+        return row_ranges
+
+    def range_bool_arr(self, bool_arr, bool_arr_rows, ranges):
+        """
+        Return the values of a groupby bool_arr for the aggregated rows
+
+        :param bool_arr: a boolean array or None
+        :param bool_arr_rows: 'all' when bool_arr has a value for every row
+         of the ctable, 'ranges' when it only has them for the rows in
+         ranges
+        :param ranges: the normalised row ranges (see row_ranges)
+        :return: :raise ValueError: when bool_arr has another length
+        """
+        if bool_arr_rows not in ('all', 'ranges'):
+            raise ValueError("bool_arr_rows should be 'all' or 'ranges', "
+                             "not " + repr(bool_arr_rows))
+        if bool_arr is None:
+            return None
+
+        if bool_arr_rows == 'all' or ranges is None:
+            nr_rows = len(self)
+        else:
+            nr_rows = sum(stop - start for start, stop in ranges)
+        if len(bool_arr) != nr_rows:
+            raise ValueError(
+                'bool_arr has {0} rows, but bool_arr_rows={1!r} needs '
+                '{2}'.format(len(bool_arr), bool_arr_rows, nr_rows))
+
+        if ranges is not None and bool_arr_rows == 'all':
+            bool_arr = bcolz.carray(ctable_ext.row_view(bool_arr, ranges)[:])
+        return bool_arr
+
+    def slice_factor(self, factor, values, ranges):
+        """
+        Return the factor and values carrays of the rows in ranges, from
+        the factor of all rows (e.g. a cached one): the labels of the rows
+        are renumbered to the groups that occur in them, so only integer
+        labels are factorized
+
+        :param factor:
+        :param values:
+        :param ranges:
+        :return:
+        """
+        labels, reverse = \
+            ctable_ext.factorize(ctable_ext.row_view(factor, ranges))
+        old_labels = np.array([reverse[i] for i in xrange(len(reverse))],
+                              dtype='int64')
+        return labels, bcolz.carray(values[:][old_labels], dtype=values.dtype)
+
+    def factorize_groupby_cols(self, groupby_cols, ranges=None):
         """
+        Return the factor and values carrays of the groupby columns, from
+        the cache (see cache_factor) when available
 
-        :type self: ctable
+        :param groupby_cols:
+        :param ranges: only the rows in these ranges (see row_ranges)
+        :return: factor_list, values_list
         """
         # first check if the factorized arrays already exist
         # unless we need to refresh the cache
@@ -105,22 +1575,59 @@ class ctable(bcolz.ctable):
         # factorize the groupby columns
         for col in groupby_cols:
 
+            if col in self.lookups:
+                col_factor_carray, col_values_carray = \
+                    self.factorize_lookup(col, ranges=ranges)
+                factor_list.append(col_factor_carray)
+                values_list.append(col_values_carray)
+                continue
+
             cached = False
-            col_rootdir = self[col].rootdir
+            if col in self.names:
+                col_rootdir = self[col].rootdir
+            elif self.rootdir:
+                # a groupby key expression, cached under a derived name
+                col_rootdir = self.key_rootdir(col)
+            else:
+                col_rootdir = None
             if col_rootdir:
                 col_factor_rootdir = col_rootdir + '.factor'
                 col_values_rootdir = col_rootdir + '.values'
-                if os.path.exists(col_factor_rootdir):
+                if os.path.exists(col_factor_rootdir + '.npy'):
+                    # memory mapped cache (see cache_factor)
+                    cached = True
+                    col_factor_carray = np.load(col_factor_rootdir + '.npy',
+                                                mmap_mode='r')
+                    col_values_carray = np.load(col_values_rootdir + '.npy',
+                                                mmap_mode='r')
+                elif os.path.exists(col_factor_rootdir):
                     cached = True
                     col_factor_carray = \
                         bcolz.carray(rootdir=col_factor_rootdir, mode='r')
                     col_values_carray = \
                         bcolz.carray(rootdir=col_values_rootdir, mode='r')
-
-            if not cached:
-                col_factor_carray, values = ctable_ext.factorize(self[col])
+                # a cache of another length (e.g. after the table was
+                # written through another handle) is out of date
+                if cached and len(col_factor_carray) != self.len:
+                    cached = False
+
+            if cached and ranges is not None:
+                col_factor_carray, col_values_carray = \
+                    self.slice_factor(col_factor_carray, col_values_carray,
+                                      ranges)
+            elif not cached:
+                if col in self.names and ranges is not None:
+                    col_factor_carray, values = ctable_ext.factorize(
+                        ctable_ext.row_view(self[col], ranges))
+                elif col in self.names:
+                    col_factor_carray, values = \
+                        ctable_ext.factorize(self[col])
+                else:
+                    col_factor_carray, values = \
+                        self.factorize_key_expression(col, ranges=ranges)
                 col_values_carray = \
-                    bcolz.carray(values.values(), dtype=self[col].dtype)
+                    bcolz.carray(values.values(),
+                                 dtype=self.groupby_col_dtype(col))
 
             factor_list.append(col_factor_carray)
             values_list.append(col_values_carray)
@@ -149,21 +1656,20 @@ class ctable(bcolz.ctable):
             # nb: this might also be cached in the future
 
             # first combine the factorized columns to single values
-            factor_set = {x: y for x, y in zip(groupby_cols, factor_list)}
-
-            # create a numexpr expression that calculates the place on
-            # a cartesian join index
-            eval_str = ''
-            previous_value = 1
-            for col, values \
-                    in zip(reversed(groupby_cols), reversed(values_list)):
-                if eval_str:
-                    eval_str += ' + '
-                eval_str += str(previous_value) + '*' + col
-                previous_value *= len(values)
-
-            # calculate the cartesian group index for each row
-            factor_input = bcolz.eval(eval_str, user_dict=factor_set)
+            # by calculating the place on a cartesian join index
+            # (in int64, as the factor carrays can have narrow dtypes)
+            block_len = ctable_ext.source_chunklen(factor_list[0])
+            factor_input = bcolz.carray([], dtype='int64',
+                                        expectedlen=array_length,
+                                        chunklen=block_len)
+            for start in xrange(0, array_length, block_len):
+                check_cancelled()
+                stop = min(start + block_len, array_length)
+                block = np.zeros(stop - start, dtype='int64')
+                for factor, values in zip(factor_list, values_list):
+                    block *= len(values)
+                    block += factor[start:stop]
+                factor_input.append(block)
 
             # now factorize the unique groupby combinations
             factor_carray, values = ctable_ext.factorize(factor_input)
@@ -195,18 +1701,15 @@ class ctable(bcolz.ctable):
         return factor_carray, nr_groups, skip_key
 
 
-    def create_agg_ctable(self, groupby_cols, agg_list, nr_groups, rootdir):
-        # create output table
-        dtype_list = []
-        for col in groupby_cols:
-            dtype_list.append((col, self[col].dtype))
+    def parse_agg_list(self, agg_list):
+        """
+        Normalise an agg_list (see groupby) to a list of
+        (output_col, input_col, agg_op) tuples
 
-        agg_cols = []
-        agg_ops = []
-        op_translation = {
-            'sum': 1,
-            'sum_na': 2
-        }
+        :param agg_list:
+        :return: :raise NotImplementedError:
+        """
+        parsed = []
 
         for agg_info in agg_list:
 
@@ -214,22 +1717,115 @@ class ctable(bcolz.ctable):
                 # straight forward sum (a ['m1', 'm2', ...] parameter)
                 output_col = agg_info
                 input_col = agg_info
-                agg_op = 1
+                agg_op = 'sum'
             else:
                 # input/output settings [['mnew1', 'm1'], ['mnew2', 'm2], ...]
                 output_col = agg_info[0]
                 input_col = agg_info[1]
                 if len(agg_info) == 2:
-                    agg_op = 1
+                    agg_op = 'sum'
                 else:
                     # input/output settings [['mnew1', 'm1', 'sum'], ['mnew2', 'm1, 'avg'], ...]
                     agg_op = agg_info[2]
-                    if agg_op not in op_translation:
+                    if agg_op in quantile_ops:
+                        # quantiles become a (mode, q) tuple, i.e.
+                        # ['p95', 'm1', 'quantile', 0.95]
+                        agg_op = self.parse_quantile(agg_op, agg_info[3:])
+                    elif agg_op not in ('sum', 'sum_na'):
                         raise NotImplementedError(
                             'Unknown Aggregation Type: ' + unicode(agg_op))
-                    agg_op = op_translation[agg_op]
 
-            col_dtype = self[input_col].dtype
+            parsed.append((output_col, input_col, agg_op))
+
+        return parsed
+
+    def parse_quantile(self, agg_op, agg_args):
+        """
+        Normalise a median, quantile or percentile operation to a
+        ('quantile' | 'approx_quantile', q) tuple
+
+        :param agg_op:
+        :param agg_args: the quantile or percentile, if any
+        :return: :raise ValueError:
+        """
+        mode = 'approx_quantile' if agg_op.startswith('approx_') \
+            else 'quantile'
+        base_op = agg_op[len('approx_'):] if agg_op.startswith('approx_') \
+            else agg_op
+
+        if base_op == 'median':
+            q = 0.5
+        elif not agg_args:
+            raise ValueError(agg_op + ' needs a ' + base_op)
+        elif base_op == 'percentile':
+            q = float(agg_args[0]) / 100.0
+        else:
+            q = float(agg_args[0])
+
+        if not 0.0 <= q <= 1.0:
+            raise ValueError('Quantiles should be between 0 and 1, '
+                             'percentiles between 0 and 100')
+
+        return mode, q
+
+    def measure_cols(self, input_col):
+        """
+        Return the columns an aggregation input (a column or a numexpr
+        expression over columns, like 'revenue - cost') needs
+
+        :param input_col:
+        :return: :raise ValueError:
+        """
+        if input_col in self.names:
+            return [input_col]
+
+        try:
+            expression_vars = compile(input_col, '<string>', 'eval').co_names
+        except SyntaxError:
+            expression_vars = []
+        measure_cols = [col for col in self.names if col in expression_vars]
+
+        if not measure_cols:
+            raise ValueError(
+                'Unknown aggregation column or expression: ' + input_col)
+
+        return measure_cols
+
+    def measure_dtype(self, input_col):
+        """
+        Return the dtype of an aggregation input (see measure_cols), for
+        expressions by evaluating it on the first row
+
+        :param input_col:
+        :return:
+        """
+        if input_col in self.names:
+            return self[input_col].dtype
+
+        user_dict = {}
+        for col in self.measure_cols(input_col):
+            user_dict[col] = np.ones(1, dtype=self[col].dtype)
+        return bcolz.eval(input_col, user_dict=user_dict,
+                          out_flavor='numpy').dtype
+
+    def create_agg_ctable(self, groupby_cols, agg_list, nr_groups, rootdir,
+                          output='ctable', cparams=None):
+        # create output table
+        dtype_list = []
+        for col in groupby_cols:
+            dtype_list.append(
+                (self.key_name(col), self.groupby_col_dtype(col)))
+
+        agg_cols = []
+        agg_ops = []
+
+        for output_col, input_col, agg_op in self.parse_agg_list(agg_list):
+
+            if isinstance(agg_op, tuple):
+                # quantiles are interpolated
+                col_dtype = np.dtype('float64')
+            else:
+                col_dtype = self.measure_dtype(input_col)
             # TODO: check if the aggregation columns is numeric
             # NB: we could build a concatenation for strings like pandas, but I would really prefer to see that as a
             # separate operation
@@ -239,34 +1835,137 @@ class ctable(bcolz.ctable):
             agg_ops.append((input_col, agg_op))
             dtype_list.append((output_col, col_dtype))
 
-        # create aggregation table
-        ct_agg = bcolz.ctable(
-            np.zeros(0, dtype_list),
-            expectedlen=nr_groups,
-            rootdir=rootdir)
+        # create aggregation table (only for ctable output, see agg_output;
+        # with automatic cparams it is created from the aggregated arrays)
+        if output == 'ctable' and cparams != 'auto':
+            ct_agg = bcolz.ctable(
+                np.zeros(0, dtype_list),
+                expectedlen=nr_groups,
+                cparams=to_cparams(cparams),
+                rootdir=rootdir)
+        else:
+            ct_agg = None
 
         return ct_agg, dtype_list, agg_ops
 
+    def check_output(self, output, rootdir):
+        if output not in ('ctable', 'numpy', 'pandas'):
+            raise ValueError("output should be 'ctable', 'numpy' or 'pandas', "
+                             "not " + repr(output))
+        if rootdir is not None and output != 'ctable':
+            raise ValueError('A rootdir can only be given for ctable output')
+
+    def check_output_names(self, groupby_cols, agg_list):
+        """
+        Raise a ValueError when two output columns of a groupby get the
+        same name, e.g. the key expressions 'f0 % 3' and 'f0 * 3' (or the
+        column f0_3) all give f0_3, see key_name
+
+        :param groupby_cols:
+        :param agg_list:
+        :return: :raise ValueError:
+        """
+        inputs = {}
+        for col in groupby_cols:
+            inputs.setdefault(self.key_name(col), []).append(col)
+        for output_col, input_col, _ in self.parse_agg_list(agg_list):
+            inputs.setdefault(output_col, []).append(input_col)
+
+        for name, cols in sorted(inputs.items()):
+            if len(cols) > 1:
+                raise ValueError(
+                    'The groupby output column {0} would occur more than '
+                    'once (for {1})'.format(
+                        name, ', '.join(repr(col) for col in cols)))
 
-    def where_terms(self, term_list):
+    def agg_output(self, ct_agg, dtype_list, total, output, rootdir=None,
+                   cparams=None):
+        """
+        Return the aggregated arrays of a groupby in the requested output
+        format (see groupby)
+
+        :param ct_agg: the aggregation ctable (None unless output is ctable
+         and cparams is not 'auto')
+        :param dtype_list: the names and dtypes of the output columns
+        :param total: the aggregated arrays, in the order of dtype_list
+        :param output: 'ctable', 'numpy' or 'pandas'
+        :param rootdir: the rootdir of an automatically compressed ctable
+        :param cparams: the compression of a ctable output (see groupby)
+        :return:
+        """
+        if output == 'ctable' and cparams != 'auto':
+            if cparams is not None:
+                ct_agg.attrs['cparams'] = cparams_meta(
+                    to_cparams(cparams), ct_agg[ct_agg.names[0]].chunklen)
+            return ct_agg
+
+        names = [name for name, _ in dtype_list]
+
+        if output == 'pandas':
+            # pandas is only needed (and imported) for pandas output
+            import pandas as pd
+            return pd.DataFrame(dict(zip(names, total)), columns=names)
+
+        result = np.empty(len(total[0]) if total else 0, dtype=dtype_list)
+        for name, values in zip(names, total):
+            result[name] = values
+
+        if output == 'ctable':
+            # the aggregated columns are sampled as a whole (see
+            # bquery.compression.choose_cparams)
+            nr_rows = sample_rows([result[name] for name in names])
+            agg_cparams, chunklen = choose_cparams(
+                [result[name][:nr_rows] for name in names])
+            ct_agg = bcolz.ctable(result, cparams=agg_cparams,
+                                  chunklen=chunklen, rootdir=rootdir)
+            ct_agg.attrs['cparams'] = cparams_meta(
+                agg_cparams, ct_agg[names[0]].chunklen, auto=True)
+            return ct_agg
+
+        return result
+
+
+    @stamped
+    def where_terms(self, term_list, cache=False, start=None, stop=None,
+                    ranges=None):
         """
         TEMPORARY WORKAROUND TILL NUMEXPR WORKS WITH IN
         where_terms(term_list, outcols=None, limit=None, skip=0)
 
-        Iterate over rows where `term_list` is true.
+        Return a boolean carray that is true for the rows where `term_list`
+        is true. It is evaluated chunk by chunk into a compressed carray,
+        which can be used as bool_arr in groupby or in ctable.where.
         A terms list has a [(col, operator, value), ..] construction.
         Eg. [('sales', '>', 2), ('state', 'in', ['IL', 'AR'])]
 
+        With cache=True the selection of every term is cached in memory
+        (see filter_cache) and the selections of the terms are combined
+        with a bitwise and. With cache='disk' the selections are also
+        stored next to the rootdir. Only on-disk ctables are cached, as
+        the cache keys include a version stamp of the column files.
+
+        With start/stop or ranges (see row_ranges) only those rows are
+        evaluated, and the selection has one value per selected row.
+
         :param term_list:
-        :param outcols:
-        :param limit:
-        :param skip:
+        :param cache: False, True or 'disk'
+        :param start:
+        :param stop:
+        :param ranges: a list of (start, stop) row ranges
         :return: :raise ValueError:
         """
 
         if type(term_list) not in [list, set, tuple]:
             raise ValueError("Only term lists are supported")
 
+        ranges = self.row_ranges(start, stop, ranges)
+
+        # (only on-disk ctables have a version stamp, see column_stamp)
+        if cache and term_list and self.rootdir:
+            return self.where_terms_cached(term_list,
+                                           disk=(cache == 'disk'),
+                                           ranges=ranges)
+
         eval_string = ''
         eval_list = []
 
@@ -330,38 +2029,171 @@ class ctable(bcolz.ctable):
                     "Input not correctly formatted for eval or list filtering"
                 )
 
-        # (1) Evaluate terms in eval
-        # return eval_string, eval_list
-        if eval_string:
-            boolarr = self.eval(eval_string)
-            if eval_list:
-                # convert to numpy array for array_is_in
-                boolarr = boolarr[:]
-        else:
-            boolarr = np.ones(self.size, dtype=bool)
+        # the selection is built block by block into a compressed boolean
+        # carray, so the full mask never needs to exist in memory
+        # the columns the eval string uses, which includes the columns that
+        # are compared with another column, like ('f0', '>', 'f1')
+        eval_cols = self.measure_cols(eval_string) if eval_string else []
+        cols = self.cols if ranges is None else ctable_rows(self, ranges)
+        nr_rows = self.size if ranges is None else len(cols)
+        boolarr = bcolz.carray([], dtype='bool', expectedlen=nr_rows)
+        block_len = min([cols[col].chunklen for col in eval_cols] +
+                        [cols[term[0]].chunklen for term in eval_list]
+                        or [boolarr.chunklen])
+
+        for start in xrange(0, nr_rows, block_len):
+            check_cancelled()
+            stop = min(start + block_len, nr_rows)
+
+            # (1) Evaluate terms in eval
+            if eval_string:
+                user_dict = \
+                    {col: ctable_ext.read_rows(cols[col], start, stop)
+                     for col in eval_cols}
+                block = bcolz.eval(eval_string, user_dict=user_dict,
+                                   out_flavor='numpy')
+            else:
+                block = np.ones(stop - start, dtype=bool)
 
-        # (2) Evaluate other terms like 'in' or 'not in' ...
-        for term in eval_list:
+            # (2) Evaluate other terms like 'in' or 'not in' ...
+            for term in eval_list:
 
-            name = term[0]
-            col = self.cols[name]
+                name = term[0]
+                col = cols[name]
 
-            operator = term[1]
-            if operator.lower() == 'not in':
-                reverse = True
-            elif operator.lower() == 'in':
-                reverse = False
-            else:
-                raise ValueError(
-                    "Input not correctly formatted for list filtering"
-                )
+                operator = term[1]
+                if operator.lower() == 'not in':
+                    reverse = True
+                elif operator.lower() == 'in':
+                    reverse = False
+                else:
+                    raise ValueError(
+                        "Input not correctly formatted for list filtering"
+                    )
+
+                value_set = set(term[2])
+
+                ctable_ext.carray_is_in(col, value_set, block, reverse,
+                                        start)
+
+            boolarr.append(block)
+
+        return boolarr
+
+    # filter cache functions
+    def term_cols(self, term):
+        """
+        Return the columns a where_terms term uses: its column and, for a
+        comparison with another column like ('f0', '>', 'f1'), that column
+
+        :param term:
+        :return:
+        """
+        cols = [term[0]]
+        if term[1].lower() not in ['in', 'not in'] and \
+                isinstance(term[2], basestring) and term[2] in self.names:
+            cols.append(term[2])
+        return cols
+
+    def column_stamp(self, cols):
+        """
+        Return a version stamp of the contents of on-disk columns: a digest
+        of the length and the write stamp of every column (see
+        carray_stamp), which changes when they are flushed (also by another
+        process or through the column carrays). Writes through this ctable
+        drop the caches right away (see invalidate_caches).
+
+        :param cols:
+        :return:
+        """
+        stamps = [self.len]
+        for col in cols:
+            stamps.append((col, carray_stamp(self[col])))
 
-            value_set = set(term[2])
+        return hashlib.md5(repr(stamps)).hexdigest()
 
-            ctable_ext.carray_is_in(col, value_set, boolarr, reverse)
+    # filter cache functions
+    def filter_key(self, term, ranges=None):
+        """
+        Return the filter cache key of a where_terms term on an on-disk
+        ctable: the rootdir, the normalised term, the row ranges (None for
+        all rows) and the version stamp of the columns of the term (see
+        column_stamp)
+
+        :param term:
+        :param ranges: the normalised row ranges (see row_ranges)
+        :return:
+        """
+        filter_col = term[0]
+        filter_operator = term[1].lower()
+        filter_value = term[2]
+
+        if filter_operator in ['in', 'not in']:
+            if type(filter_value) not in [list, set, tuple]:
+                raise ValueError("In selections need lists, sets or tuples")
+            filter_value = tuple(sorted(set(filter_value)))
 
-        if eval_list:
-            # convert boolarr back to carray
-            boolarr = bcolz.carray(boolarr)
+        if ranges is not None:
+            ranges = tuple(ranges)
+
+        return os.path.normpath(self.rootdir), \
+            (filter_col, filter_operator, filter_value), ranges, \
+            self.column_stamp(self.term_cols(term))
+
+    def filter_rootdir(self, key):
+        """
+        Return the rootdir of the disk cache of a filter key: one directory
+        per term (and row ranges), holding the selection of one version
+
+        :param key:
+        :return: the term directory, the selection rootdir
+        """
+        digest = hashlib.md5(repr(key[:3])).hexdigest()
+        term_dir = os.path.join(os.path.normpath(self.rootdir) + '.filters',
+                                digest)
+        return term_dir, os.path.join(term_dir, key[3])
+
+    def where_terms_cached(self, term_list, disk=False, ranges=None):
+        """
+        where_terms with a cached selection per term (see where_terms)
+
+        Selections of an older version of the columns are dropped from the
+        memory cache and from disk when the term is cached again. The
+        returned carray is a copy, so the caller can change it.
+
+        :param term_list:
+        :param disk: also cache the selections on disk next to the rootdir
+        :param ranges: the normalised row ranges (see row_ranges)
+        :return:
+        """
+        selections = {}
+
+        for term in term_list:
+            key = self.filter_key(term, ranges=ranges)
+            boolarr = filter_cache.get(key)
+            term_dir, filter_rootdir = self.filter_rootdir(key)
+
+            if boolarr is None and disk and os.path.exists(filter_rootdir):
+                boolarr = bcolz.carray(rootdir=filter_rootdir, mode='r').copy()
+
+            if boolarr is None:
+                boolarr = self.where_terms([term], ranges=ranges)
+                if disk:
+                    # the selections of older versions are outdated
+                    if os.path.exists(term_dir):
+                        shutil.rmtree(term_dir)
+                    os.makedirs(term_dir)
+                    boolarr.copy(rootdir=filter_rootdir, mode='w').flush()
+
+            if key not in filter_cache:
+                filter_cache.invalidate(key[:3])
+                filter_cache.put(key, boolarr)
+            selections['term%d' % len(selections)] = boolarr
+
+        if len(selections) == 1:
+            return selections.values()[0].copy()
+
+        # combine the cached selections instead of re-evaluating them
+        return bcolz.eval(' & '.join(sorted(selections)),
+                          user_dict=selections)
 
-        return boolarr
\ No newline at end of file
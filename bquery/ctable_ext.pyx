@@ -1,20 +1,223 @@
+import os
+import shutil
+import tempfile
 import numpy as np
 import cython
-from numpy cimport ndarray, dtype, npy_intp, npy_int32, npy_uint64, npy_int64, npy_float64
+import bcolz
+from numpy cimport ndarray, dtype, npy_intp, npy_int32, npy_uint8, npy_uint16, npy_uint32, npy_uint64, npy_int64, npy_float64
 
 from libc.stdlib cimport malloc
 
-from libc.string cimport strcpy
+from libc.string cimport strcpy, memcpy
 from khash cimport *
 from bcolz.carray_ext cimport carray, chunk
 
+from bquery.cache import carray_stamp, chunk_cache
+from bquery.cancel import check_cancelled
+
+# Chunk Section
+cdef object _chunk_key(carray ca, Py_ssize_t chunk_nr):
+    # the write stamp of the carray (see carray_stamp) is part of the key,
+    # so chunks of a carray that was flushed since they were cached (also
+    # by another process) are not read from the cache; writes through a
+    # bquery ctable drop its chunks right away (see invalidate_caches)
+    rootdir = os.path.normpath(ca.rootdir)
+    return os.path.dirname(rootdir), os.path.basename(rootdir), chunk_nr, \
+        carray_stamp(ca)
+
+cdef ndarray _read_chunk(carray ca, Py_ssize_t chunk_nr, ndarray buffer):
+    """
+    Return an array that holds the decompressed chunk chunk_nr of ca
+
+    Chunks of on-disk carrays are read through the process-wide chunk
+    cache, other chunks are decompressed into buffer.
+    """
+    cdef:
+        chunk chunk_
+        ndarray chunk_array
+
+    if not ca.rootdir:
+        chunk_ = ca.chunks[chunk_nr]
+        chunk_._getitem(0, ca.chunklen, buffer.data)
+        return buffer
+
+    key = _chunk_key(ca, chunk_nr)
+    chunk_array = chunk_cache.get(key)
+    if chunk_array is None:
+        chunk_array = np.empty(ca.chunklen, dtype=ca.dtype)
+        chunk_ = ca.chunks[chunk_nr]
+        chunk_._getitem(0, ca.chunklen, chunk_array.data)
+        chunk_array.flags.writeable = False
+        chunk_cache.put(key, chunk_array)
+
+    return chunk_array
+
+cdef class row_view:
+    """
+    row_view(source, ranges)
+
+    The rows of a carray (or ndarray) in a list of (start, stop) row
+    ranges, which the kernels read like a carray of just those rows; only
+    the chunks that overlap the ranges are decompressed
+    """
+    cdef readonly object source
+    cdef readonly list ranges
+    cdef readonly ndarray offsets
+    cdef readonly Py_ssize_t chunklen
+    cdef readonly object dtype
+
+    def __init__(self, source, ranges):
+        self.source = source
+        self.ranges = [(start, stop) for start, stop in ranges]
+        self.offsets = np.zeros(len(self.ranges) + 1, dtype='int64')
+        np.cumsum([stop - start for start, stop in self.ranges],
+                  out=self.offsets[1:])
+        self.chunklen = source_chunklen(source)
+        self.dtype = source.dtype
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise IndexError('A row_view can only be sliced')
+        start, stop, _ = key.indices(len(self))
+        return read_rows(self, start, max(start, stop))
+
+cdef ndarray _read_view_rows(row_view view, Py_ssize_t start, Py_ssize_t stop,
+                             ndarray buffer):
+    # the selected rows start:stop, from one range (without a copy when
+    # possible) or pieced together from several ranges into buffer
+    cdef:
+        Py_ssize_t i, range_start, n, pos
+        ndarray piece
+
+    i = np.searchsorted(view.offsets, start, side='right') - 1
+    range_start = view.ranges[i][0] + start - view.offsets[i]
+    if stop <= view.offsets[i + 1]:
+        return _read_rows(view.source, range_start,
+                          range_start + stop - start, buffer)
+
+    pos = 0
+    while start + pos < stop:
+        n = min(view.offsets[i + 1], stop) - (start + pos)
+        range_start = view.ranges[i][0] + start + pos - view.offsets[i]
+        piece = _read_rows(view.source, range_start, range_start + n,
+                           np.empty(n, dtype=view.dtype))
+        buffer[pos:pos + n] = piece[:n]
+        pos += n
+        i += 1
+
+    return buffer
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef ndarray _read_rows(source, Py_ssize_t start, Py_ssize_t stop, ndarray buffer):
+    """
+    Return an array that holds the rows start:stop of a carray, or a view
+    of them for an ndarray source (e.g. a memory mapped factor cache, which
+    is read through the OS page cache without decompressing or copying) or
+    the selected rows of a row_view
+    """
+    if isinstance(source, np.ndarray):
+        return source[start:stop]
+    elif isinstance(source, row_view):
+        return _read_view_rows(source, start, stop, buffer)
+    return _read_carray_rows(source, start, stop, buffer)
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef ndarray _read_carray_rows(carray ca, Py_ssize_t start, Py_ssize_t stop,
+                               ndarray buffer):
+    """
+    Return an array that holds the rows start:stop of ca
+
+    When the rows are exactly one chunk of ca (the aligned case) the chunk
+    is returned as read by _read_chunk, or the leftover array is
+    returned as is. Otherwise the rows are pieced together into buffer
+    from the chunks they overlap.
+    """
+    cdef:
+        chunk chunk_
+        Py_ssize_t chunklen, nchunks, atomsize, chunk_nr, chunk_row, n
+        ndarray leftover_array, chunk_array
+        char * dest
+
+    chunklen = ca.chunklen
+    nchunks = ca.nchunks
+    atomsize = ca.atomsize
+
+    chunk_nr = cython.cdiv(start, chunklen)
+    chunk_row = start - chunk_nr * chunklen
+
+    # aligned rows
+    if chunk_row == 0:
+        if chunk_nr < nchunks and stop - start == chunklen:
+            return _read_chunk(ca, chunk_nr, buffer)
+        elif chunk_nr == nchunks:
+            return ca.leftover_array
+
+    # misaligned rows
+    dest = buffer.data
+    while start < stop:
+        chunk_nr = cython.cdiv(start, chunklen)
+        chunk_row = start - chunk_nr * chunklen
+        n = min(chunklen - chunk_row, stop - start)
+        if chunk_nr < nchunks:
+            if ca.rootdir:
+                chunk_array = _read_chunk(ca, chunk_nr, None)
+                memcpy(dest, chunk_array.data + chunk_row * atomsize,
+                       n * atomsize)
+            else:
+                chunk_ = ca.chunks[chunk_nr]
+                chunk_._getitem(chunk_row, chunk_row + n, dest)
+        else:
+            leftover_array = ca.leftover_array
+            memcpy(dest, leftover_array.data + chunk_row * atomsize,
+                   n * atomsize)
+        dest += n * atomsize
+        start += n
+
+    return buffer
+
+def read_rows(ca, Py_ssize_t start, Py_ssize_t stop):
+    """
+    Return the rows start:stop of ca as a numpy array, read through the
+    chunk cache. The array can be a read-only view of a cached chunk (or
+    of ca itself, when ca is an ndarray).
+
+    :param ca:
+    :param start:
+    :param stop:
+    :return:
+    """
+    cdef ndarray buffer
+
+    if isinstance(ca, np.ndarray):
+        return ca[start:stop]
+    buffer = np.empty(stop - start, dtype=ca.dtype)
+    return _read_rows(ca, start, stop, buffer)[:stop - start]
+
+def source_chunklen(source, Py_ssize_t default=2 ** 16):
+    """
+    Return the chunklen of a carray, or default for an ndarray source
+
+    :param source:
+    :param default:
+    :return:
+    """
+    if isinstance(source, np.ndarray):
+        return default
+    return source.chunklen
+
+# ---------------------------------------------------------------------------
 # Factorize Section
 @cython.wraparound(False)
 @cython.boundscheck(False)
 cdef void _factorize_str_helper(Py_ssize_t iter_range,
                        Py_ssize_t allocation_size,
                        ndarray in_buffer,
-                       ndarray[npy_uint64] out_buffer,
+                       ndarray[npy_int64] out_buffer,
                        kh_str_t *table,
                        Py_ssize_t * count,
                        dict reverse,
@@ -50,11 +253,10 @@ cdef void _factorize_str_helper(Py_ssize_t iter_range,
 @cython.boundscheck(False)
 def factorize_str(carray carray_, carray labels=None):
     cdef:
-        chunk chunk_
         Py_ssize_t n, i, count, chunklen, leftover_elements
         dict reverse
         ndarray in_buffer
-        ndarray[npy_uint64] out_buffer
+        ndarray[npy_int64] out_buffer
         kh_str_t *table
 
     count = 0
@@ -64,26 +266,26 @@ def factorize_str(carray carray_, carray labels=None):
     n = len(carray_)
     chunklen = carray_.chunklen
     if labels is None:
-        labels = carray([], dtype='uint64', expectedlen=n)
+        # chunk-aligned with the input
+        labels = carray([], dtype='int64', expectedlen=n, chunklen=chunklen)
     # in-buffer isn't typed, because cython doesn't support string arrays (?)
-    out_buffer = np.empty(chunklen, dtype='uint64')
+    out_buffer = np.empty(chunklen, dtype='int64')
     in_buffer = np.empty(chunklen, dtype=carray_.dtype)
     table = kh_init_str()
 
     for i in range(carray_.nchunks):
-        chunk_ = carray_.chunks[i]
-        # decompress into in_buffer
-        chunk_._getitem(0, chunklen, in_buffer.data)
+        check_cancelled()
+        # decompress (or read from the chunk cache)
         _factorize_str_helper(chunklen,
                         carray_.dtype.itemsize + 1,
-                        in_buffer,
+                        _read_chunk(carray_, i, in_buffer),
                         out_buffer,
                         table,
                         &count,
                         reverse,
                         )
         # compress out_buffer into labels
-        labels.append(out_buffer.astype(np.int64))
+        labels.append(out_buffer)
 
     leftover_elements = cython.cdiv(carray_.leftover, carray_.atomsize)
     if leftover_elements > 0:
@@ -97,7 +299,7 @@ def factorize_str(carray carray_, carray labels=None):
                           )
 
     # compress out_buffer into labels
-    labels.append(out_buffer[:leftover_elements].astype(np.int64))
+    labels.append(out_buffer[:leftover_elements])
 
     kh_destroy_str(table)
 
@@ -108,7 +310,7 @@ def factorize_str(carray carray_, carray labels=None):
 cdef void _factorize_int64_helper(Py_ssize_t iter_range,
                        Py_ssize_t allocation_size,
                        ndarray[npy_int64] in_buffer,
-                       ndarray[npy_uint64] out_buffer,
+                       ndarray[npy_int64] out_buffer,
                        kh_int64_t *table,
                        Py_ssize_t * count,
                        dict reverse,
@@ -137,11 +339,10 @@ cdef void _factorize_int64_helper(Py_ssize_t iter_range,
 @cython.boundscheck(False)
 def factorize_int64(carray carray_, carray labels=None):
     cdef:
-        chunk chunk_
         Py_ssize_t n, i, count, chunklen, leftover_elements
         dict reverse
         ndarray[npy_int64] in_buffer
-        ndarray[npy_uint64] out_buffer
+        ndarray[npy_int64] out_buffer
         kh_int64_t *table
 
     count = 0
@@ -151,25 +352,25 @@ def factorize_int64(carray carray_, carray labels=None):
     n = len(carray_)
     chunklen = carray_.chunklen
     if labels is None:
-        labels = carray([], dtype='int64', expectedlen=n)
-    out_buffer = np.empty(chunklen, dtype='uint64')
+        # chunk-aligned with the input
+        labels = carray([], dtype='int64', expectedlen=n, chunklen=chunklen)
+    out_buffer = np.empty(chunklen, dtype='int64')
     in_buffer = np.empty(chunklen, dtype='int64')
     table = kh_init_int64()
 
     for i in range(carray_.nchunks):
-        chunk_ = carray_.chunks[i]
-        # decompress into in_buffer
-        chunk_._getitem(0, chunklen, in_buffer.data)
+        check_cancelled()
+        # decompress (or read from the chunk cache)
         _factorize_int64_helper(chunklen,
                         carray_.dtype.itemsize + 1,
-                        in_buffer,
+                        _read_chunk(carray_, i, in_buffer),
                         out_buffer,
                         table,
                         &count,
                         reverse,
                         )
         # compress out_buffer into labels
-        labels.append(out_buffer.astype(np.int64))
+        labels.append(out_buffer)
 
     leftover_elements = cython.cdiv(carray_.leftover, carray_.atomsize)
     if leftover_elements > 0:
@@ -183,7 +384,7 @@ def factorize_int64(carray carray_, carray labels=None):
                           )
 
     # compress out_buffer into labels
-    labels.append(out_buffer[:leftover_elements].astype(np.int64))
+    labels.append(out_buffer[:leftover_elements])
 
     kh_destroy_int64(table)
 
@@ -194,7 +395,7 @@ def factorize_int64(carray carray_, carray labels=None):
 cdef void _factorize_int32_helper(Py_ssize_t iter_range,
                        Py_ssize_t allocation_size,
                        ndarray[npy_int32] in_buffer,
-                       ndarray[npy_uint64] out_buffer,
+                       ndarray[npy_int64] out_buffer,
                        kh_int32_t *table,
                        Py_ssize_t * count,
                        dict reverse,
@@ -223,11 +424,10 @@ cdef void _factorize_int32_helper(Py_ssize_t iter_range,
 @cython.boundscheck(False)
 def factorize_int32(carray carray_, carray labels=None):
     cdef:
-        chunk chunk_
         Py_ssize_t n, i, count, chunklen, leftover_elements
         dict reverse
         ndarray[npy_int32] in_buffer
-        ndarray[npy_uint64] out_buffer
+        ndarray[npy_int64] out_buffer
         kh_int32_t *table
 
     count = 0
@@ -237,26 +437,26 @@ def factorize_int32(carray carray_, carray labels=None):
     n = len(carray_)
     chunklen = carray_.chunklen
     if labels is None:
-        labels = carray([], dtype='int32', expectedlen=n)
+        # chunk-aligned with the input
+        labels = carray([], dtype='int64', expectedlen=n, chunklen=chunklen)
     # in-buffer isn't typed, because cython doesn't support string arrays (?)
-    out_buffer = np.empty(chunklen, dtype='uint64')
+    out_buffer = np.empty(chunklen, dtype='int64')
     in_buffer = np.empty(chunklen, dtype='int32')
     table = kh_init_int32()
 
     for i in range(carray_.nchunks):
-        chunk_ = carray_.chunks[i]
-        # decompress into in_buffer
-        chunk_._getitem(0, chunklen, in_buffer.data)
+        check_cancelled()
+        # decompress (or read from the chunk cache)
         _factorize_int32_helper(chunklen,
                         carray_.dtype.itemsize + 1,
-                        in_buffer,
+                        _read_chunk(carray_, i, in_buffer),
                         out_buffer,
                         table,
                         &count,
                         reverse,
                         )
         # compress out_buffer into labels
-        labels.append(out_buffer.astype(np.int64))
+        labels.append(out_buffer)
 
     leftover_elements = cython.cdiv(carray_.leftover, carray_.atomsize)
     if leftover_elements > 0:
@@ -270,7 +470,7 @@ def factorize_int32(carray carray_, carray labels=None):
                           )
 
     # compress out_buffer into labels
-    labels.append(out_buffer[:leftover_elements].astype(np.int64))
+    labels.append(out_buffer[:leftover_elements])
 
     kh_destroy_int32(table)
 
@@ -281,7 +481,7 @@ def factorize_int32(carray carray_, carray labels=None):
 cdef void _factorize_float64_helper(Py_ssize_t iter_range,
                        Py_ssize_t allocation_size,
                        ndarray[npy_float64] in_buffer,
-                       ndarray[npy_uint64] out_buffer,
+                       ndarray[npy_int64] out_buffer,
                        kh_float64_t *table,
                        Py_ssize_t * count,
                        dict reverse,
@@ -311,11 +511,10 @@ cdef void _factorize_float64_helper(Py_ssize_t iter_range,
 @cython.boundscheck(False)
 def factorize_float64(carray carray_, carray labels=None):
     cdef:
-        chunk chunk_
         Py_ssize_t n, i, count, chunklen, leftover_elements
         dict reverse
         ndarray[npy_float64] in_buffer
-        ndarray[npy_uint64] out_buffer
+        ndarray[npy_int64] out_buffer
         kh_float64_t *table
 
     count = 0
@@ -325,26 +524,26 @@ def factorize_float64(carray carray_, carray labels=None):
     n = len(carray_)
     chunklen = carray_.chunklen
     if labels is None:
-        labels = carray([], dtype='float64', expectedlen=n)
+        # chunk-aligned with the input
+        labels = carray([], dtype='int64', expectedlen=n, chunklen=chunklen)
     # in-buffer isn't typed, because cython doesn't support string arrays (?)
-    out_buffer = np.empty(chunklen, dtype='uint64')
+    out_buffer = np.empty(chunklen, dtype='int64')
     in_buffer = np.empty(chunklen, dtype='float64')
     table = kh_init_float64()
 
     for i in range(carray_.nchunks):
-        chunk_ = carray_.chunks[i]
-        # decompress into in_buffer
-        chunk_._getitem(0, chunklen, in_buffer.data)
+        check_cancelled()
+        # decompress (or read from the chunk cache)
         _factorize_float64_helper(chunklen,
                         carray_.dtype.itemsize + 1,
-                        in_buffer,
+                        _read_chunk(carray_, i, in_buffer),
                         out_buffer,
                         table,
                         &count,
                         reverse,
                         )
         # compress out_buffer into labels
-        labels.append(out_buffer.astype(np.int64))
+        labels.append(out_buffer)
 
     leftover_elements = cython.cdiv(carray_.leftover, carray_.atomsize)
     if leftover_elements > 0:
@@ -358,13 +557,16 @@ def factorize_float64(carray carray_, carray labels=None):
                           )
 
     # compress out_buffer into labels
-    labels.append(out_buffer[:leftover_elements].astype(np.int64))
+    labels.append(out_buffer[:leftover_elements])
 
     kh_destroy_float64(table)
 
     return labels, reverse
 
-def factorize(carray carray_, carray labels=None):
+def factorize(carray_, carray labels=None):
+    if not isinstance(carray_, carray):
+        # a row_view or ndarray, i.e. some rows of a (cached) factor
+        return _factorize_source(carray_, labels)
     if carray_.dtype == 'int32':
         labels, reverse = factorize_int32(carray_, labels=labels)
     elif carray_.dtype == 'int64':
@@ -376,6 +578,101 @@ def factorize(carray carray_, carray labels=None):
         labels, reverse = factorize_str(carray_, labels=labels)
     return labels, reverse
 
+def _source_blocks(source, dtype, Py_ssize_t block_len):
+    cdef Py_ssize_t start, stop, n
+
+    n = len(source)
+    for start in xrange(0, n, block_len):
+        check_cancelled()
+        stop = min(start + block_len, n)
+        # copied, as the rows can be a read-only (cached) array
+        yield np.array(read_rows(source, start, stop), dtype=dtype)
+
+def _factorize_source(source, carray labels=None):
+    # factorize a row_view or ndarray block by block, narrow labels are
+    # factorized as int64
+    dtype = source.dtype
+    if dtype.kind in 'biu' and dtype != np.int32:
+        dtype = np.dtype('int64')
+    block_len = source_chunklen(source)
+    if labels is None:
+        labels = carray([], dtype='int64', expectedlen=len(source),
+                        chunklen=block_len)
+    return factorize_blocks(_source_blocks(source, dtype, block_len), dtype,
+                            labels)
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def factorize_blocks(blocks, dtype, carray labels):
+    """
+    Factorize the arrays of the blocks iterable (all of the given dtype)
+    as if they were one column, keeping one hash table over all blocks,
+    and append their labels to labels
+
+    This factorizes values that are computed block by block, without
+    writing them to a carray first.
+
+    :param blocks:
+    :param dtype: int32, int64, float64 or a string dtype
+    :param labels:
+    :return: labels, reverse
+    """
+    cdef:
+        Py_ssize_t count, n
+        dict reverse
+        ndarray in_buffer
+        ndarray[npy_int64] out_buffer
+        kh_int32_t *table_int32
+        kh_int64_t *table_int64
+        kh_float64_t *table_float64
+        kh_str_t *table_str
+
+    count = 0
+    reverse = {}
+    dtype = np.dtype(dtype)
+    out_buffer = np.empty(labels.chunklen, dtype='int64')
+
+    if dtype == 'int32':
+        table_int32 = kh_init_int32()
+    elif dtype == 'int64':
+        table_int64 = kh_init_int64()
+    elif dtype == 'float64':
+        table_float64 = kh_init_float64()
+    else:
+        table_str = kh_init_str()
+
+    for in_buffer in blocks:
+        n = len(in_buffer)
+        if n > len(out_buffer):
+            out_buffer = np.empty(n, dtype='int64')
+
+        if dtype == 'int32':
+            _factorize_int32_helper(n, dtype.itemsize + 1, in_buffer,
+                                    out_buffer, table_int32, &count, reverse)
+        elif dtype == 'int64':
+            _factorize_int64_helper(n, dtype.itemsize + 1, in_buffer,
+                                    out_buffer, table_int64, &count, reverse)
+        elif dtype == 'float64':
+            _factorize_float64_helper(n, dtype.itemsize + 1, in_buffer,
+                                      out_buffer, table_float64, &count,
+                                      reverse)
+        else:
+            _factorize_str_helper(n, dtype.itemsize + 1, in_buffer,
+                                  out_buffer, table_str, &count, reverse)
+
+        labels.append(out_buffer[:n])
+
+    if dtype == 'int32':
+        kh_destroy_int32(table_int32)
+    elif dtype == 'int64':
+        kh_destroy_int64(table_int64)
+    elif dtype == 'float64':
+        kh_destroy_float64(table_float64)
+    else:
+        kh_destroy_str(table_str)
+
+    return labels, reverse
+
 # ---------------------------------------------------------------------------
 # Aggregation Section (old)
 @cython.boundscheck(False)
@@ -403,400 +700,681 @@ def agg_sum(iter_):
 
 # ---------------------------------------------------------------------------
 # Aggregation Section
-@cython.wraparound(False)
-@cython.boundscheck(False)
-cdef sum_float64(carray ca_input, carray ca_factor, Py_ssize_t nr_groups, Py_ssize_t skip_key):
-    cdef:
-        chunk input_chunk, factor_chunk
-        Py_ssize_t input_chunk_nr, input_chunk_len
-        Py_ssize_t factor_chunk_nr, factor_chunk_len, factor_chunk_row
-        Py_ssize_t current_index, i, factor_total_chunks, leftover_elements
-
-        ndarray[npy_float64] in_buffer
-        ndarray[npy_int64] factor_buffer
-        ndarray[npy_float64] out_buffer
-
-    count = 0
-    ret = 0
-    reverse = {}
+def label_dtype(Py_ssize_t nr_values):
+    """
+    Return the narrowest dtype that can hold the labels of a factorization
+    with nr_values unique values
 
-    input_chunk_len = ca_input.chunklen
-    in_buffer = np.empty(input_chunk_len, dtype='float64')
-    factor_chunk_len = ca_factor.chunklen
-    factor_total_chunks = ca_factor.nchunks
-    factor_chunk_nr = 0
-    factor_buffer = np.empty(factor_chunk_len, dtype='int64')
-    if factor_total_chunks > 0:
-        factor_chunk = ca_factor.chunks[factor_chunk_nr]
-        factor_chunk._getitem(0, factor_chunk_len, factor_buffer.data)
+    :param nr_values:
+    :return:
+    """
+    if nr_values <= 2 ** 8:
+        return np.dtype('uint8')
+    elif nr_values <= 2 ** 16:
+        return np.dtype('uint16')
+    elif nr_values <= 2 ** 32:
+        return np.dtype('uint32')
     else:
-        factor_buffer = ca_factor.leftover_array
-    factor_chunk_row = 0
-    out_buffer = np.zeros(nr_groups, dtype='float64')
-
-    for input_chunk_nr in range(ca_input.nchunks):
-        # fill input buffer
-        input_chunk = ca_input.chunks[input_chunk_nr]
-        input_chunk._getitem(0, input_chunk_len, in_buffer.data)
-
-        # loop through rows
-        for i in range(input_chunk_len):
-
-            # go to next factor buffer if necessary
-            if factor_chunk_row == factor_chunk_len:
-                factor_chunk_nr += 1
-                if factor_chunk_nr < factor_total_chunks:
-                    factor_chunk = ca_factor.chunks[factor_chunk_nr]
-                    factor_chunk._getitem(0, factor_chunk_len, factor_buffer.data)
-                else:
-                    factor_buffer = ca_factor.leftover_array
-                factor_chunk_row = 0
-
-            # retrieve index
-            current_index = factor_buffer[factor_chunk_row]
-            factor_chunk_row += 1
+        return np.dtype('int64')
 
-            # update value if it's not an invalid index
-            if current_index != skip_key:
-                out_buffer[current_index] += in_buffer[i]
+def narrow_labels(carray labels, Py_ssize_t nr_values, **kwargs):
+    """
+    Copy the labels carray chunk by chunk into a new carray with the
+    narrowest dtype that fits nr_values (see label_dtype)
 
-    leftover_elements = cython.cdiv(ca_input.leftover, ca_input.atomsize)
-    if leftover_elements > 0:
-        # fill input buffer
-        in_buffer = ca_input.leftover_array
-
-        # loop through rows
-        for i in range(leftover_elements):
-
-            # go to next factor buffer if necessary
-            if factor_chunk_row == factor_chunk_len:
-                factor_chunk_nr += 1
-                if factor_chunk_nr < factor_total_chunks:
-                    factor_chunk = ca_factor.chunks[factor_chunk_nr]
-                    factor_chunk._getitem(0, factor_chunk_len, factor_buffer.data)
-                else:
-                    factor_buffer = ca_factor.leftover_array
-                factor_chunk_row = 0
+    :param labels:
+    :param nr_values:
+    :param kwargs: passed on to the new carray (rootdir, mode, ...)
+    :return:
+    """
+    cdef:
+        chunk chunk_
+        Py_ssize_t i, chunklen, leftover_elements
+        ndarray[npy_int64] in_buffer
+        carray out
 
-            # retrieve index
-            current_index = factor_buffer[factor_chunk_row]
-            factor_chunk_row += 1
+    out_dtype = label_dtype(nr_values)
+    out = carray([], dtype=out_dtype, expectedlen=len(labels), **kwargs)
 
-            # update value if it's not an invalid index
-            if current_index != skip_key:
-                out_buffer[current_index] += in_buffer[i]
+    chunklen = labels.chunklen
+    in_buffer = np.empty(chunklen, dtype='int64')
 
-    # check whether a row has to be removed if it was meant to be skipped
-    if skip_key < nr_groups:
-        np.delete(out_buffer, skip_key)
+    for i in range(labels.nchunks):
+        check_cancelled()
+        chunk_ = labels.chunks[i]
+        chunk_._getitem(0, chunklen, in_buffer.data)
+        out.append(in_buffer.astype(out_dtype))
 
-    return out_buffer
+    leftover_elements = cython.cdiv(labels.leftover, labels.atomsize)
+    if leftover_elements > 0:
+        out.append(labels.leftover_array[:leftover_elements].astype(out_dtype))
+
+    return out
+
+ctypedef fused factor_t:
+    npy_uint8
+    npy_uint16
+    npy_uint32
+    npy_int64
+
+ctypedef fused sum_t:
+    npy_int32
+    npy_int64
+    npy_float64
+
+cdef _check_factor_len(ca_factor, source):
+    # the kernels index through the labels without bounds checks, so a
+    # factor of another length than the input (e.g. an outdated factor
+    # cache) must not reach them
+    if len(ca_factor) != len(source):
+        raise ValueError(
+            'The factor has {0} rows, but the input has {1}'.format(
+                len(ca_factor), len(source)))
+
+cdef _check_measure_len(ct_input, col, ca_factor):
+    for measure_col in ct_input.measure_cols(col):
+        _check_factor_len(ca_factor, ct_input[measure_col])
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-cdef sum_int32(carray ca_input, carray ca_factor, Py_ssize_t nr_groups, Py_ssize_t skip_key):
-    cdef:
-        chunk input_chunk, factor_chunk
-        Py_ssize_t input_chunk_nr, input_chunk_len
-        Py_ssize_t factor_chunk_nr, factor_chunk_len, factor_chunk_row
-        Py_ssize_t current_index, i, factor_total_chunks, leftover_elements
-
-        ndarray[npy_int32] in_buffer
-        ndarray[npy_int64] factor_buffer
-        ndarray[npy_int32] out_buffer
-
-    count = 0
-    ret = 0
-    reverse = {}
+cdef inline void _sum_chunk(sum_t * in_values,
+                            factor_t * factor_values,
+                            sum_t * out_values,
+                            Py_ssize_t n,
+                            bint skip_nan) nogil:
+    cdef Py_ssize_t i
 
-    input_chunk_len = ca_input.chunklen
-    in_buffer = np.empty(input_chunk_len, dtype='int32')
-    factor_chunk_len = ca_factor.chunklen
-    factor_total_chunks = ca_factor.nchunks
-    factor_chunk_nr = 0
-    factor_buffer = np.empty(factor_chunk_len, dtype='int64')
-    if factor_total_chunks > 0:
-        factor_chunk = ca_factor.chunks[factor_chunk_nr]
-        factor_chunk._getitem(0, factor_chunk_len, factor_buffer.data)
+    if skip_nan:
+        # nan is the only value that differs from itself
+        for i in range(n):
+            if in_values[i] == in_values[i]:
+                out_values[factor_values[i]] += in_values[i]
     else:
-        factor_buffer = ca_factor.leftover_array
-    factor_chunk_row = 0
-    out_buffer = np.zeros(nr_groups, dtype='int32')
-
-    for input_chunk_nr in range(ca_input.nchunks):
-        # fill input buffer
-        input_chunk = ca_input.chunks[input_chunk_nr]
-        input_chunk._getitem(0, input_chunk_len, in_buffer.data)
-
-        # loop through rows
-        for i in range(input_chunk_len):
-
-            # go to next factor buffer if necessary
-            if factor_chunk_row == factor_chunk_len:
-                factor_chunk_nr += 1
-                if factor_chunk_nr < factor_total_chunks:
-                    factor_chunk = ca_factor.chunks[factor_chunk_nr]
-                    factor_chunk._getitem(0, factor_chunk_len, factor_buffer.data)
-                else:
-                    factor_buffer = ca_factor.leftover_array
-                factor_chunk_row = 0
-
-            # retrieve index
-            current_index = factor_buffer[factor_chunk_row]
-            factor_chunk_row += 1
-
-            # update value if it's not an invalid index
-            if current_index != skip_key:
-                out_buffer[current_index] += in_buffer[i]
-
-    leftover_elements = cython.cdiv(ca_input.leftover, ca_input.atomsize)
-    if leftover_elements > 0:
-        # fill input buffer
-        in_buffer = ca_input.leftover_array
-
-        # loop through rows
-        for i in range(leftover_elements):
-
-            # go to next factor buffer if necessary
-            if factor_chunk_row == factor_chunk_len:
-                factor_chunk_nr += 1
-                if factor_chunk_nr < factor_total_chunks:
-                    factor_chunk = ca_factor.chunks[factor_chunk_nr]
-                    factor_chunk._getitem(0, factor_chunk_len, factor_buffer.data)
-                else:
-                    factor_buffer = ca_factor.leftover_array
-                factor_chunk_row = 0
-
-            # retrieve index
-            current_index = factor_buffer[factor_chunk_row]
-            factor_chunk_row += 1
-
-            # update value if it's not an invalid index
-            if current_index != skip_key:
-                out_buffer[current_index] += in_buffer[i]
-
-    # check whether a row has to be removed if it was meant to be skipped
-    if skip_key < nr_groups:
-        np.delete(out_buffer, skip_key)
-
-    return out_buffer
+        for i in range(n):
+            out_values[factor_values[i]] += in_values[i]
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-cdef sum_int64(carray ca_input, carray ca_factor, Py_ssize_t nr_groups, Py_ssize_t skip_key):
+def _sum_kernel(ca_input, ca_factor,
+                ndarray[sum_t] in_buffer,
+                ndarray[factor_t] factor_buffer,
+                ndarray[sum_t] out_buffer,
+                bint skip_nan):
     cdef:
-        chunk input_chunk, factor_chunk
-        Py_ssize_t input_chunk_nr, input_chunk_len
-        Py_ssize_t factor_chunk_nr, factor_chunk_len, factor_chunk_row
-        Py_ssize_t current_index, i, factor_total_chunks, leftover_elements
-
-        ndarray[npy_int64] in_buffer
-        ndarray[npy_int64] factor_buffer
-        ndarray[npy_int64] out_buffer
+        Py_ssize_t start, stop, chunklen, n
+        ndarray in_rows, factor_rows
+        sum_t * in_values
+        factor_t * factor_values
+        sum_t * out_values
+
+    _check_factor_len(ca_factor, ca_input)
+    n = len(ca_input)
+    chunklen = ca_input.chunklen
+    out_values = <sum_t *> out_buffer.data
+
+    # walk over the chunks of the input, the factor rows are aligned when
+    # the factor carray was written with the chunklen of the input
+    start = 0
+    while start < n:
+        check_cancelled()
+        stop = min(start + chunklen, n)
+        in_rows = _read_rows(ca_input, start, stop, in_buffer)
+        factor_rows = _read_rows(ca_factor, start, stop, factor_buffer)
+        in_values = <sum_t *> in_rows.data
+        factor_values = <factor_t *> factor_rows.data
+
+        with nogil:
+            _sum_chunk(in_values, factor_values, out_values, stop - start,
+                       skip_nan)
+
+        start = stop
+
+cdef sum_values(ca_input, ca_factor, Py_ssize_t nr_groups,
+                bint skip_nan=False):
+    # the typed specialisation of the kernel is picked from the
+    # dtypes of the buffers; skip_nan leaves out nan values (sum_na)
+    out_buffer = np.zeros(nr_groups, dtype=ca_input.dtype)
+    _sum_kernel(ca_input, ca_factor,
+                np.empty(ca_input.chunklen, dtype=ca_input.dtype),
+                np.empty(ca_input.chunklen, dtype=ca_factor.dtype),
+                out_buffer, skip_nan)
 
-    count = 0
-    ret = 0
-    reverse = {}
+    return out_buffer
 
-    input_chunk_len = ca_input.chunklen
-    in_buffer = np.empty(input_chunk_len, dtype='int64')
-    factor_chunk_len = ca_factor.chunklen
-    factor_total_chunks = ca_factor.nchunks
-    factor_chunk_nr = 0
-    factor_buffer = np.empty(factor_chunk_len, dtype='int64')
-    if factor_total_chunks > 0:
-        factor_chunk = ca_factor.chunks[factor_chunk_nr]
-        factor_chunk._getitem(0, factor_chunk_len, factor_buffer.data)
+cdef ndarray _evaluate(expression, dict local_dict, ndarray out):
+    # evaluate the expression into the out buffer (numexpr is only
+    # imported once an expression is evaluated)
+    if bcolz.numexpr_here:
+        import numexpr
+        numexpr.evaluate(expression, local_dict=local_dict, out=out)
     else:
-        factor_buffer = ca_factor.leftover_array
-    factor_chunk_row = 0
-    out_buffer = np.zeros(nr_groups, dtype='int64')
-
-    for input_chunk_nr in range(ca_input.nchunks):
-        # fill input buffer
-        input_chunk = ca_input.chunks[input_chunk_nr]
-        input_chunk._getitem(0, input_chunk_len, in_buffer.data)
-
-        # loop through rows
-        for i in range(input_chunk_len):
-
-            # go to next factor buffer if necessary
-            if factor_chunk_row == factor_chunk_len:
-                factor_chunk_nr += 1
-                if factor_chunk_nr < factor_total_chunks:
-                    factor_chunk = ca_factor.chunks[factor_chunk_nr]
-                    factor_chunk._getitem(0, factor_chunk_len, factor_buffer.data)
-                else:
-                    factor_buffer = ca_factor.leftover_array
-                factor_chunk_row = 0
-
-            # retrieve index
-            current_index = factor_buffer[factor_chunk_row]
-            factor_chunk_row += 1
-
-            # update value if it's not an invalid index
-            if current_index != skip_key:
-                out_buffer[current_index] += in_buffer[i]
-
-    leftover_elements = cython.cdiv(ca_input.leftover, ca_input.atomsize)
-    if leftover_elements > 0:
-        # fill input buffer
-        in_buffer = ca_input.leftover_array
-
-        # loop through rows
-        for i in range(leftover_elements):
-
-            # go to next factor buffer if necessary
-            if factor_chunk_row == factor_chunk_len:
-                factor_chunk_nr += 1
-                if factor_chunk_nr < factor_total_chunks:
-                    factor_chunk = ca_factor.chunks[factor_chunk_nr]
-                    factor_chunk._getitem(0, factor_chunk_len, factor_buffer.data)
-                else:
-                    factor_buffer = ca_factor.leftover_array
-                factor_chunk_row = 0
-
-            # retrieve index
-            current_index = factor_buffer[factor_chunk_row]
-            factor_chunk_row += 1
-
-            # update value if it's not an invalid index
-            if current_index != skip_key:
-                out_buffer[current_index] += in_buffer[i]
-
-    # check whether a row has to be removed if it was meant to be skipped
-    if skip_key < nr_groups:
-        np.delete(out_buffer, skip_key)
-
-    return out_buffer
+        out[:] = eval(expression, {'__builtins__': {}}, local_dict)
+    return out
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-cdef groupby_value(carray ca_input, carray ca_factor, Py_ssize_t nr_groups, Py_ssize_t skip_key):
+def _sum_expression_kernel(expression, dict columns, ca_factor,
+                           ndarray[sum_t] in_buffer,
+                           ndarray[factor_t] factor_buffer,
+                           ndarray[sum_t] out_buffer,
+                           bint skip_nan):
     cdef:
-        chunk input_chunk, factor_chunk
-        Py_ssize_t input_chunk_nr, input_chunk_len
-        Py_ssize_t factor_chunk_nr, factor_chunk_len, factor_chunk_row
-        Py_ssize_t current_index, i, factor_total_chunks, leftover_elements
-
-        ndarray in_buffer
-        ndarray[npy_int64] factor_buffer
-        ndarray out_buffer
+        Py_ssize_t start, stop, block_len, n
+        ndarray in_rows, factor_rows
+        dict local_dict
+        sum_t * in_values
+        factor_t * factor_values
+        sum_t * out_values
+
+    for ca_input in columns.values():
+        _check_factor_len(ca_factor, ca_input)
+    n = len(ca_factor)
+    block_len = len(in_buffer)
+    out_values = <sum_t *> out_buffer.data
+
+    # walk over blocks of rows, evaluating the expression per block into
+    # the reusable in_buffer
+    start = 0
+    while start < n:
+        check_cancelled()
+        stop = min(start + block_len, n)
+        local_dict = {}
+        for name, ca_input in columns.items():
+            local_dict[name] = read_rows(ca_input, start, stop)
+        in_rows = _evaluate(expression, local_dict, in_buffer[:stop - start])
+        factor_rows = _read_rows(ca_factor, start, stop, factor_buffer)
+        in_values = <sum_t *> in_rows.data
+        factor_values = <factor_t *> factor_rows.data
+
+        with nogil:
+            _sum_chunk(in_values, factor_values, out_values, stop - start,
+                       skip_nan)
+
+        start = stop
+
+cdef sum_expression(ct_input, expression, ca_factor, Py_ssize_t nr_groups,
+                    bint skip_nan=False):
+    columns = {}
+    for col in ct_input.measure_cols(expression):
+        columns[col] = ct_input[col]
+    col_dtype = ct_input.measure_dtype(expression)
+    block_len = min([ca_input.chunklen for ca_input in columns.values()])
+
+    out_buffer = np.zeros(nr_groups, dtype=col_dtype)
+    _sum_expression_kernel(expression, columns, ca_factor,
+                           np.empty(block_len, dtype=col_dtype),
+                           np.empty(block_len, dtype=ca_factor.dtype),
+                           out_buffer, skip_nan)
 
-    count = 0
-    ret = 0
-    reverse = {}
+    return out_buffer
 
-    input_chunk_len = ca_input.chunklen
-    in_buffer = np.empty(input_chunk_len, dtype=ca_input.dtype)
-    factor_chunk_len = ca_factor.chunklen
-    factor_total_chunks = ca_factor.nchunks
-    factor_chunk_nr = 0
-    factor_buffer = np.empty(factor_chunk_len, dtype='int64')
-    if factor_total_chunks > 0:
-        factor_chunk = ca_factor.chunks[factor_chunk_nr]
-        factor_chunk._getitem(0, factor_chunk_len, factor_buffer.data)
-    else:
-        factor_buffer = ca_factor.leftover_array
-    factor_chunk_row = 0
+cdef groupby_value(ca_input, ca_factor, Py_ssize_t nr_groups):
+    cdef:
+        Py_ssize_t start, stop, chunklen, n
+        ndarray in_buffer, factor_buffer, in_rows, factor_rows
+
+    _check_factor_len(ca_factor, ca_input)
+    n = len(ca_input)
+    chunklen = source_chunklen(ca_input, source_chunklen(ca_factor))
+    in_buffer = np.empty(chunklen, dtype=ca_input.dtype)
+    factor_buffer = np.empty(chunklen, dtype=ca_factor.dtype)
     out_buffer = np.zeros(nr_groups, dtype=ca_input.dtype)
 
-    for input_chunk_nr in range(ca_input.nchunks):
+    start = 0
+    while start < n:
+        check_cancelled()
+        stop = min(start + chunklen, n)
+        in_rows = _read_rows(ca_input, start, stop, in_buffer)
+        factor_rows = _read_rows(ca_factor, start, stop, factor_buffer)
+        out_buffer[factor_rows[:stop - start]] = in_rows[:stop - start]
+        start = stop
 
-        # fill input buffer
-        input_chunk = ca_input.chunks[input_chunk_nr]
-        input_chunk._getitem(0, input_chunk_len, in_buffer.data)
+    return out_buffer
 
-        for i in range(input_chunk_len):
+def _measure_blocks(ct_input, col, ca_factor, ndarray in_buffer,
+                    ndarray factor_buffer):
+    # generate (start, stop, input rows, factor rows) per block of the
+    # measure, which is a column or an expression over columns
+    cdef Py_ssize_t start, stop, block_len, n
 
-            # go to next factor buffer if necessary
-            if factor_chunk_row == factor_chunk_len:
-                factor_chunk_nr += 1
-                if factor_chunk_nr < factor_total_chunks:
-                    factor_chunk = ca_factor.chunks[factor_chunk_nr]
-                    factor_chunk._getitem(0, factor_chunk_len, factor_buffer.data)
-                else:
-                    factor_buffer = ca_factor.leftover_array
-                factor_chunk_row = 0
+    if col in ct_input.names:
+        columns = {col: ct_input[col]}
+    else:
+        columns = {}
+        for measure_col in ct_input.measure_cols(col):
+            columns[measure_col] = ct_input[measure_col]
+
+    for ca_input in columns.values():
+        _check_factor_len(ca_factor, ca_input)
+    n = len(ca_factor)
+    block_len = len(in_buffer)
+    blocks = []
+    start = 0
+    while start < n:
+        check_cancelled()
+        stop = min(start + block_len, n)
+        if col in columns:
+            in_rows = _read_rows(columns[col], start, stop, in_buffer)
+        else:
+            local_dict = {}
+            for name, ca_input in columns.items():
+                local_dict[name] = read_rows(ca_input, start, stop)
+            in_rows = _evaluate(col, local_dict, in_buffer[:stop - start])
+        factor_rows = _read_rows(ca_factor, start, stop, factor_buffer)
+        yield start, stop, in_rows, factor_rows
+        start = stop
+
+cdef Py_ssize_t _measure_block_len(ct_input, col):
+    return min([ct_input[measure_col].chunklen
+                for measure_col in ct_input.measure_cols(col)])
 
-            # retrieve index
-            current_index = factor_buffer[factor_chunk_row]
-            factor_chunk_row += 1
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef inline void _scatter_chunk(sum_t * in_values,
+                                factor_t * factor_values,
+                                sum_t * out_values,
+                                npy_int64 * positions,
+                                Py_ssize_t n) nogil:
+    cdef Py_ssize_t i
 
-            # update value if it's not an invalid index
-            if current_index != skip_key:
-                out_buffer[current_index] = in_buffer[i]
+    for i in range(n):
+        out_values[positions[factor_values[i]]] = in_values[i]
+        positions[factor_values[i]] += 1
 
-    leftover_elements = cython.cdiv(ca_input.leftover, ca_input.atomsize)
-    if leftover_elements > 0:
-        in_buffer = ca_input.leftover_array
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def _scatter_block(ndarray in_rows, ndarray factor_rows,
+                   ndarray[sum_t] in_buffer,
+                   ndarray[factor_t] factor_buffer,
+                   ndarray[sum_t] out_buffer,
+                   ndarray[npy_int64] positions,
+                   Py_ssize_t n):
+    cdef:
+        sum_t * in_values
+        factor_t * factor_values
+        sum_t * out_values
+        npy_int64 * position_values
+
+    in_values = <sum_t *> in_rows.data
+    factor_values = <factor_t *> factor_rows.data
+    out_values = <sum_t *> out_buffer.data
+    position_values = <npy_int64 *> positions.data
+
+    with nogil:
+        _scatter_chunk(in_values, factor_values, out_values, position_values,
+                       n)
+
+def quantile_values(ct_input, col, ca_factor, Py_ssize_t nr_groups,
+                    qs, Py_ssize_t spill_bytes):
+    """
+    Return the exact quantiles qs of the measure col per group, as a list
+    of float64 arrays (nan for groups without rows); nan values are left
+    out, as in the approximate quantiles (see sketch_values)
+
+    The values are ordered by group with a counting sort over the factor:
+    a first pass counts the rows per group, a second pass scatters the
+    values to the segment of their group, then every segment is sorted.
+    When the values take more than spill_bytes they are scattered into a
+    memory mapped file in a temporary directory instead of memory.
+    """
+    cdef:
+        Py_ssize_t g, lo, hi, m, n
+        ndarray[npy_int64] starts
+        ndarray factor_rows, in_rows
+        double position, fraction
+
+    _check_measure_len(ct_input, col, ca_factor)
+    col_dtype = ct_input.measure_dtype(col)
+    block_len = _measure_block_len(ct_input, col)
+    in_buffer = np.empty(block_len, dtype=col_dtype)
+    factor_buffer = np.empty(block_len, dtype=ca_factor.dtype)
+    n = len(ca_factor)
+
+    # count the rows of every group
+    counts = np.zeros(nr_groups, dtype='int64')
+    for start in xrange(0, n, block_len):
+        check_cancelled()
+        stop = min(start + block_len, n)
+        factor_rows = _read_rows(ca_factor, start, stop, factor_buffer)
+        counts += np.bincount(factor_rows[:stop - start], minlength=nr_groups)
+    starts = np.zeros(nr_groups + 1, dtype='int64')
+    np.cumsum(counts, out=starts[1:])
+
+    spill_dir = None
+    try:
+        if n * col_dtype.itemsize > spill_bytes:
+            spill_dir = tempfile.mkdtemp(prefix='bquery-')
+            out_buffer = np.memmap(os.path.join(spill_dir, 'values'),
+                                   dtype=col_dtype, mode='w+', shape=(n,))
+        else:
+            out_buffer = np.empty(n, dtype=col_dtype)
+
+        # scatter the values to the segments of their groups
+        positions = starts[:nr_groups].copy()
+        for start, stop, in_rows, factor_rows in _measure_blocks(
+                ct_input, col, ca_factor, in_buffer, factor_buffer):
+            _scatter_block(in_rows, factor_rows, in_buffer, factor_buffer,
+                           out_buffer, positions, stop - start)
+
+        # sort every segment and interpolate linearly between the closest
+        # ranks (as numpy.percentile does); nan values sort last and are
+        # not counted
+        skip_nan = col_dtype.kind == 'f'
+        results = [np.empty(nr_groups, dtype='float64') for q in qs]
+        for g in range(nr_groups):
+            m = starts[g + 1] - starts[g]
+            segment = out_buffer[starts[g]:starts[g + 1]]
+            segment.sort()
+            if skip_nan:
+                m = np.count_nonzero(segment == segment)
+            for q, result in zip(qs, results):
+                if m == 0:
+                    result[g] = np.nan
+                    continue
+                position = q * (m - 1)
+                lo = <Py_ssize_t> position
+                hi = min(lo + 1, m - 1)
+                fraction = position - lo
+                result[g] = segment[lo] + (segment[hi] - segment[lo]) * fraction
+
+        return results
+
+    finally:
+        if spill_dir is not None:
+            del out_buffer
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+def sketch_values(ct_input, col, ca_factor, Py_ssize_t nr_groups,
+                  qs, sketch=None):
+    """
+    Return the approximate quantiles qs of the measure col per group, as
+    a list of float64 arrays, using a mergeable QuantileSketch
+
+    Every block of rows is added to the sketch (a new one when sketch is
+    None), so the sketch of a chunk or partition can be merged into the
+    sketch of others before the quantiles are taken.
+    """
+    if sketch is None:
+        from bquery.sketch import QuantileSketch
+        sketch = QuantileSketch()
+
+    col_dtype = ct_input.measure_dtype(col)
+    block_len = _measure_block_len(ct_input, col)
+    for start, stop, in_rows, factor_rows in _measure_blocks(
+            ct_input, col, ca_factor, np.empty(block_len, dtype=col_dtype),
+            np.empty(block_len, dtype=ca_factor.dtype)):
+        sketch.update(factor_rows[:stop - start], in_rows[:stop - start])
+
+    return [sketch.quantile(q, nr_groups) for q in qs]
+
+cdef _quantile_measures(ct_input, factor_carray, Py_ssize_t nr_groups,
+                        output_agg_ops, Py_ssize_t spill_bytes):
+    # compute all quantile measures, grouped by input and mode so that
+    # every input is ordered (or sketched) once
+    wanted = {}
+    for col, agg_op in output_agg_ops:
+        if isinstance(agg_op, tuple):
+            mode, q = agg_op
+            wanted.setdefault((col, mode), [])
+            if q not in wanted[(col, mode)]:
+                wanted[(col, mode)].append(q)
+
+    quantiles = {}
+    for (col, mode), qs in wanted.items():
+        if mode == 'quantile':
+            results = quantile_values(ct_input, col, factor_carray,
+                                      nr_groups, qs, spill_bytes)
+        else:
+            results = sketch_values(ct_input, col, factor_carray,
+                                    nr_groups, qs)
+        for q, result in zip(qs, results):
+            quantiles[(col, (mode, q))] = result
 
-        for i in range(leftover_elements):
+    return quantiles
 
-            # go to next factor buffer if necessary
-            if factor_chunk_row == factor_chunk_len:
-                factor_chunk_nr += 1
-                if factor_chunk_nr < factor_total_chunks:
-                    factor_chunk = ca_factor.chunks[factor_chunk_nr]
-                    factor_chunk._getitem(0, factor_chunk_len, factor_buffer.data)
-                else:
-                    factor_buffer = ca_factor.leftover_array
-                factor_chunk_row = 0
+def pivot_values(ct_input, col, row_factor, col_factor,
+                 Py_ssize_t nr_rows, Py_ssize_t nr_cols, bool_arr=None,
+                 bint skip_nan=False):
+    """
+    Sum the measure col into a dense nr_rows x nr_cols array, where the
+    cell of a row is given by its labels in row_factor and col_factor
+
+    Every block the two labels are combined to a cell number, which is fed
+    to the same kernel as the groupby sums (which leaves out nan values
+    with skip_nan). Rows that are false in bool_arr are summed into an
+    extra cell that is dropped.
+    """
+    cdef:
+        Py_ssize_t block_len, nr_cells
+        ndarray col_rows, cells
+
+    _check_measure_dtype(ct_input, col)
+    _check_factor_len(row_factor, col_factor)
+    if bool_arr is not None:
+        _check_factor_len(row_factor, bool_arr)
+    col_dtype = ct_input.measure_dtype(col)
+    block_len = _measure_block_len(ct_input, col)
+    nr_cells = nr_rows * nr_cols
+
+    in_buffer = np.empty(block_len, dtype=col_dtype)
+    factor_buffer = np.empty(block_len, dtype=row_factor.dtype)
+    col_buffer = np.empty(block_len, dtype=col_factor.dtype)
+    cell_buffer = np.empty(block_len, dtype='int64')
+    out_buffer = np.zeros(nr_cells + 1, dtype=col_dtype)
+
+    for start, stop, in_rows, row_rows in _measure_blocks(
+            ct_input, col, row_factor, in_buffer, factor_buffer):
+        col_rows = _read_rows(col_factor, start, stop, col_buffer)
+        cells = cell_buffer[:stop - start]
+        cells[:] = row_rows[:stop - start]
+        cells *= nr_cols
+        cells += col_rows[:stop - start]
+        if bool_arr is not None:
+            cells[~read_rows(bool_arr, start, stop)] = nr_cells
+        _sum_block(in_rows, cells, in_buffer, cell_buffer, out_buffer,
+                   stop - start, skip_nan)
+
+    return out_buffer[:nr_cells].reshape(nr_rows, nr_cols)
+
+cdef _check_measure_dtype(ct_input, col):
+    # the input is either a column or an expression over columns
+    col_dtype = ct_input.measure_dtype(col)
+    if col_dtype not in (np.float64, np.int64, np.int32):
+        raise NotImplementedError(
+            'Column dtype ({0}) not supported for aggregation yet '
+            '(only int32, int64 & float64)'.format(str(col_dtype)))
+    return col_dtype
+
+cdef _append_groups(ct_agg, npy_uint64 nr_groups, npy_uint64 skip_key,
+                    factor_carray, groupby_values, list measures):
+    total = []
 
-            # retrieve index
-            current_index = factor_buffer[factor_chunk_row]
-            factor_chunk_row += 1
+    for col_factor_carray, col_values in groupby_values:
+        col_labels = groupby_value(col_factor_carray, factor_carray, nr_groups)
+        total.append(col_values[col_labels])
 
-            # update value if it's not an invalid index
-            if current_index != skip_key:
-                out_buffer[current_index] = in_buffer[i]
+    total.extend(measures)
 
-    # check whether a row has to be fixed
+    # remove the group of the rows that were meant to be skipped
     if skip_key < nr_groups:
-        np.delete(out_buffer, skip_key)
+        total = [np.delete(values, skip_key) for values in total]
 
-    return out_buffer
+    # without an aggregation ctable the buffers are returned as they are
+    if ct_agg is not None:
+        ct_agg.append(total)
+
+    return total
 
 def aggregate_groups_by_iter_2(ct_input,
                         ct_agg,
                         npy_uint64 nr_groups,
                         npy_uint64 skip_key,
-                        carray factor_carray,
-                        groupby_cols,
+                        factor_carray,
+                        groupby_values,
                         output_agg_ops,
-                        dtype_list
+                        dtype_list,
+                        Py_ssize_t spill_bytes=256 * 2 ** 20
                         ):
-    total = []
+    """
+    groupby_values holds a (factor carray, values array) pair for every
+    groupby column; the group values are looked up through the labels of
+    the column, so no (possibly wide) column values need to be read
 
-    for col in groupby_cols:
-        total.append(groupby_value(ct_input[col], factor_carray, nr_groups, skip_key))
+    The aggregated arrays (groupby columns first) are appended to ct_agg
+    and returned; ct_agg can be None to only return them.
+
+    output_agg_ops holds an (input, agg_op) pair for every measure, where
+    agg_op is 'sum', 'sum_na' or a ('quantile' | 'approx_quantile', q)
+    tuple; spill_bytes is passed on to quantile_values
+    """
+    measures = []
+    quantiles = _quantile_measures(ct_input, factor_carray, nr_groups,
+                                   output_agg_ops, spill_bytes)
 
     for col, agg_op in output_agg_ops:
-        # TODO: input vs output column
-        col_dtype = ct_agg[col].dtype
-        if col_dtype == np.float64:
-            total.append(sum_float64(ct_input[col], factor_carray, nr_groups, skip_key))
-        elif col_dtype == np.int64:
-            total.append(sum_int64(ct_input[col], factor_carray, nr_groups, skip_key))
-        elif col_dtype == np.int32:
-            total.append(sum_int32(ct_input[col], factor_carray, nr_groups, skip_key))
+        _check_measure_dtype(ct_input, col)
+        if isinstance(agg_op, tuple):
+            measures.append(quantiles[(col, agg_op)])
+        elif col in ct_input.names:
+            measures.append(sum_values(ct_input[col], factor_carray, nr_groups,
+                                       agg_op == 'sum_na'))
         else:
-            raise NotImplementedError(
-                'Column dtype ({0}) not supported for aggregation yet '
-                '(only int32, int64 & float64)'.format(str(col_dtype)))
+            measures.append(sum_expression(ct_input, col, factor_carray,
+                                           nr_groups, agg_op == 'sum_na'))
+
+    return _append_groups(ct_agg, nr_groups, skip_key, factor_carray,
+                          groupby_values, measures)
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def _sum_block(ndarray in_rows, ndarray factor_rows,
+               ndarray[sum_t] in_buffer,
+               ndarray[factor_t] factor_buffer,
+               ndarray[sum_t] out_buffer,
+               Py_ssize_t n,
+               bint skip_nan):
+    # the buffers pick the typed specialisation, the rows can be read-only
+    # arrays of cached chunks
+    cdef:
+        sum_t * in_values
+        factor_t * factor_values
+        sum_t * out_values
 
-    ct_agg.append(total)
+    in_values = <sum_t *> in_rows.data
+    factor_values = <factor_t *> factor_rows.data
+    out_values = <sum_t *> out_buffer.data
+
+    with nogil:
+        _sum_chunk(in_values, factor_values, out_values, n, skip_nan)
+
+def aggregate_groups_many(ct_input, queries,
+                          Py_ssize_t spill_bytes=256 * 2 ** 20):
+    """
+    Aggregate several groupbys over ct_input in one shared scan
+
+    queries holds a (ct_agg, nr_groups, skip_key, factor_carray,
+    groupby_values, output_agg_ops) tuple for every groupby (see
+    aggregate_groups_by_iter_2). The union of the measure columns is read
+    block by block once and every block is summed into all queries, an
+    expression that occurs in several queries is evaluated once per block.
+    Quantile measures need their own passes (see quantile_values) and are
+    computed per query after the shared scan.
+
+    Returns the list of aggregated arrays of every query (see
+    aggregate_groups_by_iter_2).
+    """
+    cdef:
+        Py_ssize_t start, stop, block_len, n
+        ndarray in_rows, factor_rows
+
+    # plan the union of the columns needed by all queries
+    input_cols = set()
+    states = []
+    for ct_agg, nr_groups, skip_key, factor_carray, groupby_values, \
+            output_agg_ops in queries:
+        _check_factor_len(factor_carray, ct_input)
+        for col, agg_op in output_agg_ops:
+            _check_measure_dtype(ct_input, col)
+            if not isinstance(agg_op, tuple):
+                input_cols.update(ct_input.measure_cols(col))
+
+    if input_cols:
+        block_len = min([ct_input[col].chunklen for col in input_cols])
+    else:
+        block_len = min([source_chunklen(query[3]) for query in queries])
+
+    for ct_agg, nr_groups, skip_key, factor_carray, groupby_values, \
+            output_agg_ops in queries:
+        measures = []
+        for col, agg_op in output_agg_ops:
+            if isinstance(agg_op, tuple):
+                continue
+            col_dtype = ct_input.measure_dtype(col)
+            measures.append((col,
+                             np.empty(block_len, dtype=col_dtype),
+                             np.zeros(nr_groups, dtype=col_dtype),
+                             agg_op == 'sum_na'))
+        states.append(
+            (factor_carray,
+             np.empty(block_len, dtype=factor_carray.dtype),
+             measures))
+
+    # no scan is needed when there are only quantile measures
+    n = len(ct_input) if any([state[2] for state in states]) else 0
+    start = 0
+    while start < n:
+        check_cancelled()
+        stop = min(start + block_len, n)
+
+        # every column is decompressed once per block
+        local_dict = {}
+        for col in input_cols:
+            local_dict[col] = read_rows(ct_input[col], start, stop)
+        evaluated = {}
+
+        for factor_carray, factor_buffer, measures in states:
+            factor_rows = _read_rows(factor_carray, start, stop, factor_buffer)
+            for col, in_buffer, out_buffer, skip_nan in measures:
+                if col in local_dict:
+                    in_rows = local_dict[col]
+                elif col in evaluated:
+                    in_rows = evaluated[col]
+                else:
+                    in_rows = _evaluate(col, local_dict,
+                                        in_buffer[:stop - start])
+                    evaluated[col] = in_rows
+                _sum_block(in_rows, factor_rows, in_buffer, factor_buffer,
+                           out_buffer, stop - start, skip_nan)
+
+        start = stop
+
+    totals = []
+    for query, state in zip(queries, states):
+        ct_agg, nr_groups, skip_key, factor_carray, groupby_values, \
+            output_agg_ops = query
+        quantiles = _quantile_measures(ct_input, factor_carray, nr_groups,
+                                       output_agg_ops, spill_bytes)
+        sums = iter([out_buffer for _, _, out_buffer, _ in state[2]])
+        totals.append(_append_groups(ct_agg, nr_groups, skip_key, factor_carray,
+                       groupby_values,
+                       [quantiles[(col, agg_op)] if isinstance(agg_op, tuple)
+                        else next(sums)
+                        for col, agg_op in output_agg_ops]))
+
+    return totals
 
 # ---------------------------------------------------------------------------
 # Temporary Section
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef carray_is_in(carray col, set value_set, ndarray boolarr, bint reverse):
+cpdef carray_is_in(col, set value_set, ndarray boolarr, bint reverse,
+                   Py_ssize_t start=0):
     """
     TEMPORARY WORKAROUND till numexpr support in list operations
 
     Update a boolean array with checks whether the values of a column (col) are in a set (value_set)
     Reverse means "not in" functionality
+    The boolean array covers the rows of the column from start onwards
 
     For the 0d array work around, see https://github.com/Blosc/bcolz/issues/61
 
@@ -804,17 +1382,15 @@ cpdef carray_is_in(carray col, set value_set, ndarray boolarr, bint reverse):
     :param value_set:
     :param boolarr:
     :param reverse:
+    :param start:
     :return:
     """
-    cdef Py_ssize_t i
-    i = 0
-    if not reverse:
-        for val in col.iter():
-            if val not in value_set:
-                boolarr[i] = False
-            i += 1
-    else:
-        for val in col.iter():
-            if val in value_set:
-                boolarr[i] = False
-            i += 1
+    cdef:
+        Py_ssize_t n
+        ndarray in_rows, value_array
+
+    n = len(boolarr)
+    value_array = np.array(list(value_set))
+
+    in_rows = read_rows(col, start, start + n)
+    boolarr &= np.in1d(in_rows, value_array, invert=reverse)
@@ -0,0 +1,321 @@
+import Queue
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+from bcolz.ctable import ROOTDIRS
+
+import bquery
+from bquery.cache import file_stamp, stamp_scope
+# QueryCancelled and QueryTimeout are raised by the futures of cancelled
+# and timed out queries
+from bquery.cancel import CancelToken, QueryCancelled, QueryTimeout, set_token
+
+
+class QueryRejected(Exception):
+    """
+    Raised when a query is submitted to an engine that already has
+    max_pending queries queued or running
+    """
+    pass
+
+
+class QueryFuture(object):
+    """
+    The pending result of a query submitted to a QueryEngine
+
+    Callers can block on result(), or register a callback with
+    add_done_callback to hand the result over to an event loop.
+    """
+
+    def __init__(self, token):
+        self._token = token
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def cancel(self):
+        """
+        Cancel the query; a running query stops at its next chunk boundary
+
+        :return: False (without cancelling) if the query was already done
+        """
+        with self._lock:
+            if self.done():
+                return False
+            self._token.cancel()
+        return True
+
+    def cancelled(self):
+        return self._token.cancelled
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the query and return its result, or raise its exception
+
+        :param timeout: the seconds to wait (None to wait until done)
+        :return: :raise QueryCancelled: a cancelled or timed out query
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('The query is still running')
+        if self._exc_info is not None:
+            # re-raised with the traceback of the worker thread
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError('The query is still running')
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(future) once the query is done, from the worker thread (or
+        directly when it is done already)
+
+        :param fn:
+        :return:
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set_result(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+def table_stamp(ct):
+    """
+    Return the disk stamp of an on-disk ctable: the stamp of its list of
+    columns and the version stamp of every column (see column_stamp), which
+    changes when the table is flushed, also through another handle or by
+    another process
+
+    :param ct:
+    :return:
+    """
+    rootdirs = os.path.join(ct.rootdir, ROOTDIRS)
+    return file_stamp(rootdirs), ct.column_stamp(ct.names)
+
+
+class TablePool(object):
+    """
+    A pool of read-only ctables opened from disk, shared between queries
+
+    A handle is used by one query at a time: acquire returns an idle handle
+    of the rootdir or opens a new one, and release puts it back. At most
+    max_idle handles are kept, the least recently used are dropped first.
+
+    A handle keeps the length and columns it read when it was opened, so
+    every handle carries the disk stamp of the table at that time (see
+    table_stamp); an idle handle whose table was flushed since is dropped
+    and a new one is opened instead.
+    """
+
+    def __init__(self, max_idle=16):
+        self.max_idle = max_idle
+        self._idle = OrderedDict()
+        self._stamps = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, rootdir):
+        with self._lock:
+            handles = self._idle.get(rootdir)
+            if handles:
+                ct, stamp = handles.pop()
+                if not handles:
+                    del self._idle[rootdir]
+            else:
+                ct = None
+
+        if ct is None or table_stamp(ct) != stamp:
+            ct = bquery.open(rootdir, mode='r')
+            stamp = table_stamp(ct)
+        with self._lock:
+            self._stamps[id(ct)] = stamp
+        return ct
+
+    def release(self, rootdir, ct):
+        with self._lock:
+            stamp = self._stamps.pop(id(ct))
+            handles = self._idle.pop(rootdir, [])
+            handles.append((ct, stamp))
+            self._idle[rootdir] = handles
+            while len(self) > self.max_idle:
+                oldest = next(iter(self._idle))
+                self._idle[oldest].pop(0)
+                if not self._idle[oldest]:
+                    del self._idle[oldest]
+
+    def invalidate(self, rootdir):
+        """
+        Drop the idle handles of rootdir, i.e. after the ctable changed on
+        disk
+
+        :param rootdir:
+        :return:
+        """
+        with self._lock:
+            self._idle.pop(rootdir, None)
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+
+    def __len__(self):
+        return sum(len(handles) for handles in self._idle.values())
+
+
+class QueryEngine(object):
+    """
+    Run queries on on-disk ctables in a bounded pool of worker threads
+
+    Queries are submitted with a rootdir and return a QueryFuture at once,
+    so a service front-end never blocks on a query. Admission control
+    rejects new queries (QueryRejected) once max_pending queries are queued
+    or running. Every query can have a timeout and can be cancelled; the
+    kernels check for both at every chunk boundary (see bquery.cancel).
+    The aggregation loops run without the GIL, so queries on several
+    workers run in parallel.
+    """
+
+    def __init__(self, max_workers=4, max_pending=64, max_idle_tables=16,
+                 timeout=None):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.tables = TablePool(max_idle=max_idle_tables)
+        self._queue = Queue.Queue()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._workers = []
+        for _ in range(max_workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, rootdir, fn, *args, **kwargs):
+        """
+        Submit fn(ct, *args, **kwargs) on the ctable at rootdir
+
+        :param rootdir: the rootdir of the ctable
+        :param fn: the query, called with a read-only bquery ctable
+        :param timeout: (keyword) the seconds the query may take, counted
+         from its submission (default: the timeout of the engine)
+        :return: a QueryFuture :raise QueryRejected:
+        """
+        timeout = kwargs.pop('timeout', None)
+        if timeout is None:
+            timeout = self.timeout
+
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueryRejected(
+                    'The engine has {0} pending queries'.format(self._pending))
+            self._pending += 1
+
+        token = CancelToken(timeout=timeout)
+        future = QueryFuture(token)
+        self._queue.put((future, token, rootdir, fn, args, kwargs))
+        return future
+
+    def groupby(self, rootdir, groupby_cols, agg_list, where=None,
+                timeout=None, **kwargs):
+        """
+        Submit a groupby (see ctable.groupby) on the ctable at rootdir
+
+        :param rootdir:
+        :param groupby_cols:
+        :param agg_list:
+        :param where: a where_terms term list to filter the rows on
+        :param timeout: the seconds the query may take
+        :param kwargs: passed on to groupby (output, use_rollups, ...)
+        :return: a QueryFuture
+        """
+        return self.submit(rootdir, _groupby, groupby_cols, agg_list, where,
+                           timeout=timeout, **kwargs)
+
+    def where_terms(self, rootdir, term_list, timeout=None, **kwargs):
+        """
+        Submit a where_terms (see ctable.where_terms) on the ctable at
+        rootdir
+
+        :param rootdir:
+        :param term_list:
+        :param timeout: the seconds the query may take
+        :return: a QueryFuture
+        """
+        return self.submit(rootdir, _where_terms, term_list,
+                           timeout=timeout, **kwargs)
+
+    def pending(self):
+        return self._pending
+
+    def close(self, wait=True):
+        """
+        Stop the workers once the queued queries are done
+
+        :param wait: wait for the workers to stop
+        :return:
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+        self.tables.clear()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, token, rootdir, fn, args, kwargs = item
+
+            result, exc_info = None, None
+            try:
+                # a query can be cancelled (or time out) while it is queued
+                token.check()
+                set_token(token)
+                ct = self.tables.acquire(rootdir)
+                try:
+                    # the columns are stamped once for the whole query
+                    with stamp_scope():
+                        result = fn(ct, *args, **kwargs)
+                finally:
+                    self.tables.release(rootdir, ct)
+            except BaseException:
+                # also SystemExit or KeyboardInterrupt raised in a query,
+                # which would otherwise stop the worker and leave the future
+                # unresolved
+                exc_info = sys.exc_info()
+            finally:
+                set_token(None)
+
+            # the query no longer counts as pending once its result is seen
+            with self._lock:
+                self._pending -= 1
+            future._set_result(result, exc_info)
+
+
+def _groupby(ct, groupby_cols, agg_list, where, **kwargs):
+    bool_arr = ct.where_terms(where) if where else None
+    return ct.groupby(groupby_cols, agg_list, bool_arr=bool_arr, **kwargs)
+
+
+def _where_terms(ct, term_list, **kwargs):
+    return ct.where_terms(term_list, **kwargs)
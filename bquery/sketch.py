@@ -0,0 +1,114 @@
+import numpy as np
+
+# a value is counted in the bucket with the signed ordinal o, which is
+# 0 for zero, BUCKET_OFFSET + i for positive values in bucket i and
+# -(BUCKET_OFFSET + i) for negative values, so the ordinals sort like the
+# values; the ordinal is stored in the lowest ORDINAL_BITS of a key
+BUCKET_OFFSET = 2 ** 17
+ORDINAL_BITS = 19
+
+
+class QuantileSketch(object):
+    """
+    A mergeable sketch of the value distributions of many groups, for
+    approximate quantiles with a bounded relative error
+
+    Values are counted per group in logarithmic buckets (as in DDSketch),
+    so every quantile is within relative_accuracy of an exact value of the
+    group, and the memory is bounded by the number of buckets that are
+    actually used (e.g. ~600 per group for values between 1e-3 and 1e2).
+    Sketches of different chunks or partitions of a ctable merge by adding
+    the bucket counts, see merge(). NaN values are not counted.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self.keys = np.zeros(0, dtype='int64')
+        self.counts = np.zeros(0, dtype='int64')
+
+    def _ordinals(self, values):
+        values = np.asarray(values, dtype='float64')
+        ordinals = np.zeros(len(values), dtype='int64')
+        nonzero = values != 0
+        buckets = np.ceil(
+            np.log(np.abs(values[nonzero])) / np.log(self.gamma))
+        ordinals[nonzero] = \
+            np.sign(values[nonzero]).astype('int64') * \
+            (buckets.astype('int64') + BUCKET_OFFSET)
+        return ordinals
+
+    def _values(self, ordinals):
+        # the representative value of a bucket is within relative_accuracy
+        # of all values in the bucket
+        buckets = np.abs(ordinals) - BUCKET_OFFSET
+        values = 2.0 * self.gamma ** buckets / (self.gamma + 1.0)
+        values[ordinals == 0] = 0.0
+        return np.where(ordinals < 0, -values, values)
+
+    def _add(self, keys, counts):
+        keys = np.concatenate([self.keys, keys])
+        counts = np.concatenate([self.counts, counts])
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts,
+                                  minlength=len(self.keys)).astype('int64')
+
+    def update(self, groups, values):
+        """
+        Count values in the sketch of their group
+
+        :param groups: an array of (non-negative) group numbers
+        :param values: an array of values, as long as groups
+        :return:
+        """
+        values = np.asarray(values)
+        groups = np.asarray(groups, dtype='int64')
+        if values.dtype.kind == 'f':
+            valid = ~np.isnan(values)
+            values = values[valid]
+            groups = groups[valid]
+
+        keys = (groups << ORDINAL_BITS) + \
+            (self._ordinals(values) + 2 ** (ORDINAL_BITS - 1))
+        keys, counts = np.unique(keys, return_counts=True)
+        self._add(keys, counts)
+
+    def merge(self, other):
+        """
+        Add the counts of another sketch (with the same relative accuracy)
+
+        :param other:
+        :return:
+        """
+        if other.gamma != self.gamma:
+            raise ValueError('Only sketches with the same relative accuracy '
+                             'can be merged')
+        self._add(other.keys, other.counts)
+
+    def quantile(self, q, nr_groups):
+        """
+        Return the approximate q-quantile of every group (nan for groups
+        without values)
+
+        :param q: the quantile, between 0 and 1
+        :param nr_groups:
+        :return: a float64 array of nr_groups values
+        """
+        groups = self.keys >> ORDINAL_BITS
+        ordinals = (self.keys & (2 ** ORDINAL_BITS - 1)) - \
+            2 ** (ORDINAL_BITS - 1)
+
+        group_counts = np.bincount(groups, weights=self.counts,
+                                   minlength=nr_groups)[:nr_groups]
+        cumulative = np.cumsum(self.counts)
+        group_starts = np.concatenate([[0], np.cumsum(group_counts)[:-1]])
+
+        # the bucket that holds the value of rank q * (count - 1)
+        result = np.empty(nr_groups, dtype='float64')
+        result.fill(np.nan)
+        present = group_counts > 0
+        ranks = group_starts[present] + q * (group_counts[present] - 1)
+        positions = np.searchsorted(cumulative, ranks, side='right')
+        result[present] = self._values(ordinals[positions])
+
+        return result
@@ -0,0 +1,240 @@
+import bquery
+import os
+import tempfile
+import numpy as np
+import shutil
+import nose
+from numpy.testing import assert_array_equal
+from bquery.cache import LRUCache, filter_cache
+
+
+class TestCache():
+    def setup(self):
+        self.rootdir = None
+        bquery.chunk_cache.clear()
+        bquery.chunk_cache.reset_stats()
+        filter_cache.clear()
+        filter_cache.reset_stats()
+
+    def teardown(self):
+        if self.rootdir:
+            shutil.rmtree(self.rootdir)
+            if os.path.exists(self.rootdir + '.filters'):
+                shutil.rmtree(self.rootdir + '.filters')
+            self.rootdir = None
+
+    def test_lru_01(self):
+        """
+        test_lru_01: least recently used arrays are evicted first
+        """
+        cache = LRUCache(max_bytes=3 * 80)
+        for key in range(3):
+            cache.put(('col', key), np.zeros(10))
+        assert cache.get(('col', 0)) is not None
+
+        cache.put(('col', 3), np.zeros(10))
+
+        assert ('col', 0) in cache
+        assert ('col', 1) not in cache
+        assert cache.get(('col', 1)) is None
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 1
+        assert cache.stats()['evictions'] == 1
+        assert cache.stats()['nbytes'] == 3 * 80
+
+        cache.invalidate(('col',))
+        assert len(cache) == 0
+
+    def test_chunk_cache_01(self):
+        """
+        test_chunk_cache_01: repeated groupbys read the decompressed chunks
+                             from the chunk cache
+        """
+        iterable = ((x % 5, x) for x in range(100000))
+        data = np.fromiter(iterable, dtype='i8,i8')
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        ct = bquery.ctable(data, rootdir=self.rootdir)
+        ct.flush()
+        ct.cache_factor(['f0'], refresh=True)
+
+        result_1 = ct.groupby(['f0'], ['f1'])
+        stats = bquery.chunk_cache.stats()
+        assert stats['misses'] > 0
+
+        # no chunks are decompressed again
+        result_2 = ct.groupby(['f0'], ['f1'])
+        assert bquery.chunk_cache.stats()['misses'] == stats['misses']
+        assert bquery.chunk_cache.stats()['hits'] > stats['hits']
+        assert_array_equal(result_1, result_2)
+
+        # refreshing the factor cache drops its decompressed chunks
+        ct.cache_factor(['f0'], refresh=True)
+        assert_array_equal(result_1, ct.groupby(['f0'], ['f1']))
+
+    def test_chunk_cache_02(self):
+        """
+        test_chunk_cache_02: cached chunks are not read after the ctable
+                             was written
+        """
+        iterable = ((x % 3, x) for x in range(100000))
+        data = np.fromiter(iterable, dtype='i8,i8')
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        ct = bquery.ctable(data, rootdir=self.rootdir)
+        ct.flush()
+
+        def sums(ct):
+            return sorted(ct.groupby(['f0'], ['f1'], output='numpy').tolist())
+
+        def ref_sums(data):
+            return sorted((key, data['f1'][data['f0'] == key].sum())
+                          for key in np.unique(data['f0']))
+
+        assert sums(ct) == ref_sums(data)
+
+        # a column written directly, which is seen with its flush
+        ct['f1'][0:70000] = 5
+        ct['f1'].flush()
+        data['f1'][0:70000] = 5
+        assert sums(ct) == ref_sums(data)
+
+        # rows written through the ctable
+        ct[0:10] = (0, 1)
+        data[0:10] = (0, 1)
+        assert sums(ct) == ref_sums(data)
+
+        # the ctable rewritten at the same rootdir
+        data = np.fromiter(((x % 3, 2 * x) for x in range(100000)),
+                           dtype='i8,i8')
+        ct = bquery.ctable(data, rootdir=self.rootdir, mode='w')
+        ct.flush()
+        assert sums(ct) == ref_sums(data)
+
+    def test_chunk_cache_03(self):
+        """
+        test_chunk_cache_03: a query stamps every column once, not every
+                             chunk it reads
+        """
+        iterable = ((x % 5, x) for x in range(100000))
+        data = np.fromiter(iterable, dtype='i8,i8')
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        ct = bquery.ctable(data, rootdir=self.rootdir, chunklen=1000)
+        ct.flush()
+        ct.cache_factor(['f0'], refresh=True)
+        bool_arr = ct.where_terms([('f1', '>', 10)], cache=True)
+        ct.groupby(['f0'], ['f1'], bool_arr=bool_arr)
+
+        # the stamps of the query (two files per carray, see carray_stamp);
+        # the filter and the groupby make one query here, as in QueryEngine
+        stamped_paths = []
+        file_stamp = bquery.cache.file_stamp
+
+        def counting_file_stamp(path):
+            stamped_paths.append(path)
+            return file_stamp(path)
+
+        bquery.cache.file_stamp = counting_file_stamp
+        try:
+            with bquery.cache.stamp_scope():
+                bool_arr = ct.where_terms([('f1', '>', 10)], cache=True)
+                ct.groupby(['f0'], ['f1'], bool_arr=bool_arr)
+        finally:
+            bquery.cache.file_stamp = file_stamp
+        assert bquery.chunk_cache.stats()['hits'] >= 100
+        assert len(stamped_paths) == len(set(stamped_paths)) <= 4
+
+    def test_filter_cache_01(self):
+        """
+        test_filter_cache_01: cached term selections are reused and combined
+        """
+        iterable = ((x, x % 7) for x in range(100000))
+        data = np.fromiter(iterable, dtype='i8,i8')
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        ct = bquery.ctable(data, rootdir=self.rootdir)
+        ct.flush()
+
+        terms_1 = [('f0', '>', 500), ('f1', 'in', [1, 2, 3])]
+        terms_2 = [('f1', 'in', [3, 2, 1]), ('f0', '<', 90000)]
+        ref_1 = ct.where_terms(terms_1)
+        ref_2 = ct.where_terms(terms_2)
+
+        assert_array_equal(ct.where_terms(terms_1, cache=True), ref_1)
+        assert filter_cache.stats()['misses'] == 2
+
+        # the normalised in term is shared between both term lists
+        assert_array_equal(ct.where_terms(terms_2, cache=True), ref_2)
+        assert filter_cache.stats()['misses'] == 3
+        assert filter_cache.stats()['hits'] == 1
+
+        # appending rows changes the table version
+        ct.append(data[:10])
+        assert len(ct.where_terms(terms_1, cache=True)) == 100010
+        assert filter_cache.stats()['misses'] == 5
+
+        # the disk tier survives clearing the memory cache
+        assert_array_equal(ct.where_terms(terms_2, cache='disk')[:100000],
+                           ref_2)
+        filter_cache.clear()
+        filter_cache.reset_stats()
+        assert_array_equal(ct.where_terms(terms_2, cache='disk')[:100000],
+                           ref_2)
+        assert filter_cache.stats()['misses'] == 2
+        assert len(os.listdir(self.rootdir + '.filters')) == 2
+
+
+    def test_filter_cache_02(self):
+        """
+        test_filter_cache_02: cached selections follow writes to the table
+        """
+        terms = [('f1', 'in', [1, 2])]
+        data = np.fromiter(((x, x % 7) for x in range(50000)), dtype='i8,i8')
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        ct = bquery.ctable(data, rootdir=self.rootdir)
+        ct.flush()
+        assert_array_equal(ct.where_terms(terms, cache='disk'),
+                           np.in1d(data['f1'], [1, 2]))
+
+        # the returned selection is a copy
+        ct.where_terms(terms, cache=True)[:] = False
+        assert_array_equal(ct.where_terms(terms, cache=True),
+                           np.in1d(data['f1'], [1, 2]))
+
+        # a write that keeps the length, to a column (seen with its flush)
+        # and through the ctable
+        ct['f1'][0:100] = 1
+        ct['f1'].flush()
+        data['f1'][0:100] = 1
+        assert_array_equal(ct.where_terms(terms, cache=True),
+                           np.in1d(data['f1'], [1, 2]))
+        ct[100:200] = (0, 1)
+        data[100:200] = (0, 1)
+        assert_array_equal(ct.where_terms(terms, cache='disk'),
+                           np.in1d(data['f1'], [1, 2]))
+
+        # a rewrite at the same rootdir, from the disk tier
+        data = np.fromiter(((x, x % 5) for x in range(50000)), dtype='i8,i8')
+        ct = bquery.ctable(data, rootdir=self.rootdir, mode='w')
+        ct.flush()
+        filter_cache.clear()
+        assert_array_equal(ct.where_terms(terms, cache='disk'),
+                           np.in1d(data['f1'], [1, 2]))
+        # the selection of the old version was removed
+        term_dir = os.path.join(self.rootdir + '.filters',
+                                os.listdir(self.rootdir + '.filters')[0])
+        assert len(os.listdir(term_dir)) == 1
+
+        # in-memory tables are not cached
+        for i in range(4):
+            data = np.fromiter(((x, (x + i) % 7) for x in range(1000)),
+                               dtype='i8,i8')
+            ct = bquery.ctable(data)
+            assert_array_equal(ct.where_terms(terms, cache=True),
+                               np.in1d(data['f1'], [1, 2]))
+        assert len(filter_cache) == 1
+
+if __name__ == '__main__':
+    nose.main()
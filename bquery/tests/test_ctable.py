@@ -1,4 +1,6 @@
 import bquery
+import bcolz
+import glob
 import os
 import random
 import itertools
@@ -6,7 +8,7 @@ import tempfile
 import numpy as np
 import shutil
 import nose
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_equal, assert_allclose
 from nose.tools import assert_list_equal
 from nose.plugins.skip import SkipTest
 import itertools as itt
@@ -21,6 +23,9 @@ class TestCtable():
         print 'TestCtable.teardown'
         if self.rootdir:
             shutil.rmtree(self.rootdir)
+            # the rollups next to the rootdir
+            for rollup_rootdir in glob.glob(self.rootdir + '.rollup.*'):
+                shutil.rmtree(rollup_rootdir)
             self.rootdir = None
 
     def gen_almost_unique_row(self, N):
@@ -228,6 +233,733 @@ class TestCtable():
             sorted([list(x) for x in result_bcolz]),
             sorted(ref))
 
+    def test_groupby_05(self):
+        """
+        test_groupby_05: Test groupby with a bool_arr filter over chunk
+                         aligned and misaligned factor carrays
+        """
+        num_rows = 100000
+
+        # -- Data --
+        iterable = ((x % 7, x % 7, x) for x in range(num_rows))
+        data = np.fromiter(iterable, dtype='i8,i4,f8')
+
+        # -- Bcolz --
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        fact_bcolz = bquery.ctable(data, rootdir=self.rootdir)
+        fact_bcolz.flush()
+        fact_bcolz.cache_factor(['f0', 'f1'], refresh=True)
+
+        # the factor carrays are chunk-aligned with their source columns
+        factor_list, _ = fact_bcolz.factorize_groupby_cols(['f0', 'f1'])
+        assert factor_list[0].chunklen == fact_bcolz['f0'].chunklen
+        assert factor_list[1].chunklen == fact_bcolz['f1'].chunklen
+
+        mask = data['f0'] < 3
+        ref = [[key, data['f2'][mask & (data['f0'] == key)].sum()]
+               for key in range(3)]
+
+        bool_arr = fact_bcolz.where_terms([('f0', '<', 3)])
+        for col in ['f0', 'f1']:
+            result_bcolz = fact_bcolz.groupby([col], ['f2'],
+                                              bool_arr=bool_arr)
+            assert_list_equal(sorted([list(x) for x in result_bcolz]), ref)
+
+    def test_groupby_06(self):
+        """
+        test_groupby_06: Test groupby's aggregation of measure expressions
+        """
+        random.seed(1)
+
+        groupby_cols = ['f0']
+        agg_list = [['f4_f5', 'f4 - f5', 'sum'], ['f5_f6', 'f5 * f6']]
+        num_rows = 100000
+
+        # -- Data --
+        g = self.gen_almost_unique_row(num_rows)
+        data = np.fromiter(g, dtype='S1,f8,i8,i4,f8,i8,i4')
+
+        # -- Bcolz --
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        fact_bcolz = bquery.ctable(data, rootdir=self.rootdir)
+        fact_bcolz.flush()
+        fact_bcolz.cache_factor(groupby_cols, refresh=True)
+        result_bcolz = fact_bcolz.groupby(groupby_cols, agg_list)
+
+        assert result_bcolz['f4_f5'].dtype == np.float64
+        assert result_bcolz['f5_f6'].dtype == np.int64
+        for row in result_bcolz:
+            mask = data['f0'] == row[0]
+            np.testing.assert_allclose(
+                row[1], (data['f4'][mask] - data['f5'][mask]).sum())
+            assert row[2] == (data['f5'][mask] * data['f6'][mask]).sum()
+
+    def test_groupby_07(self):
+        """
+        test_groupby_07: Test groupby over key expressions, with and without
+                         a cached factorization
+        """
+        num_rows = 100000
+        day = 86400
+
+        # -- Data --
+        iterable = ((x, x * 997 % 1000 / 10.0, 1420070400 + x * 300)
+                    for x in range(num_rows))
+        data = np.fromiter(iterable, dtype='i8,f8,i8')
+
+        groupby_cols = ['f0 % 3', 'bin(f1, [25, 50, 75])']
+        keys = zip(data['f0'] % 3, np.digitize(data['f1'], [25, 50, 75]))
+        ref = {}
+        for key, value in zip(keys, data['f0']):
+            ref[key] = ref.get(key, 0) + value
+        ref = sorted([list(key) + [value] for key, value in ref.items()])
+
+        # -- Bcolz --
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        fact_bcolz = bquery.ctable(data, rootdir=self.rootdir)
+        fact_bcolz.flush()
+
+        result_bcolz = fact_bcolz.groupby(groupby_cols, ['f0'])
+        assert_list_equal(sorted([list(x) for x in result_bcolz]), ref)
+
+        fact_bcolz.cache_factor(groupby_cols, refresh=True)
+        assert os.path.exists(
+            fact_bcolz.key_rootdir(groupby_cols[0]) + '.factor')
+        result_bcolz = fact_bcolz.groupby(groupby_cols, ['f0'])
+        assert_list_equal(sorted([list(x) for x in result_bcolz]), ref)
+
+        # date truncation
+        result_bcolz = fact_bcolz.groupby(['trunc_month(f2)'], ['f0'])
+        months = data['f2'].astype('datetime64[s]').astype('datetime64[M]')
+        assert_array_equal(
+            result_bcolz['trunc_month_f2'],
+            np.unique(months).astype('datetime64[s]').astype('int64'))
+        result_bcolz = fact_bcolz.groupby(['floor(f2 / %d)' % day], ['f0'])
+        assert_array_equal(result_bcolz['floor_f2_%d' % day],
+                           np.unique(data['f2'] // day))
+
+    def test_groupby_08(self):
+        """
+        test_groupby_08: Test that key expressions can only use columns,
+                         operators and key functions
+        """
+        data = np.fromiter(((x % 5, x) for x in range(1000)), dtype='i8,i8')
+        ct = bquery.ctable(data)
+
+        for expression in ["__import__('os').getcwd()",
+                           "f0.__class__", "open('/etc/passwd')",
+                           "[x for x in f0]", "bin(f0, edges=[1])",
+                           "f0 + g0", "10 ** 10 ** 10"]:
+            try:
+                ct.groupby([expression], ['f1'])
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('Accepted ' + expression)
+
+        result = ct.groupby(['-f0 * 2'], ['f1'], output='numpy')
+        assert_array_equal(result['f0_2'], [0, -2, -4, -6, -8])
+
+        # expressions whose output names clash
+        nose.tools.assert_raises(ValueError, ct.groupby,
+                                 ['f0 % 3', 'f0 * 3'], ['f1'])
+        nose.tools.assert_raises(ValueError, ct.groupby_many,
+                                 [(['f0 % 3'], [['f0_3', 'f1']])])
+
+    def test_groupby_09(self):
+        """
+        test_groupby_09: Test that factor caches are extended on append
+        """
+        data = np.fromiter(((['a', 'b', 'c'][x % 3], x % 7, 1)
+                            for x in range(100000)), dtype='S1,i8,i8')
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        ct = bquery.ctable(data, rootdir=self.rootdir)
+        ct.flush()
+        ct.cache_factor(['f0', 'f1 % 2'])
+        ct.cache_factor(['f1'], storage='mmap')
+
+        def check(data):
+            ref = bquery.ctable(data)
+            for groupby_cols in [['f0'], ['f1'], ['f1 % 2'], ['f0', 'f1']]:
+                assert_list_equal(
+                    sorted(ct.groupby(groupby_cols, ['f2'])[:].tolist()),
+                    sorted(ref.groupby(groupby_cols, ['f2'])[:].tolist()))
+
+        new_data = data[:50000].copy()
+        new_data['f0'][:10] = 'd'
+        ct.append(new_data)
+        data = np.concatenate([data, new_data])
+        check(data)
+        assert len(np.load(ct['f1'].rootdir + '.factor.npy')) == len(data)
+
+        # more values than the labels of the cache can hold
+        new_data = data[:1000].copy()
+        new_data['f1'] = np.arange(1000)
+        ct.append(new_data)
+        data = np.concatenate([data, new_data])
+        check(data)
+        assert np.load(ct['f1'].rootdir + '.factor.npy').dtype == np.uint16
+
+        # rows appended without bquery leave the caches behind, they are
+        # factorized again with the next append
+        ct.flush()
+        bcolz_ct = bcolz.ctable(rootdir=self.rootdir, mode='a')
+        bcolz_ct.append(data[:3000])
+        bcolz_ct.flush()
+        ct = bquery.open(self.rootdir, mode='a')
+        ct.append(data[:2000])
+        data = np.concatenate([data, data[:3000], data[:2000]])
+        check(data)
+        assert len(np.load(ct['f1'].rootdir + '.factor.npy')) == len(data)
+
+    def test_groupby_10(self):
+        """
+        test_groupby_10: Test that factor caches follow a resize or trim,
+                         and that a factor of another length is refused
+        """
+        data = np.fromiter(((x % 7, 1) for x in range(100000)),
+                           dtype='i8,i8')
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        ct = bquery.ctable(data, rootdir=self.rootdir)
+        ct.flush()
+        ct.cache_factor(['f0'])
+        ct.cache_factor(['f0 % 2'], storage='mmap')
+
+        def check(data):
+            ref = bquery.ctable(data)
+            for groupby_cols in [['f0'], ['f0 % 2']]:
+                assert_list_equal(
+                    sorted(ct.groupby(groupby_cols, ['f1'])[:].tolist()),
+                    sorted(ref.groupby(groupby_cols, ['f1'])[:].tolist()))
+
+        ct.trim(30001)
+        data = data[:-30001]
+        check(data)
+        assert len(bcolz.carray(rootdir=ct['f0'].rootdir + '.factor')) == \
+            len(data)
+
+        ct.resize(80000)
+        data = np.concatenate([data, np.zeros(80000 - len(data),
+                                              dtype=data.dtype)])
+        check(data)
+
+        factor = bcolz.carray(np.zeros(len(data) - 1, dtype='int64'))
+        nose.tools.assert_raises(
+            ValueError, bquery.ctable_ext.aggregate_groups_by_iter_2,
+            ct, None, 1, 1, factor, [], [('f1', 'sum')], [])
+
+    def test_groupby_many_01(self):
+        """
+        test_groupby_many_01: Test several groupbys over one shared scan
+        """
+        num_rows = 20000
+
+        # -- Data --
+        iterable = ((x % 7, x % 13, x, x * 0.5) for x in range(num_rows))
+        data = np.fromiter(iterable, dtype='i8,i8,i8,f8')
+
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        fact_bcolz = bquery.ctable(data, rootdir=self.rootdir)
+        fact_bcolz.flush()
+        fact_bcolz.cache_factor(['f0'], refresh=True)
+
+        bool_arr = fact_bcolz.where_terms([('f2', '<', 5000)])
+        specs = [
+            (['f0'], ['f2', 'f3']),
+            (['f0', 'f1'], [['f3_sum', 'f3', 'sum'], ['f4', 'f2 * f3']]),
+            {'groupby_cols': ['f1'], 'agg_list': [['f4', 'f2 * f3']],
+             'bool_arr': bool_arr},
+        ]
+
+        results = fact_bcolz.groupby_many(specs)
+        assert len(results) == len(specs)
+
+        for spec, result in zip(specs, results):
+            if isinstance(spec, dict):
+                ref = fact_bcolz.groupby(spec['groupby_cols'],
+                                         spec['agg_list'],
+                                         bool_arr=spec['bool_arr'])
+            else:
+                ref = fact_bcolz.groupby(*spec)
+            assert_list_equal(sorted([list(x) for x in result]),
+                              sorted([list(x) for x in ref]))
+
+    def test_groupby_quantile_01(self):
+        """
+        test_groupby_quantile_01: Test exact and approximate quantiles
+        """
+        num_rows = 30000
+        random.seed(1)
+
+        # -- Data --
+        iterable = ((x % 5, random.randint(-500, 5000), random.random() * 100)
+                    for x in range(num_rows))
+        data = np.fromiter(iterable, dtype='i8,i8,f8')
+
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        fact_bcolz = bquery.ctable(data, rootdir=self.rootdir)
+        fact_bcolz.flush()
+
+        agg_list = [['med', 'f1', 'median'],
+                    ['q90', 'f2', 'quantile', 0.9],
+                    ['p10', 'f1 * 2', 'percentile', 10]]
+        ref = [[g,
+                np.median(data['f1'][data['f0'] == g]),
+                np.percentile(data['f2'][data['f0'] == g], 90),
+                np.percentile(data['f1'][data['f0'] == g] * 2, 10)]
+               for g in range(5)]
+
+        result_bcolz = fact_bcolz.groupby(['f0'], agg_list)
+        result = sorted([list(x) for x in result_bcolz])
+        assert_allclose(np.array(result), np.array(ref))
+
+        # spill the ordered values to disk
+        fact_bcolz.quantile_spill_bytes = 1024
+        result_bcolz = fact_bcolz.groupby(['f0'], agg_list)
+        result = sorted([list(x) for x in result_bcolz])
+        assert_allclose(np.array(result), np.array(ref))
+
+        # approximate quantiles are within 1% of the value at the rank
+        # (without interpolation)
+        ref = [[g,
+                np.percentile(data['f1'][data['f0'] == g], 50,
+                              interpolation='lower'),
+                np.percentile(data['f2'][data['f0'] == g], 90,
+                              interpolation='lower'),
+                np.percentile(data['f1'][data['f0'] == g] * 2, 10,
+                              interpolation='lower')]
+               for g in range(5)]
+        approx_list = [['med', 'f1', 'approx_median'],
+                       ['q90', 'f2', 'approx_quantile', 0.9],
+                       ['p10', 'f1 * 2', 'approx_percentile', 10]]
+        result_bcolz = fact_bcolz.groupby(['f0'], approx_list)
+        result = np.array(sorted([list(x) for x in result_bcolz]))
+        assert np.all(np.abs(result - np.array(ref)) <=
+                      0.01 * np.abs(np.array(ref)) + 1e-9)
+
+        # nan values are left out of both, a group of only nan has none
+        data = np.array([(0, 1.0), (0, np.nan), (0, 3.0), (0, np.nan),
+                         (1, np.nan)], dtype='i8,f8')
+        fact_bcolz = bquery.ctable(data)
+        for agg_op in ['median', 'approx_median']:
+            result = sorted(fact_bcolz.groupby(
+                ['f0'], [['med', 'f1', agg_op]])[:].tolist())
+            # the sketch gives the lower rank, within 1%
+            assert_allclose(result[0][1],
+                            2.0 if agg_op == 'median' else 1.0, rtol=0.01)
+            assert np.isnan(result[1][1])
+
+    def test_groupby_output_01(self):
+        """
+        test_groupby_output_01: Test the numpy and pandas output of groupby
+        """
+        groupby_cols = ['f0']
+        agg_list = ['f4', ['f5_sum', 'f5', 'sum']]
+        num_rows = 2000
+
+        # -- Data --
+        g = self.gen_almost_unique_row(num_rows)
+        data = np.fromiter(g, dtype='S1,f8,i8,i4,f8,i8,i4')
+
+        # -- Bcolz --
+        fact_bcolz = bquery.ctable(data)
+        ref = fact_bcolz.groupby(groupby_cols, agg_list)[:]
+
+        result_numpy = fact_bcolz.groupby(groupby_cols, agg_list,
+                                          output='numpy')
+        assert isinstance(result_numpy, np.ndarray)
+        assert_array_equal(result_numpy, ref)
+
+        try:
+            import pandas
+        except ImportError:
+            raise SkipTest('pandas is not installed')
+
+        result_pandas = fact_bcolz.groupby(groupby_cols, agg_list,
+                                           output='pandas')
+        assert_list_equal(list(result_pandas.columns), list(ref.dtype.names))
+        assert_array_equal(result_pandas.to_records(index=False), ref)
+
+    def test_transform_01(self):
+        """
+        test_transform_01: Test broadcasting group aggregates to the rows
+        """
+        num_rows = 10000
+
+        # -- Data --
+        iterable = ((x % 7, x % 3, x, x * 0.5) for x in range(num_rows))
+        data = np.fromiter(iterable, dtype='i8,i8,i8,f8')
+        fact_bcolz = bquery.ctable(data, chunklen=1000)
+
+        sums = {}
+        for g0, g1, value in zip(data['f0'], data['f1'], data['f2']):
+            sums[(g0, g1)] = sums.get((g0, g1), 0) + value
+        ref = np.array([sums[(g0, g1)]
+                        for g0, g1 in zip(data['f0'], data['f1'])])
+
+        result = fact_bcolz.transform(['f0', 'f1'],
+                                      [['group_f2', 'f2', 'sum'],
+                                       ['group_f3', 'f3', 'median']])
+        assert len(result) == num_rows
+        assert_list_equal(list(result.names), ['group_f2', 'group_f3'])
+        assert_array_equal(result['group_f2'][:], ref)
+
+        # rows outside of the filter get no aggregate
+        bool_arr = fact_bcolz.where_terms([('f2', '<', 5000)])
+        result = fact_bcolz.transform(['f0'], ['f3'], bool_arr=bool_arr)
+        sums = np.bincount(data['f0'][:5000], weights=data['f3'][:5000])
+        assert_array_equal(result['f3'][:5000], sums[data['f0'][:5000]])
+        assert np.all(np.isnan(result['f3'][5000:]))
+
+    def test_open_lazy_01(self):
+        """
+        test_open_lazy_01: Test that on-disk columns are opened on first use
+        """
+        dtype = [('f%d' % i, 'i8' if i % 2 else 'f8') for i in range(50)]
+        data = np.zeros(1000, dtype=dtype)
+        data['f1'] = np.arange(1000) % 10
+        data['f2'] = 1.5
+
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        bquery.ctable(data, rootdir=self.rootdir).flush()
+
+        fact_bcolz = bquery.open(self.rootdir)
+        # only the first column is opened, for the length
+        assert len(fact_bcolz.cols.opened()) == 1
+        assert len(fact_bcolz) == 1000
+        assert fact_bcolz.dtype == np.dtype(dtype)
+
+        result_bcolz = fact_bcolz.groupby(['f1'], ['f2'])
+        assert_list_equal(sorted([list(x) for x in result_bcolz]),
+                          [[x, 150.0] for x in range(10)])
+        assert_list_equal([col.rootdir for col in fact_bcolz.cols.opened()],
+                          [os.path.join(self.rootdir, name)
+                           for name in ['f0', 'f1', 'f2']])
+
+        assert_array_equal(fact_bcolz[5:10], data[5:10])
+
+    def test_pivot_01(self):
+        """
+        test_pivot_01: Test a dense cross table of two columns
+        """
+        num_rows = 10000
+
+        # -- Data --
+        iterable = ((['b', 'a', 'c'][x % 3], x % 4, x, x * 0.5)
+                    for x in range(num_rows))
+        data = np.fromiter(iterable, dtype='S1,i8,i8,f8')
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        fact_bcolz = bquery.ctable(data, rootdir=self.rootdir, chunklen=1000)
+        fact_bcolz.flush()
+        fact_bcolz.cache_factor(['f0'])
+
+        ref = np.zeros((3, 4))
+        for row, col, value in zip(data['f0'], data['f1'], data['f3']):
+            ref['abc'.index(row), col] += value
+
+        result = fact_bcolz.pivot('f0', 'f1', 'f3')
+        assert_list_equal(list(result.row_values), ['a', 'b', 'c'])
+        assert_list_equal(list(result.col_values), [0, 1, 2, 3])
+        assert_array_equal(result.values, ref)
+
+        # expressions and filters
+        bool_arr = fact_bcolz.where_terms([('f2', '<', 5000)])
+        result = fact_bcolz.pivot('f1', 'f0', 'f2 * 2', bool_arr=bool_arr)
+        ref = np.zeros((4, 3), dtype='int64')
+        for row, col, value in zip(data['f1'], data['f0'], data['f2']):
+            if value < 5000:
+                ref[row, 'abc'.index(col)] += value * 2
+        assert_array_equal(result.values, ref)
+
+        # wide ctable
+        result_bcolz = fact_bcolz.pivot('f0', 'f1', 'f3', output='ctable')
+        assert_list_equal(list(result_bcolz.names),
+                          ['f0', 'f1_0', 'f1_1', 'f1_2', 'f1_3'])
+        assert_array_equal(result_bcolz['f1_2'][:],
+                           fact_bcolz.pivot('f0', 'f1', 'f3').values[:, 2])
+
+    def test_pivot_02(self):
+        """
+        test_pivot_02: Test wide pivot column names of values that normalise
+                       to the same name, and sum_na in pivots and groupbys
+        """
+        data = np.array([(0, -1, 1.0), (0, 1, 2.0), (1, 1, np.nan),
+                         (1, -1, 4.0), (0, 2, np.nan)],
+                        dtype=[('f0', 'i8'), ('f1', 'i8'), ('f2', 'f8')])
+        ct = bquery.ctable(data)
+
+        result = ct.pivot('f0', 'f1', 'f2', op='sum_na', output='ctable')
+        assert_list_equal(result.names, ['f0', 'f1__1', 'f1_1', 'f1_2'])
+        assert_array_equal(result['f1__1'], [1.0, 4.0])
+        assert_array_equal(result['f1_1'], [2.0, 0.0])
+        assert_array_equal(result['f1_2'], [0.0, 0.0])
+
+        result = ct.pivot('f0', 'f1', 'f2')
+        assert np.isnan(result.values[1, 1])
+
+        # sum_na means the same in a groupby
+        agg_list = [['na', 'f2', 'sum_na'], ['sum', 'f2', 'sum'],
+                    ['na2', 'f2 * 2', 'sum_na']]
+        for result in [ct.groupby(['f0'], agg_list),
+                       ct.groupby_many([(['f0'], agg_list)])[0]]:
+            assert_array_equal(result['na'], [3.0, 4.0])
+            assert np.all(np.isnan(result['sum']))
+            assert_array_equal(result['na2'], [6.0, 8.0])
+
+        data = np.array([(0, 'a b'), (1, 'a_b')],
+                        dtype=[('f0', 'i8'), ('f1', 'S3')])
+        result = bquery.ctable(data).pivot('f1', 'f1', 'f0', output='ctable')
+        assert_list_equal(result.names, ['f1', 'f1_a_b', 'f1_a_b_1'])
+
+    def test_factor_cache_mmap_01(self):
+        """
+        test_factor_cache_mmap_01: Test memory mapped factor caches
+        """
+        num_rows = 20000
+
+        # -- Data --
+        iterable = ((['b', 'a', 'c'][x % 3], x % 4, x, x * 0.5)
+                    for x in range(num_rows))
+        data = np.fromiter(iterable, dtype='S1,i8,i8,f8')
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        fact_bcolz = bquery.ctable(data, rootdir=self.rootdir, chunklen=1000)
+        fact_bcolz.flush()
+
+        bool_arr = fact_bcolz.where_terms([('f2', '<', 15000)])
+        ref_1 = sorted(fact_bcolz.groupby(['f0'], ['f2', 'f3'])[:].tolist())
+        ref_2 = sorted(fact_bcolz.groupby(['f0', 'f1'], ['f2'],
+                                          bool_arr=bool_arr)[:].tolist())
+
+        fact_bcolz.cache_factor(['f0', 'f1'], storage={'f0': 'mmap'})
+        f0_rootdir = fact_bcolz['f0'].rootdir
+        assert os.path.exists(f0_rootdir + '.factor.npy')
+        assert os.path.exists(f0_rootdir + '.values.npy')
+        assert not os.path.exists(f0_rootdir + '.factor')
+        assert os.path.exists(fact_bcolz['f1'].rootdir + '.factor')
+
+        factor_list, values_list = fact_bcolz.factorize_groupby_cols(['f0'])
+        assert isinstance(factor_list[0], np.memmap)
+        assert factor_list[0].dtype == np.uint8
+
+        assert_list_equal(
+            sorted(fact_bcolz.groupby(['f0'], ['f2', 'f3'])[:].tolist()),
+            ref_1)
+        assert_list_equal(
+            sorted(fact_bcolz.groupby(['f0', 'f1'], ['f2'],
+                                      bool_arr=bool_arr)[:].tolist()),
+            ref_2)
+
+        # switching back to compressed storage removes the flat files
+        fact_bcolz.cache_factor(['f0'])
+        assert not os.path.exists(f0_rootdir + '.factor.npy')
+        assert_list_equal(
+            sorted(fact_bcolz.groupby(['f0'], ['f2', 'f3'])[:].tolist()),
+            ref_1)
+
+    def test_groupby_range_01(self):
+        """
+        test_groupby_range_01: Test groupby and where_terms over row ranges
+        """
+        num_rows = 20000
+
+        # -- Data --
+        iterable = ((['b', 'a', 'c', 'd'][(x // 7) % 4], x % 5, x, x * 0.5)
+                    for x in range(num_rows))
+        data = np.fromiter(iterable, dtype='S1,i8,i8,f8')
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        fact_bcolz = bquery.ctable(data, rootdir=self.rootdir, chunklen=1000)
+        fact_bcolz.flush()
+
+        ranges = [(2500, 2510), (7999, 12001), (-300, None)]
+        rows = np.concatenate([data[start:stop] for start, stop in ranges])
+        ref_bcolz = bquery.ctable(rows)
+
+        def check(**kwargs):
+            ref_bool = ref_bcolz.where_terms([('f1', 'in', [1, 3])])
+            bool_arr = fact_bcolz.where_terms([('f1', 'in', [1, 3])],
+                                              **kwargs)
+            assert_array_equal(bool_arr[:], ref_bool[:])
+            for groupby_cols in [['f0'], ['f0', 'f1'], ['f1 % 2']]:
+                ref = sorted(ref_bcolz.groupby(
+                    groupby_cols, ['f2', 'f3'], bool_arr=ref_bool)[:].tolist())
+                result = fact_bcolz.groupby(
+                    groupby_cols, ['f2', 'f3'], bool_arr=bool_arr,
+                    bool_arr_rows='ranges', **kwargs)
+                assert_list_equal(sorted(result[:].tolist()), ref)
+
+        check(ranges=ranges)
+        fact_bcolz.cache_factor(['f0', 'f1 % 2'])
+        fact_bcolz.cache_factor(['f1'], storage='mmap')
+        check(ranges=ranges)
+
+        # start/stop, with a selection over all rows of the ctable
+        ref = sorted(bquery.ctable(data[3000:4500]).groupby(
+            ['f0'], ['f2'])[:].tolist())
+        bool_arr = fact_bcolz.where_terms([('f2', '>=', 0)])
+        result = fact_bcolz.groupby(['f0'], ['f2'], bool_arr=bool_arr,
+                                    start=3000, stop=4500)
+        assert_list_equal(sorted(result[:].tolist()), ref)
+        # the selection has to have the rows bool_arr_rows asks for
+        nose.tools.assert_raises(
+            ValueError, fact_bcolz.groupby, ['f0'], ['f2'],
+            bool_arr=bool_arr, start=3000, stop=4500, bool_arr_rows='ranges')
+        nose.tools.assert_raises(
+            ValueError, fact_bcolz.groupby, ['f0'], ['f2'],
+            bool_arr=bool_arr[:1500], start=3000, stop=4500)
+
+        # groupby_many aggregates specs with a row selection separately
+        results = fact_bcolz.groupby_many([
+            {'groupby_cols': ['f0'], 'agg_list': ['f2'], 'start': 3000,
+             'stop': 4500},
+            (['f0'], ['f2'])])
+        assert_list_equal(sorted(results[0][:].tolist()), ref)
+        assert_list_equal(
+            sorted(results[1][:].tolist()),
+            sorted(bquery.ctable(data).groupby(['f0'], ['f2'])[:].tolist()))
+        try:
+            fact_bcolz.groupby_many([{'groupby_cols': ['f0'],
+                                      'agg_list': ['f2'], 'strat': 3000}])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('Accepted an unknown spec key')
+        nose.tools.assert_raises(ValueError, fact_bcolz.groupby_many,
+                                 [(['f0'], ['f2'], bool_arr)])
+
+    def test_cparams_01(self):
+        """
+        test_cparams_01: Test the compression of factor caches and groupby
+                         output
+        """
+        num_rows = 20000
+
+        # -- Data --
+        iterable = ((['b', 'a', 'c'][x % 3], x % 4, x, x * 0.5)
+                    for x in range(num_rows))
+        data = np.fromiter(iterable, dtype='S1,i8,i8,f8')
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        fact_bcolz = bquery.ctable(data, rootdir=self.rootdir, chunklen=1000)
+        fact_bcolz.flush()
+
+        ref = sorted(fact_bcolz.groupby(['f0', 'f1'], ['f2', 'f3'])[:].tolist())
+
+        fact_bcolz.cache_factor(['f0'], cparams={'cname': 'zlib', 'clevel': 9})
+        fact_bcolz.cache_factor(['f1'], cparams='auto')
+        f0_factor = bcolz.carray(rootdir=fact_bcolz['f0'].rootdir + '.factor')
+        # (bcolz does not store the codec in the carray metadata)
+        assert f0_factor.attrs['cparams']['cname'] == 'zlib'
+        assert f0_factor.attrs['cparams']['clevel'] == 9
+        assert not f0_factor.attrs['cparams']['auto']
+        f1_factor = bcolz.carray(rootdir=fact_bcolz['f1'].rootdir + '.factor')
+        meta = f1_factor.attrs['cparams']
+        assert meta['auto']
+        assert meta['chunklen'] == fact_bcolz['f1'].chunklen
+        assert f1_factor.cparams.shuffle == meta['shuffle']
+        assert_array_equal(f1_factor[:], data['f1'])
+
+        result = fact_bcolz.groupby(['f0', 'f1'], ['f2', 'f3'],
+                                    cparams=bcolz.cparams(cname='lz4'))
+        assert_list_equal(sorted(result[:].tolist()), ref)
+        assert result['f2'].cparams.cname == 'lz4'
+
+        result = fact_bcolz.groupby(['f0', 'f1'], ['f2', 'f3'],
+                                    cparams='auto')
+        assert_list_equal(sorted(result[:].tolist()), ref)
+        # the tiny output is stored in one chunk
+        assert result.attrs['cparams']['auto']
+        assert result['f2'].chunklen == len(result)
+
+    def test_groupby_lookup_01(self):
+        """
+        test_groupby_lookup_01: Test groupby over an attribute of a
+                                dimension ctable
+        """
+        num_rows = 50000
+
+        # -- Data --
+        iterable = ((x % 11, x) for x in range(num_rows))
+        data = np.fromiter(iterable, dtype='i8,i8')
+        # product 10 has no dimension row
+        dim_data = np.array([(p, 'cat%d' % (p % 3)) for p in range(10)],
+                            dtype=[('product', 'i4'), ('category', 'S4')])
+
+        ref = {}
+        for product, sales in data:
+            category = dim_data['category'][product] if product < 10 else ''
+            ref[category] = ref.get(category, 0) + sales
+        ref = sorted([list(x) for x in ref.items()])
+
+        # -- Bcolz --
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        fact_bcolz = bquery.ctable(data, rootdir=self.rootdir)
+        fact_bcolz.flush()
+        dim_bcolz = bquery.ctable(dim_data)
+        fact_bcolz.add_lookup('f0', dim_bcolz, 'product', ['category'])
+
+        result_bcolz = fact_bcolz.groupby(['category'], ['f1'])
+        assert_list_equal(sorted([list(x) for x in result_bcolz]), ref)
+
+        # a cached key column only needs its values to be matched
+        fact_bcolz.cache_factor(['f0'], refresh=True)
+        result_bcolz = fact_bcolz.groupby(['category'], ['f1'])
+        assert_list_equal(sorted([list(x) for x in result_bcolz]), ref)
+
+    def test_groupby_lookup_02(self):
+        """
+        test_groupby_lookup_02: Test lookups of keys without a dimension row
+                                when the default value is an attribute value
+        """
+        data = np.fromiter(((x % 4, 1) for x in range(1000)), dtype='i8,i8')
+        # product 3 has no dimension row, product 0 has category ''
+        dim_data = np.array([(0, ''), (1, 'a'), (2, 'a')],
+                            dtype=[('product', 'i4'), ('category', 'S4')])
+        fact_bcolz = bquery.ctable(data)
+        dim_bcolz = bquery.ctable(dim_data)
+
+        fact_bcolz.add_lookup('f0', dim_bcolz, 'product', ['category'])
+        try:
+            fact_bcolz.groupby(['category'], ['f1'])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('Missing keys joined the group of \'\'')
+
+        fact_bcolz.add_lookup('f0', dim_bcolz, 'product', ['category'],
+                              missing='none')
+        result = fact_bcolz.groupby(['category'], ['f1'], output='numpy')
+        assert_list_equal(sorted(result.tolist()),
+                          [('', 250), ('a', 500), ('none', 250)])
+
+        fact_bcolz.add_lookup('f0', dim_bcolz, 'product', ['category'],
+                              missing='a')
+        result = fact_bcolz.groupby(['category'], ['f1'], output='numpy')
+        assert_list_equal(sorted(result.tolist()), [('', 250), ('a', 750)])
+
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        fact_bcolz = bquery.ctable(data, rootdir=self.rootdir)
+        fact_bcolz.add_lookup('f0', dim_bcolz, 'product', ['category'],
+                              missing='none')
+        try:
+            fact_bcolz.create_rollup('category', ['category'], ['f1'])
+        except NotImplementedError:
+            pass
+        else:
+            raise AssertionError('Rolled up a lookup column')
+
     def test_where_terms00(self):
         """
         test_where_terms00: get terms in one column bigger than a certain value
@@ -341,6 +1073,46 @@ class TestCtable():
 
         assert_array_equal(result, mask)
 
+    def test_where_terms_05(self):
+        """
+        test_where_terms05: get a multi chunk mask for combined eval and in
+                            terms, usable in ctable.where
+        """
+        num_rows = 500000
+        include = [1, 3, 5]
+
+        # expected result
+        data = np.fromiter(((x, x % 7) for x in range(num_rows)),
+                           dtype='i8,i8')
+        mask = (data['f0'] >= 1000) & np.in1d(data['f1'], include)
+
+        # filter data
+        terms_filter = [('f0', '>=', 1000), ('f1', 'in', include)]
+        ct = bquery.ctable(data, rootdir=self.rootdir)
+        result = ct.where_terms(terms_filter)
+
+        assert isinstance(result, bquery.carray.__base__)
+        assert_array_equal(result, mask)
+        assert_array_equal([row.f0 for row in ct.where(result)],
+                           data['f0'][mask])
+
+    def test_where_terms_06(self):
+        """
+        test_where_terms06: get a mask for an eval and an in term on the
+                            same column, and a term comparing two columns
+        """
+        data = np.fromiter(((x % 7, (x * 3) % 11) for x in range(20000)),
+                           dtype='i8,i8')
+        ct = bquery.ctable(data, rootdir=self.rootdir)
+
+        result = ct.where_terms([('f1', '>', 1), ('f1', 'in', [2, 3, 4])])
+        assert_array_equal(result, (data['f1'] > 1) &
+                           np.in1d(data['f1'], [2, 3, 4]))
+
+        result = ct.where_terms([('f0', '>', 'f1'), ('f1', 'in', [1, 5])])
+        assert_array_equal(result, (data['f0'] > data['f1']) &
+                           np.in1d(data['f1'], [1, 5]))
+
     def test_factorize_groupby_cols_01(self):
         """
         test_factorize_groupby_cols_01:
@@ -364,6 +1136,150 @@ class TestCtable():
         assert_array_equal(fact_1[0][0], fact_2[0][0])
         assert_array_equal(fact_1[1][0], fact_2[1][0])
 
+    def test_factorize_groupby_cols_02(self):
+        """
+        test_factorize_groupby_cols_02: cached factors use the narrowest
+                                        label dtype
+        """
+        # generate data
+        iterable = ((x, x % 5, x % 300) for x in range(20000))
+        data = np.fromiter(iterable, dtype='i8,i8,i8')
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        ct = bquery.ctable(data, rootdir=self.rootdir)
+
+        ct.cache_factor(['f1', 'f2'], refresh=True)
+        factor_list, values_list = ct.factorize_groupby_cols(['f1', 'f2'])
+
+        assert factor_list[0].dtype == np.uint8
+        assert factor_list[1].dtype == np.uint16
+        assert_array_equal(np.arange(20000) % 5, factor_list[0])
+        assert_array_equal(np.arange(20000) % 300, factor_list[1])
+
+        result = ct.groupby(['f1', 'f2'], ['f0'])
+        assert len(result) == 300
+        assert result['f0'].sum() == data['f0'].sum()
+
+    def test_rollup_01(self):
+        """
+        test_rollup_01: Test a groupby answered from a rollup, before and
+                        after appending rows to the ctable
+        """
+        random.seed(1)
+
+        groupby_cols = ['f0', 'f2']
+        agg_list = ['f4', 'f5', ['f6_sum', 'f6', 'sum']]
+        num_rows = 2000
+
+        # -- Data --
+        g = self.gen_almost_unique_row(num_rows)
+        data = np.fromiter(g, dtype='S1,f8,i8,i4,f8,i8,i4')
+
+        # -- Bcolz --
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        fact_bcolz = bquery.ctable(data, rootdir=self.rootdir)
+        fact_bcolz.flush()
+        fact_bcolz.create_rollup('f0_f2', groupby_cols, agg_list)
+
+        def check(query_cols, query_aggs):
+            assert fact_bcolz.find_rollup(query_cols, query_aggs) == 'f0_f2'
+            result_rollup = fact_bcolz.groupby(query_cols, query_aggs)
+            result_base = fact_bcolz.groupby(query_cols, query_aggs,
+                                             use_rollups=False)
+            assert_list_equal(
+                sorted([list(x) for x in result_rollup[query_cols]]),
+                sorted([list(x) for x in result_base[query_cols]]))
+            result_rollup = sorted(result_rollup[:].tolist())
+            result_base = sorted(result_base[:].tolist())
+            for row_rollup, row_base in zip(result_rollup, result_base):
+                np.testing.assert_allclose(row_rollup[1:], row_base[1:])
+
+        check(['f0'], [['f4', 'f4'], ['f6', 'f6', 'sum']])
+        assert fact_bcolz.find_rollup(['f0', 'f1'], ['f4']) is None
+
+        # appended rows are merged into the rollup
+        g = self.gen_almost_unique_row(num_rows)
+        fact_bcolz.append(np.fromiter(g, dtype='S1,f8,i8,i4,f8,i8,i4'))
+        fact_bcolz.flush()
+        check(['f0'], ['f4', 'f5'])
+
+        fact_bcolz.drop_rollup('f0_f2')
+        assert fact_bcolz.find_rollup(['f0'], ['f4']) is None
+
+
+    def test_rollup_02(self):
+        """
+        test_rollup_02: Test that rollups over key expressions follow
+                        appends, and are not used after other writes
+        """
+        data = np.fromiter(((x % 5, x % 3, 1) for x in range(20000)),
+                           dtype='i8,i8,i8')
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        fact_bcolz = bquery.ctable(data, rootdir=self.rootdir)
+        fact_bcolz.flush()
+        fact_bcolz.create_rollup('keys', ['f0 % 2', 'f1'], ['f2'])
+
+        def check(data, rollup_name):
+            assert fact_bcolz.find_rollup(['f0 % 2'], ['f2']) == rollup_name
+            ref = bquery.ctable(data).groupby(['f0 % 2'], ['f2'])
+            assert_list_equal(
+                sorted(fact_bcolz.groupby(['f0 % 2'], ['f2'])[:].tolist()),
+                sorted(ref[:].tolist()))
+
+        check(data, 'keys')
+        fact_bcolz.append(data[:5000])
+        data = np.concatenate([data, data[:5000]])
+        fact_bcolz.flush()
+        check(data, 'keys')
+        assert fact_bcolz.rollups()['keys']['source_len'] == len(data)
+        assert not os.path.exists(
+            fact_bcolz.rollup_rootdir('keys') + '.tmp')
+
+        # a write that keeps the length makes the rollup out of date (a
+        # column written directly with its flush)
+        fact_bcolz['f2'][0:10] = 3
+        fact_bcolz['f2'].flush()
+        data['f2'][0:10] = 3
+        check(data, None)
+
+    def test_rollup_03(self):
+        """
+        test_rollup_03: Test that an append or create_rollup brings an out of
+                        date rollup up to date again
+        """
+        data = np.fromiter(((x % 5, 1) for x in range(20000)),
+                           dtype='i8,i8')
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        fact_bcolz = bquery.ctable(data, rootdir=self.rootdir)
+        fact_bcolz.flush()
+        fact_bcolz.create_rollup('f0', ['f0'], ['f1'])
+
+        def check():
+            assert fact_bcolz.find_rollup(['f0'], ['f1']) == 'f0'
+            assert_list_equal(
+                sorted(fact_bcolz.groupby(['f0'], ['f1'])[:].tolist()),
+                sorted(fact_bcolz.groupby(['f0'], ['f1'],
+                                          use_rollups=False)[:].tolist()))
+
+        # the append after a write is not merged into the old totals
+        data[0:10]['f1'] = 3
+        fact_bcolz[0:10] = data[0:10]
+        assert fact_bcolz.find_rollup(['f0'], ['f1']) is None
+        fact_bcolz.append(data[:5000])
+        fact_bcolz.flush()
+        check()
+
+        # an existing rollup is replaced
+        fact_bcolz['f1'][0:10] = 1
+        fact_bcolz['f1'].flush()
+        assert fact_bcolz.find_rollup(['f0'], ['f1']) is None
+        fact_bcolz.create_rollup('f0', ['f0'], ['f1'])
+        check()
+        assert not os.path.exists(fact_bcolz.rollup_rootdir('f0') + '.tmp')
+        assert not os.path.exists(fact_bcolz.rollup_rootdir('f0') + '.old')
 
 if __name__ == '__main__':
     nose.main()
\ No newline at end of file
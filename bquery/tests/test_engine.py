@@ -0,0 +1,134 @@
+import bquery
+import os
+import tempfile
+import threading
+import numpy as np
+import shutil
+import sys
+import traceback
+import nose
+from nose.tools import assert_list_equal, assert_raises
+from bquery.cancel import QueryCancelled, QueryTimeout, check_cancelled
+from bquery.engine import QueryEngine, QueryRejected
+
+
+class TestEngine():
+    def setup(self):
+        self.rootdir = tempfile.mkdtemp(prefix='bcolz-')
+        os.rmdir(self.rootdir)  # folder should be emtpy
+        iterable = ((x % 10, x) for x in range(10000))
+        data = np.fromiter(iterable, dtype='i8,i8')
+        bquery.ctable(data, rootdir=self.rootdir, chunklen=1000).flush()
+        self.engine = QueryEngine(max_workers=2, max_pending=2)
+
+    def teardown(self):
+        self.engine.close()
+        shutil.rmtree(self.rootdir)
+
+    def test_engine_01(self):
+        """
+        test_engine_01: queries run on pooled handles of the table
+        """
+        ref = bquery.open(self.rootdir).groupby(
+            ['f0'], ['f1'], bool_arr=bquery.open(self.rootdir).where_terms(
+                [('f1', '<', 5000)]))
+
+        future = self.engine.groupby(self.rootdir, ['f0'], ['f1'],
+                                     where=[('f1', '<', 5000)],
+                                     output='numpy')
+        result = future.result(timeout=10)
+        assert future.done()
+        assert_list_equal(sorted(result.tolist()),
+                          sorted([tuple(x) for x in ref]))
+
+        # the handle is back in the pool and used by the next query
+        assert len(self.engine.tables) == 1
+        future = self.engine.where_terms(self.rootdir, [('f0', '==', 1)])
+        assert future.result(timeout=10).sum() == 1000
+        assert len(self.engine.tables) == 1
+
+    def test_engine_02(self):
+        """
+        test_engine_02: admission control, cancellation and timeouts
+        """
+        # one worker, so the second query stays queued behind the first
+        self.engine.close()
+        self.engine = QueryEngine(max_workers=1, max_pending=2)
+        started = threading.Event()
+
+        def wait_for_cancel(ct):
+            started.set()
+            while True:
+                check_cancelled()
+
+        running = self.engine.submit(self.rootdir, wait_for_cancel)
+        started.wait(10)
+        queued = self.engine.groupby(self.rootdir, ['f0'], ['f1'])
+        assert_raises(QueryRejected, self.engine.groupby, self.rootdir,
+                      ['f0'], ['f1'])
+
+        running.cancel()
+        assert_raises(QueryCancelled, running.result, 10)
+        assert queued.result(timeout=10) is not None
+
+        # the deadline has passed before the query starts
+        future = self.engine.groupby(self.rootdir, ['f0'], ['f1'],
+                                     timeout=-1)
+        assert_raises(QueryTimeout, future.result, 10)
+
+    def test_engine_03(self):
+        """
+        test_engine_03: finished futures keep their state and tracebacks
+        """
+        future = self.engine.groupby(self.rootdir, ['f0'], ['f1'])
+        future.result(timeout=10)
+        assert not future.cancel()
+        assert not future.cancelled()
+        assert future.result(timeout=10) is not None
+
+        def failing_query(ct):
+            raise KeyError('failing')
+
+        future = self.engine.submit(self.rootdir, failing_query)
+        assert isinstance(future.exception(timeout=10), KeyError)
+        try:
+            future.result(timeout=10)
+        except KeyError:
+            functions = [frame[2] for frame in
+                         traceback.extract_tb(sys.exc_info()[2])]
+        assert 'failing_query' in functions
+
+        def exiting_query(ct):
+            raise SystemExit(1)
+
+        future = self.engine.submit(self.rootdir, exiting_query)
+        assert_raises(SystemExit, future.result, 10)
+        assert self.engine.pending() == 0
+        # the worker is still running
+        assert self.engine.where_terms(
+            self.rootdir, [('f0', '==', 1)]).result(timeout=10).sum() == 1000
+
+    def test_engine_04(self):
+        """
+        test_engine_04: pooled handles are reopened after the table changed
+        """
+        def count(ct):
+            return ct.len, ct['f1'].sum()
+
+        assert self.engine.submit(self.rootdir, count).result(
+            timeout=10) == (10000, sum(range(10000)))
+        assert len(self.engine.tables) == 1
+
+        # append through another handle
+        ct = bquery.open(self.rootdir, mode='a')
+        ct.append([[1] * 500, [1] * 500])
+        ct.flush()
+        assert self.engine.submit(self.rootdir, count).result(
+            timeout=10) == (10500, sum(range(10000)) + 500)
+
+        # an in place write to a full chunk
+        ct[0:1000] = (0, 2)
+        ct.flush()
+        assert self.engine.submit(self.rootdir, count).result(
+            timeout=10) == (10500, sum(range(1000, 10000)) + 2500)
+        assert len(self.engine.tables) == 1
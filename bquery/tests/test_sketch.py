@@ -0,0 +1,33 @@
+import numpy as np
+from bquery.sketch import QuantileSketch
+
+
+class TestSketch():
+    def test_sketch_01(self):
+        """
+        test_sketch_01: merged sketches of partitions give the quantiles of
+                        the whole, within the relative accuracy
+        """
+        np.random.seed(1)
+        groups = np.random.randint(0, 10, 20000)
+        values = np.random.lognormal(0, 2, 20000) * \
+            np.where(np.arange(20000) % 3, 1, -1)
+        values[::100] = 0
+
+        sketch = QuantileSketch(relative_accuracy=0.01)
+        for start in range(0, 20000, 3000):
+            partition = QuantileSketch(relative_accuracy=0.01)
+            partition.update(groups[start:start + 3000],
+                             values[start:start + 3000])
+            sketch.merge(partition)
+
+        for q in [0.0, 0.1, 0.5, 0.95, 1.0]:
+            # one group more than present, which has no values
+            result = sketch.quantile(q, 11)
+            assert np.isnan(result[10])
+            for g in range(10):
+                # the sketch returns a value of the group's distribution
+                # at the rank q * (n - 1)
+                ordered = np.sort(values[groups == g])
+                exact = ordered[int(q * (len(ordered) - 1))]
+                assert abs(result[g] - exact) <= 0.01 * abs(exact) + 1e-12